@@ -5,10 +5,13 @@ Onyx Salamander API Authentication Routes
 import uuid
 from fastapi import APIRouter, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordRequestForm, HTTPBasicCredentials, HTTPBasic
+from neo4j.exceptions import ConstraintError
 from typing import Optional
 
 # Onyx imports
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
 from auth.utils import *
 from models.base import Token, TokenData
 from models.user import User, UserRegister
@@ -27,7 +30,8 @@ ROUTE = {
 
 
 @router.post("/register")
-async def register_user(user:UserRegister):
+async def register_user(user:UserRegister,
+                        uow: UnitOfWork = Depends(GetUnitOfWork)):
     # Check email validity
     if not ValidateEmail(user.email):
         raise HTTPException(
@@ -46,7 +50,7 @@ async def register_user(user:UserRegister):
     salt, saltPos = CreateSalt(len(user.password))
     salted = SaltPassword(user.password, salt, saltPos)
     # Hash the password
-    phash = CreatePasswordHash(salted)
+    phash = await CreatePasswordHash(salted)
     # Create dictionary of new user attributes
     attributes = {
         "ScreenName": user.screenName,
@@ -64,31 +68,35 @@ async def register_user(user:UserRegister):
         "Disabled": False,
         "Banned": False,
     }
-    cypher_create = 'CREATE (user:User $params) RETURN user'
-
-    with settings.DB_DRIVER.session() as session:
-        # Check if user exists
-        if GetUser(user.email):
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Operation not permitted, user with email: {user.email} already exists.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
-        # Otherwise, create a new user
-        response = session.run(query=cypher_create, parameters={
+
+    async def work(tx):
+        response = await tx.run(query=queries.CREATE_USER, parameters={
             'params': attributes
         })
-        user_data = response.data()[0]['user']
+        return (await response.data())[0]['user']
+
+    # The unique User.Email constraint rejects existing users
+    try:
+        user_data = await uow.Write(work)
+    except ConstraintError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted, user with email: {user.email} already exists.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    # Forget any cached "unknown user" for this email
+    InvalidateUser(user.email)
 
     return User(**user_data)
 
 
 @router.post("/login", response_model=User)
-async def login_HTTP_basic(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+async def login_HTTP_basic(credentials: HTTPBasicCredentials = Depends(HTTPBasic()),
+                           uow: UnitOfWork = Depends(GetUnitOfWork)):
     if not settings.ENABLE_HTTP_AUTH:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="HTTP Basic Authentication Has Been Disabled.")
-    user = AuthenticateUser(credentials.username, credentials.password)
+    user = await AuthenticateUser(uow, credentials.username, credentials.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -98,13 +106,28 @@ async def login_HTTP_basic(credentials: HTTPBasicCredentials = Depends(HTTPBasic
     return user
 
 
+@router.get("/cache/stats")
+async def user_cache_stats(user: User = Depends(GetCurrentActiveUser)):
+    """user_cache_stats - Returns the hit/miss counters of this worker's
+    user cache (admins only)."""
+    if not user.Admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Only admins can view cache statistics.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return USER_CACHE.Stats()
+
+
 @router.post("/token", response_model=Token)
-async def login_access_token(form_data: OAuth2PasswordRequestForm = Depends(), expires: Optional[timedelta] = None):
+async def login_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+                             expires: Optional[timedelta] = None,
+                             uow: UnitOfWork = Depends(GetUnitOfWork)):
     if not settings.ENABLE_BEARER_AUTH:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Token Authentication Has Been Disabled")
 
-    user = AuthenticateUser(form_data.username, form_data.password)
+    user = await AuthenticateUser(uow, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -4,14 +4,19 @@ Onyx Salamander API Authentication Utilities
 
 """
 import re
+import asyncio
 import secrets
 import string
+from concurrent.futures import ThreadPoolExecutor
 from jose import JWTError, jwt
 from typing import Optional, List
 from datetime import datetime, timedelta
 from models.base import TokenData
 from fastapi import Depends, HTTPException, status
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.cache import TTLCache
 from models.user import User, UserInDB
 
 # RFC 5322 Regex Email Pattern
@@ -25,29 +30,60 @@ EMAIL_VALIDATE_PATTERN = "(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\\.[a-z0-9!#$%&'*+/=
 #   1 Special Char
 PASSWORD_COMPLEXITY_PATTERN = "^(?=.*?[A-Z])(?=.*?[a-z])(?=.*?[0-9])(?=.*?[#?!@$%^&*-]).{8,}$"
 
-def AuthenticateUser(email: str, pword: str):
+# passlib hashes with the bcrypt package (pinned in requirements.txt),
+# which releases the GIL, so a thread pool hashes passwords in parallel
+# without stalling the event loop.
+PASSWORD_POOL = ThreadPoolExecutor(max_workers=settings.PASSWORD_WORKERS,
+                                   thread_name_prefix="onyx-password")
+_password_jobs = 0  # Hash jobs running or waiting in PASSWORD_POOL
+
+# Users looked up by the auth dependencies, keyed by email
+USER_CACHE = TTLCache(maxsize=settings.USER_CACHE_SIZE,
+                      ttl=settings.USER_CACHE_TTL)
+
+async def AuthenticateUser(uow: UnitOfWork, email: str, pword: str):
     """AuthenticateUser - Authenticates a user and returns an instance of it.
+        uow: UnitOfWork - The request's unit of work
         email: str
         pword: str
 
         Usage:
-            user = AuthenticateUser('email@email.com', 'password')
+            user = await AuthenticateUser(uow, 'email@email.com', 'password')
             if user:
                 # Authentication success!
     """
-    user = GetUser(email)
+    user = await uow.Read(GetUser, email)
     if user:
-        return user if VerifyPassword(user, pword) else False
+        return user if await VerifyPassword(user, pword) else False
     return False
 
-def CreatePasswordHash(pword: str):
+async def _RunPasswordJob(func, *args):
+    """_RunPasswordJob - Runs a CPU heavy password function in
+    PASSWORD_POOL, or answers 503 when PASSWORD_QUEUE_LIMIT jobs are
+    already waiting for a worker.
+    """
+    global _password_jobs
+    if _password_jobs >= settings.PASSWORD_WORKERS + settings.PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress, try again shortly.",
+            headers={"Retry-After": "1"}
+        )
+    _password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            PASSWORD_POOL, func, *args)
+    finally:
+        _password_jobs -= 1
+
+async def CreatePasswordHash(pword: str):
     """CreatePasswordHash - Generates a hash of a password string.
         pword: str
 
         Usage:
-            hash = CreatePasswordhash('password') 
+            hash = await CreatePasswordHash('password')
     """
-    return settings.PWD_CONTEXT.hash(pword)
+    return await _RunPasswordJob(settings.PWD_CONTEXT.hash, pword)
 
 def CreateSalt(plen: int):
     """CreateSalt - Creates a salt for a password size.
@@ -78,36 +114,72 @@ def SaltPassword(pword:str, salt:str, saltPos:int):
         return False
     return pword[:saltPos] + salt + pword[saltPos:]
 
-def VerifyPassword(user:User, plain: str):
+async def VerifyPassword(user:User, plain: str):
     """VerifyPassword - Verifies a plaintext password.
         user: User - use GetUser()
         plain: str - The plaintext password
 
         Usage:
-            if(VerifyPassword(user, password)):
+            if await VerifyPassword(user, password):
                 # Authenticated successfully
     """
     salted = SaltPassword(plain, user.Salt, user.SaltPos)
-    return settings.PWD_CONTEXT.verify(salted, user.HashedPassword)
+    if not salted:
+        return False
+    return await _RunPasswordJob(settings.PWD_CONTEXT.verify,
+                                 salted, user.HashedPassword)
 
-def GetUser(email: str):
+async def GetUser(tx, email: str):
     """GetUser - Retrieves a user by email.
+        tx: The transaction to run in
         email: email
 
         Usage:
-            user = GetUser(email)
+            user = await uow.Read(GetUser, email)
             if user:
                 # User found!
     """
-    cypher_search = f"MATCH (user:User) WHERE user.Email = '{email}' RETURN user"
-    with settings.DB_DRIVER.session() as session:
-        user = session.run(query=cypher_search)
-        data = user.data()
-        if len(data) > 0:
-            user_data = data[0]['user']
-            return UserInDB(**user_data)
+    user = await tx.run(query=queries.GET_USER,
+                        parameters={"email": email})
+    data = await user.data()
+    if len(data) > 0:
+        user_data = data[0]['user']
+        return UserInDB(**user_data)
     return None
 
+async def GetCachedUser(uow: UnitOfWork, email: str):
+    """GetCachedUser - Retrieves a user by email through USER_CACHE.
+        uow: UnitOfWork - The request's unit of work
+        email: str
+
+    Unknown emails are cached too when USER_CACHE_NEGATIVE_TTL is set.
+
+        Usage:
+            user = await GetCachedUser(uow, email)
+    """
+    found, user = USER_CACHE.Get(email)
+    if found:
+        return user
+    user = await uow.ReadShared(("user", email), GetUser, email)
+    if user is not None:
+        USER_CACHE.Set(email, user)
+    else:
+        USER_CACHE.Set(email, None, ttl=settings.USER_CACHE_NEGATIVE_TTL)
+    return user
+
+def InvalidateUser(email: Optional[str] = None):
+    """InvalidateUser - Drops a user from USER_CACHE, call it after any
+    change to a User node so bans & disables apply right away.
+        email: str - The user's email, None drops every user
+
+        Usage:
+            InvalidateUser(user.Email)
+    """
+    if email is None:
+        USER_CACHE.Clear()
+    else:
+        USER_CACHE.Pop(email)
+
 def ValidateEmail(email: str):
     """ValidateEmail - Determines whether an email address is real or fake
         email: str
@@ -168,14 +240,15 @@ def ReadToken(token: str):
         raise cred_except from e
     return token_data, cred_except
 
-async def GetCurrentUser(token: str = Depends(settings.OAUTH2_SCHEME)):
+async def GetCurrentUser(token: str = Depends(settings.OAUTH2_SCHEME),
+                         uow: UnitOfWork = Depends(GetUnitOfWork)):
 
     """GetCurrentUser - Used to decrypt auth tokens and return the user email
     """
     if not token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
     token_data, cred_except = ReadToken(token=token)
-    user = GetUser(token_data.Email)
+    user = await GetCachedUser(uow, token_data.Email)
     if user is None:
         raise cred_except
     return user
@@ -189,14 +262,15 @@ async def GetCurrentActiveUser(current: User = Depends(GetCurrentUser)):
         raise HTTPException(status_code=400, detail="User Banned.")
     return current
 
-async def GetCurrentActiveUserAllowGuest(token: str = Depends(settings.OAUTH2_SCHEME)):
+async def GetCurrentActiveUserAllowGuest(token: str = Depends(settings.OAUTH2_SCHEME),
+                                         uow: UnitOfWork = Depends(GetUnitOfWork)):
     """GetCurrentUserAllowGuest  
     """
     if not token:
         return None
     else:
         token_data, _ = ReadToken(token=token)
-        current = GetUser(token_data.Email)
+        current = await GetCachedUser(uow, token_data.Email)
         if not current:
             return None
         if current.Disabled:
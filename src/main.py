@@ -2,6 +2,8 @@
 
 The main API server file.
 """
+from contextlib import asynccontextmanager
+import anyio
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -10,6 +12,29 @@ from starlette.middleware.cors import CORSMiddleware
 from onyx import settings
 import auth.auth as auth
 from onyx.routes import ImportRoutes
+from onyx.db.driver import OpenDriver, CloseDriver
+from onyx.db.migrations import RunMigrations
+from onyx.blog.autocomplete import LoadAutocomplete
+from onyx.blog.routing import LoadRouting
+from onyx.blog.image import ShutdownImageWorkers
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """lifespan - Opens the database driver, applies schema migrations &
+    loads the autocomplete index & URL routing table before serving
+    requests, then closes the driver & stops the image workers on
+    shutdown.
+    """
+    await OpenDriver()
+    if settings.RUN_MIGRATIONS:
+        await RunMigrations()
+    await LoadAutocomplete()
+    await LoadRouting()
+    yield
+    await CloseDriver()
+    await anyio.to_thread.run_sync(ShutdownImageWorkers)
+
 
 # Setup App
 app = FastAPI(
@@ -19,7 +44,7 @@ app = FastAPI(
     docs_url=settings.DOCS_URL,
     redoc_url=settings.REDOC_URL,
     debug=settings.DEBUG,
-
+    lifespan=lifespan,
 )
 
 # Mount static directory
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+"""migrate.py
+
+A handy script for applying database schema migrations.
+
+usage:
+    ./migrate.py
+    python3 migrate.py --dry-run
+    python3 migrate.py --target 1
+
+"""
+import argparse
+import asyncio
+from onyx.db.driver import OpenDriver, CloseDriver
+from onyx.db.migrations import RunMigrations
+
+
+async def Migrate(dry_run: bool, target: int):
+    """Migrate - Opens the driver, runs the migrations and reports them."""
+    await OpenDriver()
+    try:
+        applied = await RunMigrations(dry_run=dry_run, target=target)
+    finally:
+        await CloseDriver()
+    if not applied:
+        print("Database schema is up to date.")
+    for version, description, statements in applied:
+        print(f"{'Would apply' if dry_run else 'Applied'} "
+              f"migration {version}: {description}")
+        if dry_run:
+            for statement in statements:
+                print(f"    {statement}")
+
+
+# This section only runs if migrate.py is called directly
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(description="Apply schema migrations.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Show pending migrations without applying them")
+    parser.add_argument("--target", type=int, default=None,
+                        help="Migrate up to this version (default: latest)")
+    args = parser.parse_args()
+    asyncio.run(Migrate(dry_run=args.dry_run, target=args.target))
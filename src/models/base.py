@@ -55,7 +55,16 @@ class Node(NodeBase):
     Properties: Optional[dict] = None
 
 
-class Nodes(BaseModel):
+class CursorPage(BaseModel):
+    """CursorPage holds the cursors of a page of a list endpoint. Pass
+    NextCursor or PrevCursor back as `cursor` to read the next or previous
+    page, they are None when there is nothing more to read.
+    """
+    NextCursor: Optional[str] = None
+    PrevCursor: Optional[str] = None
+
+
+class Nodes(CursorPage):
     """Nodes is a helper class that allows us to return a list of Nodes.
     """
     Nodes: List[Node]
@@ -72,6 +81,48 @@ class Relationship(BaseModel):
     TargetNode: Node or BaseModel
     Properties: Optional[dict] = None
 
+# Batch Request & Response Models
+
+
+class BatchNode(BaseModel):
+    """BatchNode is one node to create through the batch CRUD endpoint.
+    """
+    Label: str
+    Properties: Optional[dict] = None
+
+
+class BatchRelationship(BaseModel):
+    """BatchRelationship is one relationship to create through the batch
+    CRUD endpoint, the source & target nodes are matched by a property value.
+    """
+    SourceLabel: str
+    SourceProperty: str
+    SourceValue: str
+    TargetLabel: str
+    TargetProperty: str
+    TargetValue: str
+    RelationshipType: str
+    Properties: Optional[dict] = None
+
+
+class BatchResult(BaseModel):
+    """BatchResult reports the outcome of one item of a batch request,
+    Index is the position of the item in the request.
+    """
+    Index: int
+    Success: bool
+    NODE_ID: Optional[int] = None  # Set for created nodes
+    UUID: Optional[str] = None  # Set for created nodes
+    RelationshipIDs: Optional[List[int]] = None  # Set for relationships
+    Error: Optional[str] = None
+
+
+class BatchResults(BaseModel):
+    """BatchResults is a helper class that allows us to return a list of
+    BatchResult.
+    """
+    Results: List[BatchResult]
+
 # Query Response Models
 
 
@@ -6,6 +6,7 @@ This represents a blog post within the Onyx Salamander CMS.
 from typing import Optional, List
 from pydantic import BaseModel
 from datetime import datetime
+from models.base import CursorPage
 
 
 class BlogPost(BaseModel):
@@ -32,3 +33,8 @@ class BlogPost(BaseModel):
     PublishedDate: Optional[datetime] = None
     ReviewDate: Optional[datetime] = None
     ArchiveDate: Optional[datetime] = None
+
+
+class BlogPosts(CursorPage):
+    """BlogPosts is a page of BlogPost results."""
+    BlogPosts: List[BlogPost]
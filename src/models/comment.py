@@ -6,6 +6,8 @@ CMS database.
 from typing import Optional, List
 from pydantic import BaseModel
 from datetime import datetime
+from models.base import CursorPage
+from models.file import File
 
 
 class Comment(BaseModel):
@@ -24,3 +26,30 @@ class Comment(BaseModel):
     # Datetime Metadata
     CreatedDate: Optional[datetime] = None
     ModifiedDate: Optional[datetime] = None
+
+
+class Comments(CursorPage):
+    """Comments is a page of Comment results."""
+    Comments: List[Comment]
+
+
+class CommentNode(Comment):
+    """CommentNode is a comment in a thread, with its author's screen name,
+    its attachments and the first replies to it. NextCursor reads more
+    replies from /comment/thread/{UUID}. Comments at the depth limit have
+    no Replies, HasReplies tells whether there are any to read.
+    """
+    Author: Optional[str] = None
+    Attachments: List[File] = []
+    Replies: List["CommentNode"] = []
+    HasReplies: bool = False
+    NextCursor: Optional[str] = None
+
+
+CommentNode.update_forward_refs()
+
+
+class CommentThread(CursorPage):
+    """CommentThread is a page of the comments on an item, with their
+    replies nested inside them."""
+    Comments: List[CommentNode]
@@ -2,9 +2,10 @@
 
 This file contains the File models for the Onyx Salamander CMS database.
 """
-from typing import Optional
+from typing import Optional, List
 from pydantic import BaseModel
 from datetime import datetime
+from models.base import CursorPage
 
 
 class File(BaseModel):
@@ -15,6 +16,7 @@ class File(BaseModel):
     Type: str
     SizeBytes: int
     Hash: Optional[str] = None
+    Blob: Optional[str] = None  # Storage key of a deduplicated file
     Description: Optional[str] = None
 
     # User Metadata
@@ -24,3 +26,8 @@ class File(BaseModel):
     # Datetime Metadata
     CreatedDate: Optional[datetime] = None
     ModifiedDate: Optional[datetime] = None
+
+
+class Files(CursorPage):
+    """Files is a page of File results."""
+    Files: List[File]
@@ -5,6 +5,7 @@ This file contains the Page models for the Onyx Salamander CMS database.
 from typing import Optional, List
 from pydantic import BaseModel
 from datetime import datetime
+from models.base import CursorPage
 
 
 class URI(BaseModel):
@@ -55,3 +56,13 @@ class Page(BaseModel):
     PublishDate: Optional[datetime] = None  # Can be used to time page creation
     ReviewDate: Optional[datetime] = None
     ArchiveDate: Optional[datetime] = None
+
+
+class URIs(CursorPage):
+    """URIs is a page of URI results."""
+    URLs: List[URI]
+
+
+class Pages(CursorPage):
+    """Pages is a page of Page results."""
+    Pages: List[Page]
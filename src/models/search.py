@@ -0,0 +1,37 @@
+"""models/search.py
+
+This file contains the search result models for the Onyx Salamander CMS.
+"""
+from typing import Optional, List, Dict
+from pydantic import BaseModel
+from models.base import CursorPage
+from models.blog_post import BlogPost
+from models.page import Page
+
+
+class SearchHit(BaseModel):
+    """SearchHit is a blog post or page matching a search, with the parts
+    of its fields that matched (HTML escaped, matches in <mark>).
+    """
+    Type: str  # "post" or "page"
+    Score: float
+    Highlights: Dict[str, str] = {}
+    BlogPost: Optional[BlogPost] = None
+    Page: Optional[Page] = None
+
+
+class SearchResults(CursorPage):
+    """SearchResults is a page of search hits, best matches first."""
+    Hits: List[SearchHit]
+
+
+class Suggestion(BaseModel):
+    """Suggestion is a title matching what has been typed so far."""
+    Type: str  # "post", "page" or "url"
+    Key: str  # The post UUID, page URL (or title) or URL
+    Title: str
+
+
+class Suggestions(BaseModel):
+    """Suggestions are the autocomplete matches of a prefix."""
+    Suggestions: List[Suggestion]
@@ -0,0 +1,30 @@
+"""models/tag.py
+
+This file contains the Tag facet models for the Onyx Salamander CMS.
+"""
+from typing import List
+from pydantic import BaseModel
+from models.base import CursorPage
+from models.blog_post import BlogPosts
+from models.page import Pages
+
+
+class Tag(BaseModel):
+    """Tag is a normalized tag or keyword and how many items use it."""
+    Name: str
+    Count: int = 0
+
+
+class Tags(CursorPage):
+    """Tags is a page of tags, most used first."""
+    Tags: List[Tag]
+
+
+class TaggedBlogPosts(BlogPosts):
+    """TaggedBlogPosts is a page of the blog posts with a tag."""
+    Tag: Tag
+
+
+class TaggedPages(Pages):
+    """TaggedPages is a page of the pages with a keyword."""
+    Tag: Tag
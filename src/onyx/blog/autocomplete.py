@@ -0,0 +1,249 @@
+"""onyx/blog/autocomplete.py
+
+Type-ahead over blog post titles, page titles & URLs for the Onyx
+Salamander CMS.
+
+Every worker keeps the titles in memory as a sorted list, so a prefix is
+found with a binary search instead of a database query. The index is
+loaded at startup, the handlers that change titles update it once their
+transaction has committed, and it is reloaded every AUTOCOMPLETE_REFRESH
+seconds to pick up changes made by other workers.
+"""
+import time
+import asyncio
+from bisect import bisect_left, insort
+from typing import Optional, List
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from neo4j import READ_ACCESS
+
+from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork
+from auth.auth import GetCurrentActiveUserAllowGuest
+from models.user import User
+from models.search import Suggestion, Suggestions
+
+# Setup API Router
+router = APIRouter()
+
+ROUTE = {
+    "router": router,
+    "prefix": "/autocomplete",
+    "tags": ["Search"]
+}
+
+TITLE_TYPES = ("post", "page", "url")
+MAX_WORDS = 8  # Titles match from the start of any of their first words
+
+
+class PrefixIndex:
+    """PrefixIndex finds titles by the prefix of any of their words.
+
+    Each title is stored once per word as (rest of the title from that
+    word, type, key) in a sorted list, case folded. All the titles starting
+    with a prefix are next to each other, so a lookup is one bisect and a
+    short scan.
+
+        Usage:
+            index = PrefixIndex()
+            index.Add("post", post.UUID, post.Title, published=True)
+            for kind, key, title, info in index.Search("gra", 10):
+                ...
+    """
+
+    def __init__(self):
+        self._keys = []  # Sorted (folded suffix, type, key)
+        self._entries = {}  # (type, key) -> (title, info)
+        self.loaded = 0  # time.monotonic() of the last full load
+        self.generation = 0  # Bumped by every Add & Remove
+
+    @staticmethod
+    def _Suffixes(title: str):
+        words = (title or "").casefold().split()[:MAX_WORDS]
+        return {" ".join(words[i:]) for i in range(len(words))}
+
+    def Add(self, kind: str, key: str, title: str, **info):
+        """Add - Adds a title or replaces the one stored for (kind, key)."""
+        self.Remove(kind, key)
+        self.generation += 1
+        self._entries[(kind, key)] = (title, info)
+        for suffix in self._Suffixes(title):
+            insort(self._keys, (suffix, kind, key))
+
+    def Remove(self, kind: str, key: str):
+        """Remove - Removes the title of (kind, key) if there is one."""
+        self.generation += 1
+        entry = self._entries.pop((kind, key), None)
+        if entry is None:
+            return
+        for suffix in self._Suffixes(entry[0]):
+            i = bisect_left(self._keys, (suffix, kind, key))
+            if i < len(self._keys) and self._keys[i] == (suffix, kind, key):
+                del self._keys[i]
+
+    def Load(self, rows):
+        """Load - Replaces the whole index with rows of
+        (kind, key, title, info)."""
+        keys = []
+        entries = {}
+        for kind, key, title, info in rows:
+            entries[(kind, key)] = (title, info)
+            keys.extend((suffix, kind, key)
+                        for suffix in self._Suffixes(title))
+        keys.sort()
+        self._keys, self._entries = keys, entries
+        self.loaded = time.monotonic()
+
+    def Search(self, prefix: str, limit: int, accept=None):
+        """Search - Yields up to limit (kind, key, title, info) whose title
+        has a word starting with prefix. accept(kind, info) can skip
+        results, e.g. the ones a user may not see."""
+        prefix = " ".join(prefix.casefold().split())
+        seen = set()
+        i = bisect_left(self._keys, (prefix,))
+        while i < len(self._keys) and len(seen) < limit:
+            suffix, kind, key = self._keys[i]
+            i += 1
+            if not suffix.startswith(prefix):
+                break
+            if (kind, key) in seen:
+                continue
+            title, info = self._entries[(kind, key)]
+            if accept is None or accept(kind, info):
+                seen.add((kind, key))
+                yield kind, key, title, info
+
+    def __len__(self):
+        return len(self._entries)
+
+
+AUTOCOMPLETE = PrefixIndex()
+_reload = None  # Running reload task
+_again = False  # Reload once more when the running reload is done
+
+
+def _Row(kind: str, record):
+    return (kind, record["key"], record["title"],
+            {"published": record["published"],
+             "owners": [owner for owner in record["owners"] if owner],
+             "private": record["private"]})
+
+
+async def LoadAutocomplete():
+    """LoadAutocomplete - (Re)loads every title from the database.
+
+    Runs in its own session since it also runs in the background, outside
+    of any request. If this worker changes the index while the titles are
+    read, they may predate the change, so they are dropped and the index
+    stays as it is until the next reload.
+    """
+    generation = AUTOCOMPLETE.generation
+    rows = []
+    async with settings.DB_DRIVER.session(
+            default_access_mode=READ_ACCESS,
+            fetch_size=settings.EXPORT_FETCH_SIZE) as session:
+        for kind in TITLE_TYPES:
+            result = await session.run(query=queries.TITLES[kind])
+            async for record in result:
+                rows.append(_Row(kind, record))
+    if AUTOCOMPLETE.generation != generation:
+        return False
+    AUTOCOMPLETE.Load(rows)
+    return True
+
+
+def RefreshAutocomplete(force: bool = False):
+    """RefreshAutocomplete - Starts a background reload once the index is
+    older than AUTOCOMPLETE_REFRESH seconds (or right away with force), at
+    most one at a time.
+
+        Usage:
+            RefreshAutocomplete(force=True)
+    """
+    global _reload, _again
+    if _reload and not _reload.done():
+        # The running reload may have read the database before the change
+        _again = _again or force
+        return
+    age = time.monotonic() - AUTOCOMPLETE.loaded
+    if not force and age < settings.AUTOCOMPLETE_REFRESH:
+        return
+    _reload = asyncio.ensure_future(LoadAutocomplete())
+    _reload.add_done_callback(_Reloaded)
+
+
+def _Reloaded(task):
+    """_Reloaded - Starts the reload forced while task was running."""
+    global _again
+    # Keep serving the old index if the reload fails
+    if not task.cancelled():
+        task.exception()
+    if _again:
+        _again = False
+        RefreshAutocomplete(force=True)
+
+
+async def _ReadTitles(tx, kind: str, keys: List[str]):
+    res = await tx.run(query=queries.TITLES_BY_KEY[kind],
+                       parameters={"keys": keys})
+    return [_Row(kind, record) async for record in res]
+
+
+async def ReindexTitles(uow: UnitOfWork, kind: str, keys: List[Optional[str]]):
+    """ReindexTitles - Reads the titles of some items again, call it once
+    a change to them has been committed. Items that are gone are removed.
+        uow: UnitOfWork
+        kind: str - post, page or url
+        keys: List[str] - Post UUIDs, page URLs (or titles) or URLs
+
+        Usage:
+            await ReindexTitles(uow, "page", [url, new_url])
+    """
+    keys = [key for key in keys if key]
+    if not keys:
+        return
+    rows = await uow.Read(_ReadTitles, kind, keys)
+    for key in keys:
+        AUTOCOMPLETE.Remove(kind, key)
+    for kind, key, title, info in rows:
+        AUTOCOMPLETE.Add(kind, key, title, **info)
+
+
+@router.get("", response_model=Suggestions)
+async def autocomplete(q: str,
+                       types: Optional[List[str]] = Query(None),
+                       limit: int = 10,
+                       user: User = Depends(GetCurrentActiveUserAllowGuest)):
+    """autocomplete - Returns the post titles, page titles & URLs with a
+    word that starts with q, from memory.
+
+    q: str - What has been typed so far
+    types: List[str] - post, page and/or url (default: all)
+    limit: int - At most AUTOCOMPLETE_MAX_RESULTS
+
+    Guests only see published posts and pages & URLs that do not require a
+    login. Users also see their own posts, admins see everything.
+    """
+    if not 0 < limit <= settings.AUTOCOMPLETE_MAX_RESULTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"limit must be 1 - {settings.AUTOCOMPLETE_MAX_RESULTS}.")
+    types = set(types or TITLE_TYPES)
+    uid = user.UUID if user else None
+    admin = bool(user and user.Admin)
+
+    def accept(kind, info):
+        if kind not in types:
+            return False
+        if admin:
+            return True
+        if not info["published"] and uid not in info["owners"]:
+            return False
+        return uid is not None or not info["private"]
+
+    RefreshAutocomplete()
+    suggestions = []
+    if q.strip():
+        for kind, key, title, _ in AUTOCOMPLETE.Search(q, limit, accept):
+            suggestions.append(Suggestion(Type=kind, Key=key, Title=title))
+    return Suggestions(Suggestions=suggestions)
@@ -10,11 +10,17 @@ from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
 
 # Import utils for database access & models
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage, EncodeCursor, DecodeCursor
+from onyx.db.stream import StreamRecords
 from auth.auth import GetCurrentActiveUser
 from models.user import User
-from models.comment import Comment
+from models.comment import Comment, Comments, CommentNode, CommentThread
 from models.file import File
-from onyx.blog.file import create_file, delete_file
+from onyx.blog.file import StoreUploads, DiscardUploads, RemoveStored
+from onyx.blog.file import RestoreBlobs
+from onyx.blog.file import _CreateFiles, _DeleteFile
 
 # Setup API Router
 router = APIRouter()
@@ -25,37 +31,43 @@ ROUTE = {
     "tags": ["Comment"]
 }
 
+MAX_THREAD_DEPTH = 8  # Levels of replies read by /comment/thread at once
 
-def GetComment(UUID: str, GetAttached=False):
-    basic = f"""MATCH (comment:Comment) WHERE comment.UUID = "{UUID}" RETURN comment"""
 
+def _FitThread(depth: int, limit: int, replies: int, budget: int):
+    """_FitThread - Returns (depth, limit, replies) shrunk until the thread
+    reads at most budget comments. Replies per comment go first, then
+    levels, then the comments on the item.
+
+        Usage:
+            depth, limit, replies = _FitThread(3, 25, 10, 500)
+    """
+    limit = min(limit, max(budget - 1, 1))
+    while replies > 1 and queries.ThreadNodes(depth, limit, replies) > budget:
+        replies -= 1
+    while depth > 1 and queries.ThreadNodes(depth, limit, replies) > budget:
+        depth -= 1
+    return depth, limit, replies
+
+
+async def GetComment(tx, UUID: str, GetAttached=False):
     if GetAttached:
-        cypher_search = """MATCH (comment:Comment {UUID: $uid})-[r:ATTACHES]->(f:File)
-        RETURN f, comment
-        """
         files = []
         comment = None
-        with settings.DB_DRIVER.session() as session:
-            res = session.run(query=cypher_search,
-                              parameters={"uid": UUID}).data()
+        res = await (await tx.run(query=queries.GET_COMMENT_WITH_ATTACHMENTS,
+                                  parameters={"uid": UUID})).data()
         if res:
             comment = Comment(**res[0]["comment"])
-            for each in res:
-                if each["f"]:
-                    files.append(File(**each["f"]))
-        else:
-            with settings.DB_DRIVER.session() as session:
-                res = session.run(query=basic).data()
-                if res:
-                    comment = Comment(**res[0]["comment"])
+            for each in res[0]["files"]:
+                files.append(File(**each))
 
         return {"Comment": comment, "Attachments": files}
 
     else:
-        with settings.DB_DRIVER.session() as session:
-            res = session.run(query=basic).data()
-            if res:
-                return Comment(**res[0]["comment"])
+        res = await (await tx.run(query=queries.GET_COMMENT,
+                                  parameters={"uid": UUID})).data()
+        if res:
+            return Comment(**res[0]["comment"])
 
 # Create a comment
 @router.post("/create", response_model=Comment)
@@ -68,7 +80,8 @@ async def create_comment(message: str,
                          # IDFK what that even means ¯\_(ツ)_/¯
                          linkedFiles: Optional[List[UploadFile]] = None,
                          published: Optional[bool] = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         uow: UnitOfWork = Depends(GetUnitOfWork)):
     UUID = str(uuid.uuid4())
     date = str(datetime.now(settings.SERVER_TIMEZONE))
     attributes = {
@@ -81,67 +94,149 @@ async def create_comment(message: str,
         "CreatedDate": date,
         "ModifiedDate": date,
     }
-    cypher_matches = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    MATCH (commentOn) WHERE commentOn.UUID = "{commentOn}"
-    """
-    cypher_creates = """
-    CREATE (comment:Comment $params)
-    CREATE (user)-[madeComment:OWNS]->(comment)
-    CREATE (comment)-[isOn:ON]->(commentOn)
-    """
-    files = []
-    if linkedFiles:
-        # Upload each file and attach to comment
-        i = 0
-        for file in linkedFiles:
-            f = await create_file(file, user=user)
-            if f:
-                cypher_matches += f"""
-                MATCH (file{i}:File)
-                WHERE file{i}.UUID = "{f.UUID}"
-                """
-                cypher_creates += f"""
-                CREATE (comment)-[linksTofile{i}:ATTACHES]->(file{i})
-                """
-                i += 1
-    cypher = cypher_matches + cypher_creates + " RETURN comment "
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={
-                          "params": attributes}).data()
-        if res:
-            return Comment(**res[0]["comment"])
-    # Failed, delete uploads
-    for file in linkedFiles:
-        await delete_file(UUID=file.UUID, user=user)
-    raise HTTPException(
-        status_code=status.HTTP_404_NOT_FOUND,
-        detail=f"Object {commentOn} not found.",
-    )
+    uploads = []
+
+    async def work(tx):
+        # Create the attachment nodes, the comment & its edges in one commit
+        await _CreateFiles(tx, user, uploads)
+        res = await (await tx.run(query=queries.CREATE_COMMENT, parameters={
+                          "user": user.UUID,
+                          "commentOn": commentOn,
+                          "files": [upload["UUID"] for upload in uploads],
+                          "params": attributes})).data()
+        if not res:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Object {commentOn} not found.",
+            )
+        return Comment(**res[0]["comment"])
+
+    try:
+        # Upload the files to storage concurrently
+        uploads.extend(await StoreUploads(linkedFiles or [], user))
+        comment = await uow.Write(work)
+    except BaseException:
+        # Failed, delete uploads
+        await DiscardUploads(uploads)
+        raise
+    await RestoreBlobs(linkedFiles or [], uploads)
+    return comment
 
 # List Comments
 
 
-@router.get("/list/{UUID}", response_model=List[Comment])
-async def list_comments(UUID: str):
-    """Returns all comments attached to an item
-    """
-    cypher = """MATCH (comment:Comment)-[r:ON]->(n {UUID: $uid})
-    RETURN comment
+@router.get("/list/{UUID}", response_model=Comments)
+async def list_comments(UUID: str,
+                        limit: int = 25,
+                        cursor: Optional[str] = None,
+                        uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """Returns a page of the comments attached to an item, oldest first
     """
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_COMMENTS, {"uid": UUID}, cursor, limit)
     comments = []
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"uid": UUID}).data()
-        for each in res:
-            comments.append(Comment(**each["comment"]))
+    for each in res:
+        comments.append(Comment(**each["comment"]))
+
+    return Comments(Comments=comments,
+                    NextCursor=next_cursor,
+                    PrevCursor=prev_cursor)
+
+# Read a thread
+
+
+def _BuildThread(items: list, limit: int, replies: int):
+    """_BuildThread - Turns one level of a thread read by
+    queries.CommentThreadQuery into CommentNodes, returning them and the
+    cursor of the comments after them (None if there are none)."""
+    items = sorted(items, key=lambda item: (item["CreatedDate"], item["UUID"]))
+    more = len(items) > limit
+    items = items[:limit]
+    nodes = []
+    for item in items:
+        item = dict(item)
+        children = item.pop("Replies", None)
+        attachments = [File(**each) for each in item.pop("Attachments")]
+        node = CommentNode(**item, Attachments=attachments)
+        if children is not None:
+            node.Replies, node.NextCursor = _BuildThread(children, replies,
+                                                         replies)
+            node.HasReplies = bool(node.Replies)
+        nodes.append(node)
+    next_cursor = None
+    if more:
+        next_cursor = EncodeCursor([items[-1]["CreatedDate"], items[-1]["UUID"]])
+    return nodes, next_cursor
+
+
+@router.get("/thread/{UUID}", response_model=CommentThread)
+async def read_thread(UUID: str,
+                      depth: int = 2,
+                      limit: int = 20,
+                      replies: int = 5,
+                      cursor: Optional[str] = None,
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """read_thread - Returns the comments on an item with their replies
+    nested inside them, read in one query.
+
+    UUID: str - The item (or comment) the thread is on
+    depth: int - Levels of comments, 1 is only the direct comments
+    limit: int - Comments on the item per page
+    replies: int - Replies read per comment
+
+    Each comment's NextCursor reads more of its replies, by passing the
+    comment's UUID & the cursor to this endpoint. Requests that could read
+    more than COMMENT_THREAD_MAX_NODES comments get fewer replies per
+    comment, then fewer levels.
+    """
+    if not 0 < depth <= MAX_THREAD_DEPTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"depth must be 1 - {MAX_THREAD_DEPTH}."
+        )
+    if limit < 1 or replies < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit & replies must be at least 1."
+        )
+    depth, limit, replies = _FitThread(depth, limit, replies,
+                                       settings.COMMENT_THREAD_MAX_NODES)
+    _, after = DecodeCursor(cursor)
+
+    async def work(tx):
+        res = await tx.run(query=queries.CommentThreadQuery(depth),
+                           parameters={"uid": UUID,
+                                       "after": after,
+                                       "limit": limit,
+                                       "replies": replies})
+        return await res.single()
+
+    record = await uow.Read(work)
+    if not record:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Object {UUID} not found."
+        )
+    comments, next_cursor = _BuildThread(record["comments"], limit, replies)
+    return CommentThread(Comments=comments, NextCursor=next_cursor)
+
+# Export Comments
 
-    return comments
+
+@router.get("/export/{UUID}")
+async def export_comments(UUID: str):
+    """Streams all comments attached to an item as newline delimited JSON
+    """
+    return StreamRecords(queries.EXPORT_COMMENTS, {"uid": UUID},
+                         lambda record: Comment(**record["comment"]).json())
 
 # Read a comment
 
 
 @router.get("/read/{UUID}")
-async def read_comment(UUID: str, GetAttached: bool = True):
-    return GetComment(UUID=UUID, GetAttached=GetAttached)
+async def read_comment(UUID: str, GetAttached: bool = True,
+                       uow: UnitOfWork = Depends(GetUnitOfWork)):
+    return await uow.Read(GetComment, UUID=UUID, GetAttached=GetAttached)
 
 # Update Comment
 
@@ -151,7 +246,8 @@ async def update_comment(UUID: str, message: Optional[str] = None,
                          deleteFiles: Optional[List[str]] = None,
                          linkedFiles: Optional[List[UploadFile]] = None,
                          published: Optional[bool] = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         uow: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.SERVER_TIMEZONE))
     attributes = {
         "Published": published,
@@ -159,54 +255,47 @@ async def update_comment(UUID: str, message: Optional[str] = None,
     }
     if message:
         attributes["Message"] = message
-    c = GetComment(UUID=UUID, GetAttached=True)
-    comment = c["Comment"]
-    files = c["Attachments"]
-    if not user.Admin and not comment.Creator:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="You cannot edit that comment."
-        )
-    # Handle file deletion
-    if deleteFiles and files:
-        for file in files:
-            if file.UUID in deleteFiles:
-                await delete_file(UUID=file.UUID, user=user)
-            elif file.Filename in deleteFiles:
-                await delete_file(UUID=file.UUID, user=user)
-
-    cypher_matches = f"""MATCH (comment:Comment)
-    WHERE comment.UUID = "{UUID}"
-    """
-    cypher_creates = ""
-
-    # Handle file uploading
-    if linkedFiles:
-        # Upload each file and attach to comment
-        i = 0
-        for file in linkedFiles:
-            f = await create_file(file, user=user)
-            if f:
-                cypher_matches += f"""
-                MATCH (file{i}:File)
-                WHERE file{i}.UUID = "{f.UUID}"
-                """
-                cypher_creates += f"""
-                CREATE (comment)-[linksTofile{i}:ATTACHES]->(file{i})
-                """
-                i += 1
-    cypher = cypher_matches
-    cypher += cypher_creates
-    cypher += """ SET comment += $attributes
-    RETURN comment
-    """
-    print("CYUPHER: ", cypher)
+    uploads = []
 
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={
-                          "attributes": attributes}).data()
-        print(res)
-        return Comment(**res[0]["comment"])
+    async def work(tx):
+        deleted = []
+        c = await GetComment(tx, UUID=UUID, GetAttached=True)
+        comment = c["Comment"]
+        files = c["Attachments"]
+        if not comment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Comment not found."
+            )
+        if not user.Admin and comment.Creator != user.UUID:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="You cannot edit that comment."
+            )
+        # Handle file deletion
+        if deleteFiles and files:
+            for file in files:
+                if file.UUID in deleteFiles or file.Filename in deleteFiles:
+                    deleted.append(await _DeleteFile(tx, file.UUID, user))
+        # Handle file uploading
+        await _CreateFiles(tx, user, uploads)
+        res = await (await tx.run(query=queries.UPDATE_COMMENT, parameters={
+                          "uid": UUID,
+                          "files": [upload["UUID"] for upload in uploads],
+                          "attributes": attributes})).data()
+        return Comment(**res[0]["comment"]), deleted
+
+    try:
+        # Upload the files to storage concurrently
+        uploads.extend(await StoreUploads(linkedFiles or [], user))
+        comment, deleted = await uow.Write(work)
+    except BaseException:
+        await DiscardUploads(uploads)
+        raise
+    await RestoreBlobs(linkedFiles or [], uploads)
+    # Remove the bytes of detached files once the update has committed
+    await RemoveStored(deleted)
+    return comment
 
 # Delete Comment
 
@@ -214,36 +303,36 @@ async def update_comment(UUID: str, message: Optional[str] = None,
 @router.post("/delete/{UUID}")
 async def delete_comment(UUID: str,
                          deleteLinked: bool = True,
-                         user: User = Depends(GetCurrentActiveUser)):
+                         user: User = Depends(GetCurrentActiveUser),
+                         uow: UnitOfWork = Depends(GetUnitOfWork)):
     """delete_comment()
 
     UUID:str - Comment UUID
     deleteLinked - Whether to delete linked files
     """
-    c = GetComment(UUID=UUID, GetAttached=True)
-    comment = c["Comment"]
-    files = c["Attachments"]
-    if not comment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Comment not found."
-        )
-    if not user.Admin and comment.Creator != user.UUID:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="You cannot delete this comment."
-        )
-    if deleteLinked and files != None:
-        for file in files:
-            await delete_file(UUID=file.UUID, user=user)
-    cypher = f"""MATCH (comment:Comment)
-    WHERE comment.UUID = "{UUID}"
-    DETACH DELETE comment
-    """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
-    # rel should be empty, if not this _should_ return an error message
-    return rel or {
+    async def work(tx):
+        c = await GetComment(tx, UUID=UUID, GetAttached=True)
+        comment = c["Comment"]
+        files = c["Attachments"]
+        if not comment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Comment not found."
+            )
+        if not user.Admin and comment.Creator != user.UUID:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="You cannot delete this comment."
+            )
+        deleted = []
+        if deleteLinked and files != None:
+            for file in files:
+                deleted.append(await _DeleteFile(tx, file.UUID, user))
+        await tx.run(query=queries.DELETE_COMMENT, parameters={"uid": UUID})
+        return deleted
+
+    deleted = await uow.Write(work)
+    await RemoveStored(deleted)
+    return {
         "response": f"Comment was successfully deleted."
     }
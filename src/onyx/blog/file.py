@@ -3,17 +3,23 @@
 This file handles CRUD functionality for files in the Onyx Salamander CMS
 """
 import uuid
-from tempfile import SpooledTemporaryFile
+import asyncio
+import anyio
 from typing import Optional, List
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi import UploadFile
 # Import utilities for database access & File model
 
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from onyx.db.stream import StreamRecords
+from onyx.storage.errors import FileExists
 from auth.auth import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest
 from models.user import User
-from models.file import File as DBFile
+from models.file import File as DBFile, Files
 
 # Setup API Router
 router = APIRouter()
@@ -25,98 +31,285 @@ ROUTE = {
 }
 
 
-def GetFileHash(file: SpooledTemporaryFile, block_size: int = 2**20):
-    hash = settings.HASH_FUNC()
-    while True:
-        data = file.read(block_size)
-        if not data:
-            break
-        hash.update(data)
-    return hash.hexdigest()
-
-
-def GetFileFromDB(UUID: str):
-    cypher = f"""MATCH (file:File)
-    WHERE file.UUID = "{UUID}" 
-    RETURN file
-    """
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
-        if not res:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
-        res = res[0]
-    f = DBFile(**res["file"])
+async def GetFileFromDB(tx, UUID: Optional[str] = None,
+                        filename: Optional[str] = None):
+    cypher = queries.GET_FILE if UUID else queries.GET_FILE_BY_FILENAME
+    res = await (await tx.run(query=cypher,
+                              parameters={"uid": UUID,
+                                          "filename": filename})).data()
+    if not res:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File: {UUID or filename} not found.")
+    f = DBFile(**res[0]["file"])
     return f
 
 
-def ReadFileFromStorage(dbFile: DBFile):
+def ReadFileFromStorage(dbFile: DBFile, headers=None):
     if dbFile:
-        return settings.STORAGE_DRIVER.ReadFile(dbFile.UUID, dbFile.Filename)
+        return settings.STORAGE_DRIVER.ReadFile(dbFile.Blob or dbFile.UUID,
+                                                dbFile.Filename,
+                                                headers=headers,
+                                                etag=dbFile.Hash)
 
-# Create
+
+async def _HashUpload(file: UploadFile, digest, chunk_size: int):
+    """_HashUpload - Adds the content of an upload to digest off the event
+    loop and returns its size. The upload is rewound afterwards."""
+    size = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        await anyio.to_thread.run_sync(digest.update, chunk)
+        size += len(chunk)
+    await file.seek(0)
+    return size
 
 
-@router.post("/create", response_model=DBFile)
-async def create_file(file: UploadFile, description: Optional[str] = None, user: User = Depends(GetCurrentActiveUser)):
+async def StoreUpload(file: UploadFile, user: User,
+                      description: Optional[str] = None):
+    """StoreUpload - Writes an upload to storage and returns the attributes
+    of its File node. The node itself is created by _CreateFile so callers
+    can put it in the same transaction as the rest of their writes.
+
+    The upload is read only once, its hash & size are worked out while it
+    is being written. With DEDUPLICATE_FILES on the upload is hashed first
+    and stored under its digest, which is skipped if the same content is
+    already stored (see RestoreBlobs).
+    """
     date = str(datetime.now(settings.SERVER_TIMEZONE))
     uid = str(uuid.uuid4())
     attributes = {
         "UUID": uid,
         "Filename": file.filename,
         "Type": file.content_type,
-        "SizeBytes": file.size,
         "Creator": user.UUID,
         "Modifier": user.UUID,
         "CreatedDate": date,
         "ModifiedDate": date,
     }
-    if settings.HASH_FILES:
-        attributes["Hash"] = await GetFileHash(file)
     if description:
         attributes["Description"] = description
 
-    # Upload file to storage
-    await settings.STORAGE_DRIVER.WriteFile(uid, file)
+    driver = settings.STORAGE_DRIVER
+    digest = None
+    if settings.HASH_FILES or settings.DEDUPLICATE_FILES:
+        digest = settings.HASH_FUNC()
+    if settings.DEDUPLICATE_FILES:
+        attributes["SizeBytes"] = await _HashUpload(
+            file, digest, settings.UPLOAD_CHUNK_SIZE)
+        blob = attributes["Blob"] = digest.hexdigest()
+        if not await anyio.to_thread.run_sync(driver.Exists, blob):
+            try:
+                await driver.WriteFile(blob, file,
+                                       chunk_size=settings.UPLOAD_CHUNK_SIZE)
+            except FileExists:
+                pass  # Stored by a concurrent upload of the same content
+    else:
+        # Upload file to storage, hashing it on the way
+        attributes["SizeBytes"] = await driver.WriteFile(
+            uid, file, digest=digest, chunk_size=settings.UPLOAD_CHUNK_SIZE)
+    if digest is not None:
+        attributes["Hash"] = digest.hexdigest()
+    return attributes
 
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    CREATE (file:File $params)
-    CREATE (user)-[relationship:OWNS]->(file)
-    RETURN file
+
+async def StoreUploads(files: List[UploadFile], user: User):
+    """StoreUploads - Writes several uploads to storage at the same time,
+    at most UPLOAD_CONCURRENCY at once, and returns their File attributes
+    in the order of files.
+
+    If any upload fails (or the request is cancelled) the others are
+    waited for and discarded before the error is raised, so nothing is left
+    behind in storage.
+
+        Usage:
+            uploads = await StoreUploads(linkedFiles or [], user)
     """
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        f = res.data()[0]["file"]
-    return DBFile(**f)
+    slots = asyncio.Semaphore(settings.UPLOAD_CONCURRENCY)
+
+    async def store(file):
+        async with slots:
+            return await StoreUpload(file, user)
+
+    tasks = [asyncio.ensure_future(store(file)) for file in files]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        await DiscardUploads([res for res in results
+                              if isinstance(res, dict)])
+        raise
+
+
+async def _Unlink(key: str):
+    """_Unlink - Deletes a key from storage in a worker thread, storage
+    drivers such as S3 make a network call for it."""
+    try:
+        await anyio.to_thread.run_sync(settings.STORAGE_DRIVER.DeleteFile,
+                                       key)
+    except FileNotFoundError:
+        pass
+
+
+async def _RemoveBlob(tx, blob: str):
+    """_RemoveBlob - Removes the bytes of a deduplicated blob that no file
+    uses, along with its node.
+
+    The bytes are removed while the transaction holds the blob's lock, so
+    an upload of the same content either commits first (and the blob is
+    kept) or creates the blob anew afterwards and writes the bytes again
+    (see RestoreBlobs). Removing them twice on a retry does no harm.
+    """
+    record = await (await tx.run(query=queries.LOCK_UNUSED_BLOB,
+                                 parameters={"hash": blob})).single()
+    if not record:
+        return
+    await _Unlink(blob)
+    await tx.run(query=queries.DELETE_UNUSED_BLOB, parameters={"hash": blob})
+
+
+async def RemoveBlobs(blobs: List[str]):
+    """RemoveBlobs - Removes the deduplicated blobs that are no longer used.
+
+    Runs in its own session since it also cleans up after requests whose
+    transaction failed.
+    """
+    if not blobs:
+        return
+    async with settings.DB_DRIVER.session() as session:
+        for blob in sorted(set(blobs)):
+            await session.execute_write(_RemoveBlob, blob)
+
+
+async def RemoveStored(deleted: List[tuple]):
+    """RemoveStored - Removes the bytes of deleted files from storage, call
+    it once their nodes are gone for good.
+        deleted: List[tuple] - (file, unused) pairs returned by _DeleteFile
+
+        Usage:
+            await RemoveStored(deleted)
+    """
+    blobs = []
+    for f, unused in deleted:
+        if unused is None:
+            continue
+        if f.Blob:
+            blobs.append(unused)
+        else:
+            await _Unlink(unused)
+    await RemoveBlobs(blobs)
+
+
+async def DiscardUploads(uploads: List[dict]):
+    """DiscardUploads - Removes stored uploads whose File nodes were never
+    committed.
+
+    Deduplicated blobs are only removed if no committed file uses them,
+    another upload of the same content may share them.
+    """
+    blobs = []
+    for attributes in uploads:
+        if "Blob" in attributes:
+            blobs.append(attributes["Blob"])
+        else:
+            await _Unlink(attributes["UUID"])
+    await RemoveBlobs(blobs)
+
+
+async def RestoreBlobs(files: List[UploadFile], uploads: List[dict]):
+    """RestoreBlobs - Writes the bytes of deduplicated uploads again if
+    they are missing, call it once their File nodes have committed.
+
+    StoreUpload skips content that is already stored, but the last file
+    using it may be deleted before the upload commits, and the bytes
+    removed with it. Once a committed file uses a blob its bytes are never
+    removed, so checking them afterwards is enough.
+
+        Usage:
+            await RestoreBlobs(linkedFiles or [], uploads)
+    """
+    driver = settings.STORAGE_DRIVER
+    for file, attributes in zip(files, uploads):
+        blob = attributes.get("Blob")
+        if blob is None or await anyio.to_thread.run_sync(driver.Exists,
+                                                          blob):
+            continue
+        await file.seek(0)
+        await driver.WriteFile(blob, file, overwrite=True,
+                               chunk_size=settings.UPLOAD_CHUNK_SIZE)
+
+
+async def _CreateFile(tx, user: User, attributes: dict):
+    res = await tx.run(query=queries.CREATE_FILE,
+                       parameters={"user": user.UUID,
+                                   "params": attributes})
+    return DBFile(**(await res.data())[0]["file"])
+
+
+async def _CreateFiles(tx, user: User, uploads: List[dict]):
+    """_CreateFiles - Creates the File nodes of several uploads with a
+    single query."""
+    if not uploads:
+        return []
+    res = await tx.run(query=queries.CREATE_FILES,
+                       parameters={"user": user.UUID, "files": uploads})
+    return [DBFile(**record["file"]) for record in await res.data()]
+
+
+async def _DeleteFile(tx, UUID: str, user: User):
+    """_DeleteFile - Deletes a File node the user is allowed to delete.
+
+    Returns (file, unused) where unused is the storage key to remove once
+    the transaction has committed, or None while a deduplicated blob is
+    still used by other files.
+    """
+    f = await GetFileFromDB(tx, UUID=UUID)
+    if not user.Admin and f.Creator != user.UUID:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="You are not allowed to delete this file.")
+    res = await tx.run(query=queries.DELETE_FILE, parameters={"uid": f.UUID})
+    record = await res.single()
+    return f, record and record["unused"]
+
+# Create
+
+
+@router.post("/create", response_model=DBFile)
+async def create_file(file: UploadFile, description: Optional[str] = None,
+                      user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    attributes = await StoreUpload(file, user, description)
+    try:
+        f = await uow.Write(_CreateFile, user, attributes)
+    except BaseException:
+        await DiscardUploads([attributes])
+        raise
+    await RestoreBlobs([file], [attributes])
+    return f
 
 # Read
 
 
 @router.get("/read/")
-async def read_file(download: bool = True,
+async def read_file(request: Request,
+                   download: bool = True,
                    UUID: Optional[str] = None,
                    filename: Optional[str] = None,
-                   user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    cypher = """MATCH (file:File)
-    """
+                   user: User = Depends(GetCurrentActiveUserAllowGuest),
+                   uow: UnitOfWork = Depends(GetUnitOfWork)):
     if UUID:
-        cypher += f"""WHERE file.UUID = "{UUID}" """
+        f = await uow.ReadShared(("file", UUID), GetFileFromDB, UUID)
     elif filename:
-        cypher += f"""WHERE file.Filename = "{filename}" """
+        f = await uow.ReadShared(("file-name", filename),
+                                 GetFileFromDB, filename=filename)
     else:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="No UUID or filename provided.")
-
-    cypher += "RETURN file"
-
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
-        if not res:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"File: {UUID} not found.")
-        res = res[0]
-    f = DBFile(**res["file"])
-    file = ReadFileFromStorage(f)
+    file = ReadFileFromStorage(f, request.headers)
     if download:
         return file
     return f
@@ -124,35 +317,33 @@ async def read_file(download: bool = True,
 # List
 
 
-@router.post("/list", response_model=List[DBFile])
+@router.post("/list", response_model=Files)
 async def list_file(limit: int = 25,
-                   user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    cypher = f"""MATCH (file:File) RETURN file LIMIT {limit}"""
+                   cursor: Optional[str] = None,
+                   user: User = Depends(GetCurrentActiveUserAllowGuest),
+                   uow: UnitOfWork = Depends(GetUnitOfWork)):
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_FILES, {}, cursor, limit)
     files = []
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
-        for file in res:
-            files.append(DBFile(**file["file"]))
-    return files
+    for file in res:
+        files.append(DBFile(**file["file"]))
+    return Files(Files=files, NextCursor=next_cursor, PrevCursor=prev_cursor)
+
+
+@router.get("/export")
+async def export_file(user: User = Depends(GetCurrentActiveUserAllowGuest)):
+    """export_file - Streams every file record as newline delimited JSON"""
+    return StreamRecords(queries.EXPORT_FILES, {},
+                         lambda record: DBFile(**record["file"]).json())
 
 
 @router.post("/delete/{UUID}")
 async def delete_file(UUID: str,
-                     user: User = Depends(GetCurrentActiveUser)):
-    cypher = f"""MATCH (file:File)
-    WHERE file.UUID = "{UUID}"
-    DETACH DELETE file
-    """
-    f = GetFileFromDB(UUID=UUID)
-    if not f:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="File not found.")
-    if not user.Admin and f.Creator != user.UUID:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail="You are not allowed to delete this file.")
-    settings.STORAGE_DRIVER.DeleteFile(f.UUID)
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
-    return res or {
+                     user: User = Depends(GetCurrentActiveUser),
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    f, unused = await uow.Write(_DeleteFile, UUID, user)
+    # Only remove the bytes once the node is gone for good
+    await RemoveStored([(f, unused)])
+    return {
         "response": f"File {f.Filename} was successfully deleted."
     }
@@ -0,0 +1,273 @@
+"""onyx/blog/image.py
+
+Resized & converted versions (derivatives) of image files for the Onyx
+Salamander CMS.
+
+Derivatives are rendered with Pillow in a process pool, so decoding and
+encoding never block the event loop, and cached on disk in IMAGE_CACHE_DIR
+by the file's hash and the transform. The cache is bounded by
+IMAGE_CACHE_BYTES, least recently used derivatives are deleted first.
+
+Pillow is an optional dependency, install it to use image transforms:
+
+    pip install Pillow
+"""
+import io
+import os
+import asyncio
+import hashlib
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import Query, Response
+
+from onyx import settings
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.cache import TTLCache, SingleFlight
+from onyx.storage.base import PARTIAL_SUFFIX
+from onyx.storage.response import RangeFileResponse, ETagMatches
+from auth.auth import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest
+from models.user import User
+
+from onyx.blog.file import GetFileFromDB
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+# Setup API Router
+router = APIRouter()
+
+ROUTE = {
+    "router": router,
+    "prefix": "/file",
+    "tags": ["File"]
+}
+
+# Output formats, name -> (Pillow format, media type)
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+FITS = ("contain", "crop")
+
+# Rendering is CPU bound & holds the GIL, so it runs in other processes
+IMAGE_POOL = ProcessPoolExecutor(max_workers=settings.IMAGE_WORKERS)
+# Deletes evicted derivatives off the event loop, one at a time & in order
+EVICT_POOL = ThreadPoolExecutor(max_workers=1,
+                                thread_name_prefix="image-evict")
+# Coalesces concurrent requests for the same derivative & the cache load
+IMAGE_FLIGHT = SingleFlight()
+
+
+def _Remove(name: str):
+    """_Remove - Deletes a derivative from disk. Runs in EVICT_POOL."""
+    try:
+        os.remove(os.path.join(settings.IMAGE_CACHE_DIR, name))
+    except FileNotFoundError:
+        pass
+
+
+def _Evict(name: str, size: int):
+    """_Evict - Queues the deletion of a derivative pushed out of
+    IMAGE_CACHE. If it is rendered again before that runs, read_image
+    finds the file missing & renders it once more."""
+    EVICT_POOL.submit(_Remove, name)
+
+
+def ShutdownImageWorkers():
+    """ShutdownImageWorkers - Stops the render processes & finishes the
+    queued deletions, called when the app shuts down.
+
+        Usage:
+            ShutdownImageWorkers()
+    """
+    IMAGE_POOL.shutdown(cancel_futures=True)
+    EVICT_POOL.shutdown()
+
+
+# Sizes of the derivatives on disk, keyed by their file name
+IMAGE_CACHE = TTLCache(maxsize=settings.IMAGE_CACHE_BYTES,
+                       ttl=float("inf"),
+                       weigh=lambda size: size,
+                       evict=_Evict)
+_cache_loaded = False
+
+
+def _ScanImageCache():
+    """_ScanImageCache - Returns the (name, size) of the derivatives left
+    on disk by earlier runs, oldest first, deleting unfinished ones. Runs
+    in a worker thread."""
+    os.makedirs(settings.IMAGE_CACHE_DIR, exist_ok=True)
+    with os.scandir(settings.IMAGE_CACHE_DIR) as it:
+        entries = [(entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                   for entry in it if entry.is_file()]
+    found = []
+    for _, name, size in sorted(entries):
+        if name.endswith(PARTIAL_SUFFIX):
+            _Remove(name)
+        else:
+            found.append((name, size))
+    return found
+
+
+async def _LoadImageCache():
+    """_LoadImageCache - Indexes the derivatives left on disk so they count
+    towards IMAGE_CACHE_BYTES. The directory is read in a thread, the
+    cache is only touched on the event loop."""
+    global _cache_loaded
+    for name, size in await anyio.to_thread.run_sync(_ScanImageCache):
+        if size > IMAGE_CACHE.maxsize:
+            _Evict(name, size)
+        else:
+            IMAGE_CACHE.Set(name, size)
+    _cache_loaded = True
+
+
+def RenderImage(data: bytes, width: Optional[int], height: Optional[int],
+                fit: str, fmt: str, quality: int):
+    """RenderImage - Returns data resized & converted to fmt. Runs in
+    IMAGE_POOL.
+
+    contain fits the image inside width x height keeping its aspect ratio,
+    crop fills width x height exactly and cuts off what does not fit.
+    Images are never enlarged.
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        img = ImageOps.exif_transpose(original)
+        if fit == "crop":
+            # Shrink the box to the image, keeping its aspect ratio
+            scale = min(1, img.width / width, img.height / height)
+            size = (max(1, round(width * scale)),
+                    max(1, round(height * scale)))
+            img = ImageOps.fit(img, size, Image.LANCZOS)
+        elif width or height:
+            img.thumbnail((width or img.width, height or img.height),
+                          Image.LANCZOS)
+        pil_format = FORMATS[fmt][0]
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, pil_format, quality=quality)
+        return out.getvalue()
+
+
+async def _RenderDerivative(f, name: str, transform: tuple):
+    """_RenderDerivative - Renders a derivative & stores it in the cache,
+    returning its bytes."""
+    try:
+        data = await settings.STORAGE_DRIVER.ReadBytes(f.Blob or f.UUID)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"File: {f.UUID} not found.")
+    try:
+        body = await asyncio.get_running_loop().run_in_executor(
+            IMAGE_POOL, RenderImage, data, *transform)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="File is not a supported image.")
+
+    if len(body) <= IMAGE_CACHE.maxsize:
+        path = os.path.join(settings.IMAGE_CACHE_DIR, name)
+
+        def write():
+            partial = path + PARTIAL_SUFFIX
+            with open(partial, "wb") as out:
+                out.write(body)
+            os.replace(partial, path)
+        await anyio.to_thread.run_sync(write)
+        IMAGE_CACHE.Set(name, len(body))
+    return body
+
+
+@router.get("/image/cache/stats")
+async def image_cache_stats(user: User = Depends(GetCurrentActiveUser)):
+    """image_cache_stats - Returns the size & hit/miss counters of this
+    worker's image derivative cache (admins only)."""
+    if not user.Admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Only admins can view cache statistics.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return IMAGE_CACHE.Stats()
+
+
+@router.get("/image/{UUID}")
+async def read_image(request: Request, UUID: str,
+                     width: Optional[int] = None,
+                     height: Optional[int] = None,
+                     fit: str = "contain",
+                     fmt: str = Query("webp", alias="format"),
+                     quality: int = settings.IMAGE_QUALITY,
+                     user: User = Depends(GetCurrentActiveUserAllowGuest),
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """read_image - Serves an image file resized and/or converted.
+
+    UUID: str - File UUID
+    width, height: int - Bounding box, at most IMAGE_MAX_SIZE
+    fit: str - contain (keep aspect ratio) or crop (fill the box)
+    format: str - webp, avif, jpeg or png
+    quality: int - Encoder quality, 1 - 100
+    """
+    if Image is None:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                            detail="Image transforms need Pillow installed.")
+    for size in (width, height):
+        if size is not None and not 0 < size <= settings.IMAGE_MAX_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"width & height must be 1 - {settings.IMAGE_MAX_SIZE}.")
+    if fit not in FITS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"fit must be one of {', '.join(FITS)}.")
+    if fit == "crop" and not (width and height):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="crop needs both width & height.")
+    Image.init()
+    if fmt not in FORMATS or FORMATS[fmt][0] not in Image.SAVE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unsupported image format: {fmt}")
+    if not 0 < quality <= 100:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="quality must be 1 - 100.")
+
+    f = await uow.ReadShared(("file", UUID), GetFileFromDB, UUID)
+    if not (f.Type or "").startswith("image/"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="File is not an image.")
+
+    # The hash names the content, so a derivative is shared by every file
+    # with the same bytes
+    transform = (width, height, fit, fmt, quality)
+    source = f.Hash or f.Blob or f.UUID
+    digest = hashlib.sha256(repr((source,) + transform).encode()).hexdigest()
+    name = f"{digest[:40]}.{fmt}"
+    etag = f'"{digest[:32]}"'
+    headers = {"Cache-Control": settings.IMAGE_CACHE_CONTROL}
+    media_type = FORMATS[fmt][1]
+    if ETagMatches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers={"ETag": etag, **headers})
+
+    if not _cache_loaded:
+        # Concurrent first requests share one scan
+        await IMAGE_FLIGHT.Do(("load",), _LoadImageCache)
+    path = os.path.join(settings.IMAGE_CACHE_DIR, name)
+    found, _ = IMAGE_CACHE.Get(name)
+    # Other workers share the directory & may have deleted it
+    if found and os.path.exists(path):
+        return RangeFileResponse(path, media_type=media_type,
+                                 headers=headers, etag=digest[:32],
+                                 range_header=request.headers.get("range"),
+                                 if_range=request.headers.get("if-range"),
+                                 zero_copy=settings.ZERO_COPY_SEND)
+    body = await IMAGE_FLIGHT.Do(name, _RenderDerivative, f, name, transform)
+    return Response(content=body, media_type=media_type,
+                    headers={"ETag": etag, **headers})
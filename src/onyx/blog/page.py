@@ -2,17 +2,27 @@
 
 This file handles CRUD functionality for Pages in the Onyx Salamander CMS
 """
+import hashlib
 from typing import Optional, List
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from fastapi.responses import RedirectResponse
 
 # Import utilities for database access & Page model
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from onyx.db.stream import StreamRecords
+from onyx.cache import TTLCache
+from onyx.storage.response import ETagMatches
 from auth.auth import GetCurrentActiveUser
 from models.user import User
-from models.page import Page
+from models.page import Page, Pages
 
 from onyx.blog.url import _CreateURL
+from onyx.blog.autocomplete import ReindexTitles
+from onyx.blog.routing import ROUTING, RerouteURLs, RefreshRouting
 
 # Setup API Router
 router = APIRouter()
@@ -24,39 +34,73 @@ ROUTE = {
     "tags": ["Page"]
 }
 
+# Serialized responses of the public page route, keyed by URL.
+# Entries are (etag, body) and the cache is bounded by total body size.
+PAGE_CACHE = TTLCache(maxsize=settings.PAGE_CACHE_BYTES,
+                      ttl=settings.PAGE_CACHE_TTL,
+                      weigh=lambda entry: len(entry[1]))
+# How many times each URL (and the whole cache) was invalidated. A page read
+# is only cached if no invalidation happened while it was being read.
+_generations = {}
+_generation = 0
 
-def GetPage(url: Optional[str] = None, title: Optional[str] = None):
+
+def _Generation(url: str):
+    """_Generation - Returns the current cache generation of url."""
+    return _generation, _generations.get(url, 0)
+
+
+def InvalidatePage(*urls: str):
+    """InvalidatePage - Drops pages from PAGE_CACHE, call it once a change
+    to a page has been committed.
+        urls: str - The page URLs, none drops every page
+
+        Usage:
+            InvalidatePage(url, new_url)
+    """
+    global _generation
+    if not urls:
+        _generation += 1
+        PAGE_CACHE.Clear()
+    for url in urls:
+        if url:
+            _generations[url] = _generations.get(url, 0) + 1
+            PAGE_CACHE.Pop(url)
+
+
+async def GetPage(tx, url: Optional[str] = None, title: Optional[str] = None):
     if url:
-        cypher_search = f"MATCH (page:Page) WHERE page.URL = '{url}' RETURN page"
+        cypher_search = queries.GET_PAGE_BY_URL
     elif title:
-        cypher_search = f"MATCH (page:Page) WHERE page.Title = '{title}' RETURN page"
+        cypher_search = queries.GET_PAGE_BY_TITLE
+    else:
+        return None
 
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher_search).data()
-        if result:
-            return Page(**result[0]["page"])
+    result = await (await tx.run(query=cypher_search,
+                                 parameters={"url": url,
+                                             "title": title})).data()
+    if result:
+        return Page(**result[0]["page"])
 
 
-def UpdatePageURL(original: str, new: str, user: User, delete_old: bool = True):
-    # Create new URL
-    _CreateURL(url=new, user=user)
+async def UpdatePageURL(tx, original: str, new: str, user: User, delete_old: bool = True):
+    """UpdatePageURL - Moves a page to a new URL. Unless delete_old, the
+    original URL is kept as a redirect to the new one."""
+    # Create new URL, or take back an old URL of the page
+    reused = await (await tx.run(query=queries.REUSE_URL,
+                                 parameters={"url": new})).data()
+    if not reused:
+        await _CreateURL(tx, url=new, user=user)
     # Detach & Delete url
-    cypher_detach = f"MATCH (url:URL) WHERE url.URL = '{original}'"
-    if delete_old:
-        cypher_detach += " DETACH DELETE url"
-    else:
-        cypher_detach += " DETACH url"
+    cypher_detach = queries.DELETE_URL if delete_old else queries.UNLINK_URL
+    await tx.run(query=cypher_detach, parameters={"url": original})
     # Update & attach page URL
-    cypher = f"""
-    MATCH (url:URL) WHERE url.URL = "{new}"
-    MATCH (page:Page) WHERE page.URL = "{original}"
-    SET page.URL = "{new}"
-    CREATE (url)-[relationship:LINKS]->(page)
-    RETURN page
-    """
-    with settings.DB_DRIVER.session() as session:
-        session.run(query=cypher_detach).data()
-        page = session.run(query=cypher).data()[0]["page"]
+    page = (await (await tx.run(query=queries.RELINK_PAGE_URL,
+                                parameters={"original": original,
+                                            "new": new})).data())[0]["page"]
+    if not delete_old:
+        await tx.run(query=queries.REDIRECT_URL,
+                     parameters={"original": original, "new": new})
     return Page(**page)
 
 
@@ -69,16 +113,10 @@ async def create_page(title: str, headline: str, language: str,
                       publishDate: Optional[datetime] = None,
                       reviewDate: Optional[datetime] = None,
                       archiveDate: Optional[datetime] = None,
-                      user: User = Depends(GetCurrentActiveUser)
+                      user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)
                       ):
     """CreatePage - Creates a new page"""
-    # Check that Page does not exist
-    if GetPage(title=title):
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Operation not permitted. Page with Title: {title} already exists.",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
     date = str(datetime.now(settings.SERVER_TIMEZONE))
 
     attributes = {
@@ -110,35 +148,101 @@ async def create_page(title: str, headline: str, language: str,
     if archiveDate:
         attributes["ArchiveDate"] = archiveDate
 
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    CREATE (page:Page $params)
-    CREATE (user)-[relationship:OWNS]->(page)
-    """
-    if url:
-        _CreateURL(url=url, user=user, description=description)
-        cypher += f"""MATCH (url:URL) WHERE url.URL = "{url}"
-        CREATE (url)-[relationship2:LINKS]->(page)"""
-
-    cypher += "RETURN page"
+    async def work(tx):
+        # Check that Page does not exist
+        if await GetPage(tx, title=title):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Operation not permitted. Page with Title: {title} already exists.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        if url:
+            await _CreateURL(tx, url=url, user=user, description=description)
 
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        page = res.data()[0]
-        page = page["page"]
+        res = await tx.run(query=queries.CREATE_PAGE,
+                           parameters={"user": user.UUID,
+                                       "url": url,
+                                       "params": attributes})
+        page = (await res.data())[0]
+        return Page(**page["page"])
 
-    return Page(**page)
+    page = await uow.Write(work)
+    await ReindexTitles(uow, "page", [url or title])
+    await ReindexTitles(uow, "url", [url])
+    await RerouteURLs(uow, [url])
+    return page
 
 # Read Pages
 
 
 @page_router.get("/{url}", response_model=Page)
+async def serve_page(url: str, request: Request,
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """serve_page - Serves a page to visitors from PAGE_CACHE.
+
+    Old URLs of a moved page are redirected (301) to its current URL from
+    the routing table.
+
+    Responses carry a strong ETag of the serialized page (which includes
+    its ModifiedDate), so a matching If-None-Match is answered with 304
+    straight from the cache. A page read while the page was invalidated
+    (e.g. a read that started before an update committed) is served but
+    not cached.
+    """
+    RefreshRouting()
+    target = ROUTING.Redirect(url)
+    if target:
+        location = "/" + target.lstrip("/")
+        if request.url.query:
+            location += "?" + request.url.query
+        return RedirectResponse(location,
+                                status_code=status.HTTP_301_MOVED_PERMANENTLY)
+    found, entry = PAGE_CACHE.Get(url)
+    if not found:
+        generation = _Generation(url)
+        # Requests made after an invalidation do not join older reads
+        page = await uow.ReadShared(("page", url, generation), GetPage,
+                                    url=url)
+        if not page:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Nothing found for /{url}"
+            )
+        body = page.json().encode()
+        entry = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        if _Generation(url) == generation:
+            PAGE_CACHE.Set(url, entry)
+
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": settings.PAGE_CACHE_CONTROL}
+    if ETagMatches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+    return Response(content=body, media_type="application/json",
+                    headers=headers)
+
+
+@router.get("/cache/stats")
+async def page_cache_stats(user: User = Depends(GetCurrentActiveUser)):
+    """page_cache_stats - Returns the hit/miss counters of this worker's
+    page cache (admins only)."""
+    if not user.Admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Only admins can view cache statistics.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return PAGE_CACHE.Stats()
+
+
 @router.post("/read/", response_model=Page)
 async def read_page(url: Optional[str] = None,
-                    title: Optional[str] = None):
+                    title: Optional[str] = None,
+                    uow: UnitOfWork = Depends(GetUnitOfWork)):
     if url:
-        p = GetPage(url=url)
+        p = await uow.ReadShared(("page", url), GetPage, url=url)
     elif title:
-        p = GetPage(title=title)
+        p = await uow.ReadShared(("page-title", title), GetPage, title=title)
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -154,16 +258,25 @@ async def read_page(url: Optional[str] = None,
 # List Pages
 
 
-@router.get("/list/pages", response_model=List[Page])
-async def list_pages(limit: int = 25):
-    cypher = f"MATCH (page:Page) return page LIMIT {limit}"
+@router.get("/list/pages", response_model=Pages)
+async def list_pages(limit: int = 25,
+                     cursor: Optional[str] = None,
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_PAGES, {}, cursor, limit)
     out = []
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
-        for page in rel:
-            out.append(Page(**page["page"]))
-    return out
+    for page in res:
+        out.append(Page(**page["page"]))
+    return Pages(Pages=out, NextCursor=next_cursor, PrevCursor=prev_cursor)
+
+# Export Pages
+
+
+@router.get("/export/pages")
+async def export_pages():
+    """export_pages - Streams every page as newline delimited JSON"""
+    return StreamRecords(queries.EXPORT_PAGES, {},
+                         lambda record: Page(**record["page"]).json())
 
 # Update Pages
 
@@ -171,36 +284,32 @@ async def list_pages(limit: int = 25):
 @router.put("/update/{url}", response_model=Page)
 async def update_page(url: str,
                       attributes: dict,
-                      user: User = Depends(GetCurrentActiveUser)):
+                      redirect: bool = False,
+                      user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """update_page - Updates a page, a URL in attributes moves it. With
+    redirect the old URL is kept and redirects to the new one."""
     time = str(datetime.now(settings.SERVER_TIMEZONE))
-    page = GetPage(url=url)
-    if page and not page.Owner == user.UUID:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"You do not have write access to {url}.",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    cypher = f"""MATCH (page:Page) WHERE page.URL = "{url}"
-    SET page += $attributes
-    SET page.Modifier = "{user.UUID}"
-    SET page.ModifiedDate = "{time}"
-    RETURN page
-    """
-    if "URL" in attributes.keys():
-        UpdatePageURL(original=url, new=attributes["URL"], user=user)
-        url = attributes["URL"]
-        del attributes["URL"]
-    for key in attributes.keys():
-        if key in settings.BASE_PROPERTIES:
-            del attributes[key]
-    with settings.DB_DRIVER.session() as session:
+    new_url = attributes.pop("URL", None)
+    attributes = {key: value for key, value in attributes.items()
+                  if key not in settings.BASE_PROPERTIES}
+    queries.ValidatePropertyKeys(attributes)
+
+    async def work(tx):
+        page = await GetPage(tx, url=url)
+        if page and not page.Owner == user.UUID:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write access to {url}.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
         if not user.Admin:
-            relate = session.run(query=f"""MATCH (user:User)-[relationship]->(page:Page)
-            WHERE user.UUID = "{user.UUID}" AND page.URL = "{url}"
-            RETURN relationship
-            """).data()[0]
+            relate = await (await tx.run(query=queries.GET_PAGE_PERMISSIONS,
+                                         parameters={"user": user.UUID,
+                                                     "url": url})).data()
             if relate:
-                if "OWNS" not in str(relate) and "CanModify" not in str(relate):
+                types = [each["type"] for each in relate]
+                if "OWNS" not in types and "CanModify" not in types:
                     raise HTTPException(
                         status_code=status.HTTP_401_UNAUTHORIZED,
                         detail=f"You do not have write access to page {url}.",
@@ -212,9 +321,24 @@ async def update_page(url: str,
                     detail=f"You do not have write access to {url}.",
                     headers={"WWW-Authenticate": "Bearer"}
                 )
-        update = session.run(query=cypher, parameters={
-                             "attributes": attributes}).data()[0]
-    return Page(**update["page"])
+        current = url
+        if new_url:
+            await UpdatePageURL(tx, original=url, new=new_url, user=user,
+                                delete_old=not redirect)
+            current = new_url
+        update = (await (await tx.run(query=queries.UPDATE_PAGE, parameters={
+                             "url": current,
+                             "attributes": attributes,
+                             "user": user.UUID,
+                             "date": time})).data())[0]
+        return Page(**update["page"])
+
+    page = await uow.Write(work)
+    InvalidatePage(url, new_url)
+    await ReindexTitles(uow, "page", [url, new_url])
+    await ReindexTitles(uow, "url", [url, new_url])
+    await RerouteURLs(uow, [url, new_url])
+    return page
 
 # Delete Pages
 
@@ -222,23 +346,26 @@ async def update_page(url: str,
 @router.post("/delete/{url}")
 async def delete_page(url: str,
                       del_url: bool = True,
-                      user: User = Depends(GetCurrentActiveUser)):
-    page = GetPage(url=url)
-    if page and not page.Owner == user.UUID:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"You do not have write access to {url}.",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    cypher = f"""MATCH (page:Page) WHERE page.URL = "{url}"
-    MATCH (url:URL) WHERE url.URL = "{url}"
-    DETACH DELETE page
-    """
-    if del_url:
-        cypher += "DETACH DELETE url"
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
+                      user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    async def work(tx):
+        page = await GetPage(tx, url=url)
+        if page and not page.Owner == user.UUID:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write access to {url}.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        result = await tx.run(query=queries.DELETE_PAGE,
+                              parameters={"url": url,
+                                          "del_url": del_url})
+        return await result.data()
+
+    rel = await uow.Write(work)
+    InvalidatePage(url)
+    await ReindexTitles(uow, "page", [url])
+    await ReindexTitles(uow, "url", [url])
+    await RerouteURLs(uow, [url])
     # rel should be empty, if not this _should_ return an error message
     return rel or {
         "response": f"Page {url} was successfully deleted."
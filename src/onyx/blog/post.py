@@ -9,7 +9,12 @@ from fastapi import APIRouter, Depends, HTTPException, status
 # Import utilities for database access & File model
 
 from onyx import settings
-from models.blog_post import BlogPost
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from onyx.db.stream import StreamRecords
+from onyx.blog.autocomplete import ReindexTitles
+from models.blog_post import BlogPost, BlogPosts
 from auth.auth import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest
 from models.base import Relationship
 from models.user import User
@@ -27,25 +32,27 @@ ROUTE = {
 }
 
 
-def GetBlogPost(UUID: Optional[str] = None,
-                title: Optional[str] = None,
-                user: Optional[User] = None):
+async def GetBlogPost(tx,
+                      UUID: Optional[str] = None,
+                      title: Optional[str] = None,
+                      user: Optional[User] = None):
     if UUID:
-        cypher_search = f"MATCH (post:BlogPost) WHERE post.UUID = '{UUID}' "
+        cypher_search = queries.GET_BLOG_POST_BY_UUID
     elif title:
-        cypher_search = f"MATCH (post:BlogPost) WHERE post.Title = '{title}'"
-
-    if not user:
-        cypher_search += "AND post.Published = True"
-    elif not user.Admin:
-        cypher_search += f"AND post.Owner = '{user.UUID}'"
-
-    cypher_search += " RETURN post"
+        cypher_search = queries.GET_BLOG_POST_BY_TITLE
+    else:
+        return None
+    parameters = {
+        "uid": UUID,
+        "title": title,
+        "user": user.UUID if user else None,
+        "admin": bool(user and user.Admin),
+    }
 
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher_search).data()
-        if result:
-            return BlogPost(**result[0]["post"])
+    result = await (await tx.run(query=cypher_search,
+                                 parameters=parameters)).data()
+    if result:
+        return BlogPost(**result[0]["post"])
 
 # Create
 
@@ -55,7 +62,8 @@ async def create_blog_post(title: str, content: str,
                            published: Optional[bool] = False,
                            tags: Optional[List[str]] = None,
                            keywords: Optional[List[str]] = None,
-                           user: User = Depends(GetCurrentActiveUser)):
+                           user: User = Depends(GetCurrentActiveUser),
+                           uow: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.SERVER_TIMEZONE))
     attributes = {
         "UUID": str(uuid.uuid4()),
@@ -75,16 +83,14 @@ async def create_blog_post(title: str, content: str,
     if keywords:
         attributes["Keywords"] = keywords
 
-    cypher = f"""MATCH (user:User) WHERE user.UUID = "{user.UUID}"
-    CREATE (post:BlogPost $params)
-    CREATE (user)-[relationship:OWNS]->(post)
-    CREATE (user)-[relationship2:AUTHOR]->(post)
-    RETURN post
-    """
+    async def work(tx):
+        res = await tx.run(query=queries.CREATE_BLOG_POST,
+                           parameters={"user": user.UUID,
+                                       "params": attributes})
+        return BlogPost(**(await res.data())[0]["post"])
 
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"params": attributes})
-        post = BlogPost(**res.data()[0]["post"])
+    post = await uow.Write(work)
+    await ReindexTitles(uow, "post", [post.UUID])
     return post
 
 # Read
@@ -93,37 +99,58 @@ async def create_blog_post(title: str, content: str,
 @router.get("/read", response_model=Optional[BlogPost])
 async def read_blog_post(UUID: Optional[str] = None,
                          title: Optional[str] = None,
-                         user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    return GetBlogPost(UUID=UUID, title=title, user=user)
+                         user: User = Depends(GetCurrentActiveUserAllowGuest),
+                         uow: UnitOfWork = Depends(GetUnitOfWork)):
+    # Visibility depends on the user, so they are part of the key
+    key = ("post", UUID, title, user.UUID if user else None,
+           bool(user and user.Admin))
+    return await uow.ReadShared(key, GetBlogPost,
+                                UUID=UUID, title=title, user=user)
 
 # List
 
 
-@router.get("/list", response_model=List[BlogPost])
+@router.get("/list", response_model=BlogPosts)
 async def list_blog_posts(limit: int = 25,
                           order_by: Optional[str] = None,
-                          user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    if not user:
-        cypher = f"MATCH (post:BlogPost) WHERE post.Published = True RETURN post LIMIT {limit}"
-    elif not user.Admin:
-        cypher = f"""MATCH (post:BlogPost) WHERE post.Published = True
-        OR post.Owner = "{user.UUID}"
-        OR post.Creator = "{user.UUID}"
-        RETURN post
-        LIMIT {limit}
-        """
-    elif user.Admin == True:
-        cypher = "MATCH (post:BlogPost) RETURN post LIMIT {limit}"
-
-    if order_by:
-        cypher += f" ORDER BY post.{order_by}"
+                          cursor: Optional[str] = None,
+                          user: User = Depends(GetCurrentActiveUserAllowGuest),
+                          uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """list_blog_posts - Returns a page of the visible blog posts.
+
+    order_by: str - CreatedDate (default), ModifiedDate, PublishedDate or
+        Title. Posts without that property (e.g. drafts when sorting by
+        PublishedDate) are left out.
+    """
+    order_by = queries.ValidateSortKey(order_by or "CreatedDate")
+    parameters = {
+        "user": user.UUID if user else None,
+        "admin": bool(user and user.Admin),
+    }
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_BLOG_POSTS[order_by], parameters, cursor,
+        limit)
     posts = []
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
-        for each in res:
-            post = BlogPost(**each["post"])
-            posts.append(post)
-    return posts
+    for each in res:
+        post = BlogPost(**each["post"])
+        posts.append(post)
+    return BlogPosts(BlogPosts=posts,
+                     NextCursor=next_cursor,
+                     PrevCursor=prev_cursor)
+
+# Export
+
+
+@router.get("/export")
+async def export_blog_posts(user: User = Depends(GetCurrentActiveUserAllowGuest)):
+    """export_blog_posts - Streams every visible blog post as newline
+    delimited JSON"""
+    parameters = {
+        "user": user.UUID if user else None,
+        "admin": bool(user and user.Admin),
+    }
+    return StreamRecords(queries.EXPORT_BLOG_POSTS, parameters,
+                         lambda record: BlogPost(**record["post"]).json())
 
 # Update
 
@@ -131,56 +158,54 @@ async def list_blog_posts(limit: int = 25,
 @router.post("/update/{UUID}", response_model=BlogPost)
 async def update_blog_post(UUID: str,
                            attributes: dict,
-                           user: User = Depends(GetCurrentActiveUser)):
+                           user: User = Depends(GetCurrentActiveUser),
+                           uow: UnitOfWork = Depends(GetUnitOfWork)):
     date = str(datetime.now(settings.SERVER_TIMEZONE))
-    post = GetBlogPost(UUID=UUID, user=user)
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"You do not have write read/write access to the post or it does not exist."
-        )
-    cypher = f"""MATCH (post:BlogPost)
-    WHERE post.UUID = "{UUID}"
-    SET post += $attributes
-    SET post.Modifier = "{user.UUID}"
-    SET post.ModifiedDate = "{date}"
-    """
+    published = None
     if "Published" in attributes.keys():
-        if attributes["Published"]:
-            cypher += f"""SET post.Published = True
-            SET post.PublishedDate = "{date}"
-            """
-        else:
-            cypher += f"""SET post.Published = False"""
-        del attributes["Published"]
-    cypher += "RETURN post"
-    for key in attributes.keys():
-        if key in settings.BASE_PROPERTIES:
-            del attributes[key]
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"attributes": attributes})
-        updated = BlogPost(**res.data()[0]["post"])
-    return updated
+        published = bool(attributes.pop("Published"))
+    attributes = {key: value for key, value in attributes.items()
+                  if key not in settings.BASE_PROPERTIES}
+    queries.ValidatePropertyKeys(attributes)
+
+    async def work(tx):
+        post = await GetBlogPost(tx, UUID=UUID, user=user)
+        if not post:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write read/write access to the post or it does not exist."
+            )
+        res = await tx.run(query=queries.UPDATE_BLOG_POST,
+                           parameters={"uid": UUID,
+                                       "attributes": attributes,
+                                       "user": user.UUID,
+                                       "date": date,
+                                       "published": published})
+        return BlogPost(**(await res.data())[0]["post"])
+
+    post = await uow.Write(work)
+    await ReindexTitles(uow, "post", [UUID])
+    return post
 
 # Delete
 
 
 @router.post("/delete/{UUID}")
 async def delete_blog_post(UUID: str,
-                           user: User = Depends(GetCurrentActiveUser)):
-    post = GetBlogPost(UUID=UUID, user=user)
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"You do not have write read/write access to the post, or it does not exist."
-        )
-    cypher = f"""MATCH (post:BlogPost)
-    WHERE post.UUID = "{UUID}"
-    DETACH DELETE post
-    """
-
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
+                           user: User = Depends(GetCurrentActiveUser),
+                           uow: UnitOfWork = Depends(GetUnitOfWork)):
+    async def work(tx):
+        post = await GetBlogPost(tx, UUID=UUID, user=user)
+        if not post:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write read/write access to the post, or it does not exist."
+            )
+        return await (await tx.run(query=queries.DELETE_BLOG_POST,
+                                   parameters={"uid": UUID})).data()
+
+    res = await uow.Write(work)
+    await ReindexTitles(uow, "post", [UUID])
     return res or {
         "response": f"Blog post {UUID} was successfully deleted."
     }
@@ -0,0 +1,204 @@
+"""onyx/blog/routing.py
+
+In-memory routing table of the URLs of the Onyx Salamander CMS.
+
+Every worker keeps each URL node in memory, together with the URL it
+redirects to: a URL that LINKS to another URL (an old page URL kept by
+UpdatePageURL) redirects there. URLs are resolved and redirects are served
+without a database query. The table is loaded at startup, the handlers that
+change URLs update it once their transaction has committed, and it is
+reloaded every ROUTING_REFRESH seconds to pick up changes made by other
+workers.
+"""
+import time
+import asyncio
+from typing import Optional, List
+from neo4j import READ_ACCESS
+
+from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork
+from models.page import URI
+
+MAX_REDIRECTS = 10  # Longest redirect chain followed, guards against loops
+
+
+class RoutingTable:
+    """RoutingTable maps URLs to their URI and old URLs to new ones.
+
+    Redirect chains (a page moved twice) are followed in memory, so clients
+    get a single redirect to the current URL.
+
+        Usage:
+            table = RoutingTable()
+            table.Set(uri, redirect="new-url")
+            target = table.Redirect("old-url")
+    """
+
+    def __init__(self):
+        self._urls = {}  # URL -> URI
+        self._redirects = {}  # Old URL -> URL it LINKS to
+        self.loaded = 0  # time.monotonic() of the last full load
+        self.generation = 0  # Bumped by every Set & Remove
+
+    def Set(self, uri: URI, redirect: Optional[str] = None):
+        """Set - Adds a URL or replaces the one stored with the same URL."""
+        self.generation += 1
+        self._urls[uri.URL] = uri
+        if redirect:
+            self._redirects[uri.URL] = redirect
+        else:
+            self._redirects.pop(uri.URL, None)
+
+    def Remove(self, url: str):
+        """Remove - Removes a URL, along with the redirects to it (they
+        were deleted with it)."""
+        self.generation += 1
+        self._urls.pop(url, None)
+        self._redirects.pop(url, None)
+        for source in self.Sources(url):
+            del self._redirects[source]
+
+    def Load(self, rows):
+        """Load - Replaces the whole table with rows of (URI, redirect)."""
+        urls = {}
+        redirects = {}
+        for uri, redirect in rows:
+            urls[uri.URL] = uri
+            if redirect:
+                redirects[uri.URL] = redirect
+        self._urls, self._redirects = urls, redirects
+        self.loaded = time.monotonic()
+
+    def Get(self, url: str):
+        """Get - Returns the URI of url, None if it is not in the table."""
+        return self._urls.get(url)
+
+    def Redirect(self, url: str):
+        """Redirect - Returns the current URL an old URL redirects to, None
+        if url is not a redirect."""
+        target = self._redirects.get(url)
+        for _ in range(MAX_REDIRECTS):
+            if target not in self._redirects:
+                break
+            target = self._redirects[target]
+        return target
+
+    def Sources(self, url: str):
+        """Sources - Returns the URLs that redirect straight to url."""
+        return [source for source, target in self._redirects.items()
+                if target == url]
+
+    def Find(self, text: str):
+        """Find - Returns the URIs whose URL contains text."""
+        return [uri for url, uri in self._urls.items() if text in url]
+
+    def __len__(self):
+        return len(self._urls)
+
+
+ROUTING = RoutingTable()
+_reload = None  # Running reload task
+_again = False  # Reload once more when the running reload is done
+
+
+def _Row(record):
+    return URI(**record["url"]), record["redirect"]
+
+
+async def LoadRouting():
+    """LoadRouting - (Re)loads every URL from the database.
+
+    Runs in its own session since it also runs in the background, outside
+    of any request. If this worker changes the table while the rows are
+    read, they may predate the change, so they are dropped and the table
+    stays as it is until the next reload.
+    """
+    generation = ROUTING.generation
+    rows = []
+    async with settings.DB_DRIVER.session(
+            default_access_mode=READ_ACCESS,
+            fetch_size=settings.EXPORT_FETCH_SIZE) as session:
+        result = await session.run(query=queries.LOAD_ROUTES)
+        async for record in result:
+            rows.append(_Row(record))
+    if ROUTING.generation != generation:
+        return False
+    ROUTING.Load(rows)
+    return True
+
+
+def RefreshRouting(force: bool = False):
+    """RefreshRouting - Starts a background reload once the table is older
+    than ROUTING_REFRESH seconds (or right away with force), at most one at
+    a time.
+
+        Usage:
+            RefreshRouting(force=True)
+    """
+    global _reload, _again
+    if _reload and not _reload.done():
+        # The running reload may have read the database before the change
+        _again = _again or force
+        return
+    age = time.monotonic() - ROUTING.loaded
+    if not force and age < settings.ROUTING_REFRESH:
+        return
+    _reload = asyncio.ensure_future(LoadRouting())
+    _reload.add_done_callback(_Reloaded)
+
+
+def _Reloaded(task):
+    """_Reloaded - Starts the reload forced while task was running."""
+    global _again
+    # Keep serving the old table if the reload fails
+    if not task.cancelled():
+        task.exception()
+    if _again:
+        _again = False
+        RefreshRouting(force=True)
+
+
+async def _ReadRoutes(tx, urls: List[str]):
+    res = await tx.run(query=queries.READ_ROUTES, parameters={"urls": urls})
+    return [_Row(record) async for record in res]
+
+
+async def RerouteURLs(uow: UnitOfWork, urls: List[Optional[str]]):
+    """RerouteURLs - Reads some URLs again, call it once a change to them
+    has been committed. URLs that are gone are removed, and the URLs that
+    redirected to them are read again too.
+        uow: UnitOfWork
+        urls: List[str] - The URLs that changed
+
+        Usage:
+            await RerouteURLs(uow, [url, new_url])
+    """
+    urls = {url for url in urls if url}
+    for url in list(urls):
+        urls.update(ROUTING.Sources(url))
+    if not urls:
+        return
+    rows = await uow.Read(_ReadRoutes, list(urls))
+    for url in urls:
+        ROUTING.Remove(url)
+    for uri, redirect in rows:
+        ROUTING.Set(uri, redirect)
+
+
+async def ResolveURL(uow: UnitOfWork, url: str):
+    """ResolveURL - Returns the URI of url from the routing table. URLs the
+    table does not know yet (e.g. made by another worker) are read from the
+    database and added to it.
+        uow: UnitOfWork
+        url: str
+
+        Usage:
+            uri = await ResolveURL(uow, url)
+    """
+    RefreshRouting()
+    uri = ROUTING.Get(url)
+    if uri is None:
+        await RerouteURLs(uow, [url])
+        uri = ROUTING.Get(url)
+    return uri
@@ -0,0 +1,157 @@
+"""onyx/blog/search.py
+
+Full-text search over blog posts & pages in the Onyx Salamander CMS.
+
+Searches use the blog_post_text & page_text full-text indexes created by
+the schema migrations, so a search never scans the graph.
+"""
+import re
+import html
+from typing import Optional, List
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from neo4j.exceptions import ClientError
+
+from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from auth.auth import GetCurrentActiveUserAllowGuest
+from models.user import User
+from models.blog_post import BlogPost
+from models.page import Page
+from models.search import SearchHit, SearchResults
+
+# Setup API Router
+router = APIRouter()
+
+ROUTE = {
+    "router": router,
+    "prefix": "/search",
+    "tags": ["Search"]
+}
+
+SEARCH_TYPES = ("post", "page")
+# Fields highlighted for each result type
+HIGHLIGHT_FIELDS = {
+    "post": ("Title", "Content"),
+    "page": ("Title", "Headline", "Intro", "Description"),
+}
+# Lucene operators & syntax that are not search terms
+_LUCENE_OPERATORS = {"AND", "OR", "NOT", "TO"}
+_TERM_PATTERN = re.compile(r"[\w*?]+")
+# Error the full-text procedures fail with on a query Lucene cannot parse
+_PROCEDURE_FAILED = "Neo.ClientError.Procedure.ProcedureCallFailed"
+
+
+def _IsParseError(error: ClientError):
+    """_IsParseError - Whether a search failed because Lucene could not
+    parse the query, rather than e.g. a missing index."""
+    return (error.code == _PROCEDURE_FAILED
+            and "ParseException" in (error.message or ""))
+
+
+def _TermPattern(query: str):
+    """_TermPattern - Returns a regex matching the words of a search query,
+    or None if it has no words. Wildcards match the rest of a word."""
+    terms = []
+    for term in _TERM_PATTERN.findall(query):
+        if term in _LUCENE_OPERATORS:
+            continue
+        term = re.escape(term.strip("*?")) + (r"\w*" if "*" in term else "")
+        if term:
+            terms.append(term)
+    if not terms:
+        return None
+    return re.compile(r"\b(?:" + "|".join(terms) + r")\b", re.IGNORECASE)
+
+
+def Highlight(text: Optional[str], pattern, length: int):
+    """Highlight - Returns the part of text around its first match of
+    pattern, HTML escaped with every match wrapped in <mark>, or None if
+    nothing matches.
+        text: str
+        pattern: re.Pattern - From _TermPattern
+        length: int - Roughly how many characters to return
+
+        Usage:
+            snippet = Highlight(post.Content, pattern, 160)
+    """
+    if not text or pattern is None:
+        return None
+    first = pattern.search(text)
+    if not first:
+        return None
+    start = max(first.start() - length // 4, 0)
+    end = min(start + length, len(text))
+    part = text[start:end]
+    marked = []
+    last = 0
+    for match in pattern.finditer(part):
+        marked.append(html.escape(part[last:match.start()]))
+        marked.append(f"<mark>{html.escape(match.group())}</mark>")
+        last = match.end()
+    marked.append(html.escape(part[last:]))
+    return (("..." if start else "") + "".join(marked)
+            + ("..." if end < len(text) else ""))
+
+
+@router.get("", response_model=SearchResults)
+async def search(q: str,
+                 types: Optional[List[str]] = Query(None),
+                 published: Optional[bool] = None,
+                 limit: int = 25,
+                 cursor: Optional[str] = None,
+                 user: User = Depends(GetCurrentActiveUserAllowGuest),
+                 uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """search - Returns the blog posts & pages matching a full-text query,
+    best matches first.
+
+    q: str - Lucene query, e.g. graph databases, "exact phrase" or data*
+    types: List[str] - post and/or page (default: both)
+    published: bool - Only published (true) or unpublished (false) results
+    limit: int - Page size
+    cursor: str - Cursor returned by a previous page
+
+    Guests only find published posts and pages that do not require a
+    login. Users also find their own posts, admins find everything.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Search query must not be empty.")
+    types = tuple(t for t in SEARCH_TYPES if t in (types or SEARCH_TYPES))
+    if not types:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"types must be {' and/or '.join(SEARCH_TYPES)}.")
+    parameters = {
+        "query": q,
+        "published": published,
+        "user": user.UUID if user else None,
+        "admin": bool(user and user.Admin),
+    }
+    try:
+        res, next_cursor, prev_cursor = await uow.Read(
+            ReadPage, queries.SearchQuery(types), parameters, cursor, limit)
+    except ClientError as e:
+        if not _IsParseError(e):
+            raise
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid search query.")
+
+    pattern = _TermPattern(q)
+    hits = []
+    for record in res:
+        hit = SearchHit(Type=record["type"], Score=record["score"])
+        node = record["node"]
+        if hit.Type == "post":
+            hit.BlogPost = BlogPost(**node)
+        else:
+            hit.Page = Page(**node)
+        for field in HIGHLIGHT_FIELDS[hit.Type]:
+            snippet = Highlight(node.get(field), pattern,
+                                settings.SEARCH_SNIPPET_LENGTH)
+            if snippet:
+                hit.Highlights[field] = snippet
+        hits.append(hit)
+    return SearchResults(Hits=hits, NextCursor=next_cursor,
+                         PrevCursor=prev_cursor)
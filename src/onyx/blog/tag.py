@@ -0,0 +1,142 @@
+"""onyx/blog/tag.py
+
+Tag & keyword facets of blog posts and pages for the Onyx Salamander CMS.
+
+The Tags & Keywords of posts and the Keywords of pages are also stored as
+(:Tag) nodes, which posts and pages are TAGGED to. Each tag counts the
+posts (all and published) and pages (all and public) that use it, and each
+user has a DRAFTS counter to the tags of their unpublished posts. The
+statements that write posts, pages & URLs keep the counters up to date, so
+a tag cloud or the size of a tag is read from a node instead of counting
+every post.
+"""
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from auth.auth import GetCurrentActiveUserAllowGuest
+from models.user import User
+from models.blog_post import BlogPost
+from models.page import Page
+from models.tag import Tag, Tags, TaggedBlogPosts, TaggedPages
+
+# Setup API Router
+router = APIRouter()
+
+ROUTE = {
+    "router": router,
+    "prefix": "/tag",
+    "tags": ["Tag"]
+}
+
+TAG_TYPES = ("post", "page")
+
+
+def NormalizeTag(name: str):
+    """NormalizeTag - Returns the name a tag is stored under, trimmed &
+    lower case like the Cypher that creates tags."""
+    return name.strip().lower()
+
+
+def _Counter(kind: str, user: Optional[User]):
+    """_Counter - Returns the Tag property counting the items of kind the
+    user may see. Only admins count every unpublished post, see _ReadTag
+    for the user's own. Guests only count public pages."""
+    if kind == "page":
+        return "PageCount" if user else "PublicPageCount"
+    return "PostCount" if user and user.Admin else "PublishedCount"
+
+
+async def _ReadTag(tx, name: str, counter: str,
+                   drafts_of: Optional[str] = None):
+    """_ReadTag - Returns a tag with the count in counter. drafts_of adds
+    the DRAFTS counter of that user, so the count matches the posts the
+    user is listed."""
+    cypher = queries.GET_TAG_WITH_DRAFTS if drafts_of else queries.GET_TAG
+    record = await (await tx.run(query=cypher,
+                                 parameters={"tag": name,
+                                             "user": drafts_of})).single()
+    if not record:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Tag: {name} not found."
+        )
+    count = (record["tag"].get(counter) or 0) + (record.get("drafts") or 0)
+    return Tag(Name=name, Count=count)
+
+
+@router.get("/list", response_model=Tags)
+async def list_tags(kind: str = "post",
+                    limit: int = 50,
+                    cursor: Optional[str] = None,
+                    user: User = Depends(GetCurrentActiveUserAllowGuest),
+                    uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """list_tags - Returns the tags of posts or pages with their counts,
+    most used first (a tag cloud).
+
+    kind: str - post (Tags & Keywords) or page (Keywords)
+    """
+    if kind not in TAG_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"kind must be one of {', '.join(TAG_TYPES)}."
+        )
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_TAGS[_Counter(kind, user)], {}, cursor, limit)
+    tags = [Tag(Name=each["name"], Count=each["count"]) for each in res]
+    return Tags(Tags=tags, NextCursor=next_cursor, PrevCursor=prev_cursor)
+
+
+@router.get("/{name}/posts", response_model=TaggedBlogPosts)
+async def list_tagged_blog_posts(name: str,
+                                 limit: int = 25,
+                                 order_by: Optional[str] = None,
+                                 cursor: Optional[str] = None,
+                                 user: User = Depends(GetCurrentActiveUserAllowGuest),
+                                 uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """list_tagged_blog_posts - Returns a page of the blog posts with a tag
+    or keyword, and how many there are."""
+    order_by = queries.ValidateSortKey(order_by or "CreatedDate")
+    name = NormalizeTag(name)
+    parameters = {
+        "tag": name,
+        "user": user.UUID if user else None,
+        "admin": bool(user and user.Admin),
+    }
+
+    drafts_of = user.UUID if user and not user.Admin else None
+
+    async def work(tx):
+        tag = await _ReadTag(tx, name, _Counter("post", user), drafts_of)
+        return (tag,) + await ReadPage(
+            tx, queries.LIST_TAGGED_BLOG_POSTS[order_by], parameters,
+            cursor, limit)
+
+    tag, res, next_cursor, prev_cursor = await uow.Read(work)
+    posts = [BlogPost(**each["post"]) for each in res]
+    return TaggedBlogPosts(Tag=tag, BlogPosts=posts,
+                           NextCursor=next_cursor, PrevCursor=prev_cursor)
+
+
+@router.get("/{name}/pages", response_model=TaggedPages)
+async def list_tagged_pages(name: str,
+                            limit: int = 25,
+                            cursor: Optional[str] = None,
+                            user: User = Depends(GetCurrentActiveUserAllowGuest),
+                            uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """list_tagged_pages - Returns a page of the pages with a keyword, and
+    how many there are."""
+    name = NormalizeTag(name)
+    parameters = {"tag": name, "user": user.UUID if user else None}
+
+    async def work(tx):
+        tag = await _ReadTag(tx, name, _Counter("page", user))
+        return (tag,) + await ReadPage(tx, queries.LIST_TAGGED_PAGES,
+                                       parameters, cursor, limit)
+
+    tag, res, next_cursor, prev_cursor = await uow.Read(work)
+    pages = [Page(**each["page"]) for each in res]
+    return TaggedPages(Tag=tag, Pages=pages,
+                       NextCursor=next_cursor, PrevCursor=prev_cursor)
@@ -6,16 +6,23 @@ import uuid
 from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
+from neo4j.exceptions import ConstraintError
 
 # Import utilities for database access & Page model
 from onyx import settings
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from onyx.db.stream import StreamRecords
+from onyx.blog.autocomplete import ReindexTitles
+from onyx.blog.routing import ROUTING, RerouteURLs, ResolveURL
 from auth.auth import GetCurrentActiveUser, GetCurrentActiveUserAllowGuest
 from models.base import Relationship
 from models.user import User
 from models.group import Group
 from models.file import File
 from models.comment import Comment
-from models.page import Page, URI
+from models.page import Page, URI, URIs
 
 # Setup API Router
 router = APIRouter()
@@ -26,31 +33,27 @@ ROUTE = {
         "tags":["URL"]
 } 
 
-def GetURL(url:str, contains:Optional[bool]=False):
+async def GetURL(tx, url:str, contains:Optional[bool]=False):
+    """GetURL - Reads a URL in tx. With contains the first URL containing
+    url is looked up in the routing table instead of scanning every URL
+    node."""
     if contains:
-        cypher_search = f"MATCH (url:URL) WHERE url.URL CONTAINS '{url}' RETURN url"
-    else:
-        cypher_search = f"MATCH (url:URL) WHERE url.URL = '{url}' RETURN url"
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher_search).data()
-        if result:
-            return URI(**result[0]['url'])
+        found = ROUTING.Find(url)
+        return found[0] if found else False
+    result = await (await tx.run(query=queries.GET_URL,
+                                 parameters={"url": url})).data()
+    if result:
+        return URI(**result[0]['url'])
     return False
 
-def _CreateURL(url: str,
+async def _CreateURL(tx,
+                    url: str,
                     user: User,
                     description: Optional[str] = None,
                     requireAuth: Optional[bool] = False,
                     requiresGroup: Optional[List[str]] = None,
                     linkedFile: Optional[File] = None,
                     ):
-    # Check that URL does not exist
-    if GetURL(url=url):
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Operation not permitted. URL `{url}` already exists.",
-            headers={"WWW-Authenticate":"Bearer"}
-        )
     attributes = {
         "URL":url,
         "Description":description,
@@ -60,30 +63,22 @@ def _CreateURL(url: str,
         "CreatedDate":str(datetime.now(settings.SERVER_TIMEZONE)),
         "ModifiedDate":str(datetime.now(settings.SERVER_TIMEZONE)),
     }
-    cypher = f"""MATCH (user:User) WHERE user.UUID="{user.UUID}"
-    CREATE (url:URL $params)
-    CREATE (user)-[relationship1:OWNS]->(url) 
-    """
-    if linkedFile:
-        cypher += f"""MATCH (file:File) WHERE file.UUID="{File.UUID}"
-        CREATE (url)-[relationship2:LINKS]->(file)
-        """
-    cypher += """RETURN url"""
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher, parameters={"params":attributes})
-        url_data = res.data()[0]["url"]
-    
-    if requiresGroup:
-        i=3
-        for group in requiresGroup:
-            cypher += f"""MATCH (group:Group) WHERE group.Name="{group}"
-            MATCH (url:URL) WHERE url.URL = "{url}"
-            CREATE (url)-[relationship{i}:REQUIRES]->(group)
-            RETURN url
-            """
-            i+=1
-            with settings.DB_DRIVER.session() as session:
-                url_data = res.data()[0]["url"]
+    parameters = {
+        "user":user.UUID,
+        "params":attributes,
+        "file":linkedFile.UUID if linkedFile else None,
+        "groups":requiresGroup or [],
+    }
+    # The unique URL.URL constraint rejects existing URLs
+    try:
+        res = await tx.run(query=queries.CREATE_URL, parameters=parameters)
+        url_data = (await res.data())[0]["url"]
+    except ConstraintError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted. URL `{url}` already exists.",
+            headers={"WWW-Authenticate":"Bearer"}
+        )
     return URI(**url_data)
 
 @router.post("/create", response_model=URI)
@@ -91,115 +86,133 @@ async def create_url(url: str,
                     description: Optional[str] = None,
                     requireAuth: Optional[bool] = False,
                     requireGroup: Optional[List[str]] = None,
-                    user: User = Depends(GetCurrentActiveUser)
+                    user: User = Depends(GetCurrentActiveUser),
+                    uow: UnitOfWork = Depends(GetUnitOfWork)
                     ):
     """CreateURL - Creates a new URL"""
-    return _CreateURL(url=url, description=description,
-                      requireAuth=requireAuth, requiresGroup=requireGroup,
-                      user=user)
+    rl = await uow.Write(_CreateURL, url=url, description=description,
+                         requireAuth=requireAuth, requiresGroup=requireGroup,
+                         user=user)
+    await ReindexTitles(uow, "url", [url])
+    await RerouteURLs(uow, [url])
+    return rl
 
 @router.post("/read/{url}", response_model=URI)
-async def read_url(url: str, user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    url = GetURL(url=url)
+async def read_url(url: str,
+                   user: User = Depends(GetCurrentActiveUserAllowGuest),
+                   uow: UnitOfWork = Depends(GetUnitOfWork)):
+    rl = await ResolveURL(uow, url)
+    if not rl:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"URL: {url} not found."
+        )
     # Check if requires access
-    if url.RequiresAuth:
+    if rl.RequiresAuth:
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail=f"URL: {url} requires login.",
                 headers={"WWW-Authenticate":"Bearer"}
             )
-    return url
-    
+    return rl
+
+async def _CheckURLAccess(tx, url: str, user: User):
+    """_CheckURLAccess - Raises unless the user owns or can modify the URL."""
+    if user.Admin:
+        return
+    relate = await (await tx.run(query=queries.GET_URL_PERMISSIONS,
+                                 parameters={"user":user.UUID,
+                                             "url":url})).data()
+    types = [each["type"] for each in relate]
+    if "OWNS" not in types and "CanModify" not in types:
+        raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail=f"You do not have write access to {url}.",
+                headers={"WWW-Authenticate":"Bearer"}
+            )
+
 @router.put("/update/{url}", response_model=URI)
 async def update_url(url: str,
                     attributes:dict,
                     description: Optional[str] = None,
                     requireAuth: Optional[bool] = None,
                     requireGroup: Optional[List[str]] = [],
-                    user: User = Depends(GetCurrentActiveUser)):
+                    user: User = Depends(GetCurrentActiveUser),
+                    uow: UnitOfWork = Depends(GetUnitOfWork)):
     time = str(datetime.now(settings.SERVER_TIMEZONE))
-    check_relationship = f"""MATCH (user:User)-[relationship]->(url:URL)
-    WHERE user.UUID = "{user.UUID}"
-    AND url.URL = "{url}"
-    RETURN ID(user), LABELS(user), relationship
-    """
-    cypher = f"""MATCH (url:URL)
-     WHERE url.URL = "{url}"
-     SET url += $attributes
-     SET url.Modifier = "{user.UUID}"
-     SET url.ModifiedDate = "{time}"
-    """
+    attributes = {key:value for key, value in attributes.items()
+                  if key not in settings.BASE_PROPERTIES}
     if description:
-        cypher += f"SET url.Description = '{description}'\n" 
-    if requireAuth:
-        cypher += f"SET url.RequireAuth = '{requireAuth}'\n" 
+        attributes["Description"] = description
+    if requireAuth is not None:
+        attributes["RequiresAuth"] = requireAuth
     if requireGroup:
-        cypher += f"SET url.RequireGroup = '{requireGroup}'\n"
-    cypher += "RETURN url"
+        attributes["RequireGroup"] = requireGroup
+    queries.ValidatePropertyKeys(attributes)
 
-    with settings.DB_DRIVER.session() as session:
+    async def work(tx):
         # Check if user owns the URL or can modify it
-        if not user.Admin:
-            relate = session.run(query=check_relationship).data()[0]
-            if relate:
-                if "OWNS" not in str(relate) and "CanModify" not in str(relate):
-                    raise HTTPException(
-                        status_code=status.HTTP_401_UNAUTHORIZED,
-                        detail=f"You do not have write access to {url}.",
-                        headers={"WWW-Authenticate":"Bearer"}
-                    )
-            else:
-                raise HTTPException(
-                        status_code=status.HTTP_401_UNAUTHORIZED,
-                        detail=f"You do not have write access to {url}.",
-                        headers={"WWW-Authenticate":"Bearer"}
-                    )
-    with settings.DB_DRIVER.session() as session:
-        update = session.run(query=cypher, parameters={"attributes":attributes})
-        url = update.data()[0]["url"]
-    return URI(**url)
-
-@router.get("/list")
+        await _CheckURLAccess(tx, url, user)
+        update = await tx.run(query=queries.UPDATE_URL,
+                              parameters={"url":url,
+                                          "attributes":attributes,
+                                          "user":user.UUID,
+                                          "date":time})
+        return URI(**(await update.data())[0]["url"])
+
+    rl = await uow.Write(work)
+    # RequiresAuth also decides who can see the page behind the URL
+    await ReindexTitles(uow, "url", [url])
+    await ReindexTitles(uow, "page", [url])
+    await RerouteURLs(uow, [url])
+    return rl
+
+@router.get("/list", response_model=URIs)
 async def list_url(limit:int=25,
-                  user: User = Depends(GetCurrentActiveUserAllowGuest)):
-    """ListURL returns a list of URLs
+                  cursor: Optional[str] = None,
+                  user: User = Depends(GetCurrentActiveUserAllowGuest),
+                  uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """ListURL returns a page of URLs
     """
-    if not user:
-        cypher = f"""MATCH (url:URL)
-        WHERE url.RequiresAuth = False
-        RETURN url LIMIT {limit}
-        """
-    else:
-        cypher = f"""MATCH (url:URL)
-        RETURN url LIMIT {limit}
-        """
-    with settings.DB_DRIVER.session() as session:
-        res = session.run(query=cypher).data()
+    res, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_URLS,
+        {"user":user.UUID if user else None}, cursor, limit)
     urls = []
     for each in res:
-        print(each)
         urls.append(URI(**each["url"]))
     
-    return urls
+    return URIs(URLs=urls, NextCursor=next_cursor, PrevCursor=prev_cursor)
 
-@router.post("/delete/{url}")
-async def delete_url(url:str, user:User = Depends(GetCurrentActiveUser)):
-    rl = GetURL(url=url)
-    if rl and not rl.Creator == user.UUID:
-        raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail=f"You do not have write access to {url}.",
-                headers={"WWW-Authenticate":"Bearer"}
-            )
-    
-    cypher = f"""MATCH (url:URL) WHERE url.URL = "{url}"
-    DETACH DELETE url
+@router.get("/export")
+async def export_url(user: User = Depends(GetCurrentActiveUserAllowGuest)):
+    """ExportURL streams every URL as newline delimited JSON
     """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
+    return StreamRecords(queries.EXPORT_URLS,
+                         {"user":user.UUID if user else None},
+                         lambda record: URI(**record["url"]).json())
+
+@router.post("/delete/{url}")
+async def delete_url(url:str,
+                     user:User = Depends(GetCurrentActiveUser),
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    async def work(tx):
+        rl = await GetURL(tx, url=url)
+        if rl and not rl.Creator == user.UUID:
+            raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail=f"You do not have write access to {url}.",
+                    headers={"WWW-Authenticate":"Bearer"}
+                )
+        result = await tx.run(query=queries.DELETE_URL,
+                              parameters={"url":url})
+        return await result.data()
+
+    rel = await uow.Write(work)
+    await ReindexTitles(uow, "url", [url])
+    await ReindexTitles(uow, "page", [url])
+    await RerouteURLs(uow, [url])
     # rel should be empty, if not this _should_ return an error message
     return rel or {
         "response":f"URL {url} was successfully deleted."
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,142 @@
+"""onyx/cache.py
+
+In-process caches & request coalescing for the Onyx Salamander CMS.
+
+The API runs on a single event loop per worker and the cache methods never
+await, so no locking is needed. Each worker keeps its own cache.
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from fastapi import HTTPException, status
+
+
+class TTLCache:
+    """TTLCache is a size bounded least recently used cache whose entries
+    expire ttl seconds after they were stored.
+
+    By default maxsize counts entries. Pass weigh to bound the cache by
+    something else, e.g. weigh=len bounds a cache of bytes by total length.
+    A maxsize or ttl of 0 disables the cache. evict(key, value) is called
+    for every entry pushed out to make room, e.g. to delete a cached file.
+
+        Usage:
+            cache = TTLCache(maxsize=1024, ttl=60)
+            found, value = cache.Get(key)
+            if not found:
+                cache.Set(key, value)
+    """
+
+    def __init__(self, maxsize: int, ttl: float, weigh=None, evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh or (lambda value: 1)
+        self.evict = evict
+        self.size = 0  # Total weight of the cached entries
+        self._entries = OrderedDict()  # key -> (expires, weight, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, key):
+        """Get - Returns (found, value), found is False on a miss."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            self.Pop(key)
+        self.misses += 1
+        return False, None
+
+    def Set(self, key, value, ttl: float = None):
+        """Set - Stores value, evicting the least recently used entries if
+        the cache is full. ttl overrides the cache's ttl for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        weight = self.weigh(value)
+        self.Pop(key)
+        # Entries that could never fit are not cached at all
+        if ttl <= 0 or weight > self.maxsize:
+            return
+        self._entries[key] = (time.monotonic() + ttl, weight, value)
+        self.size += weight
+        while self.size > self.maxsize:
+            key, (_, evicted, value) = self._entries.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+            if self.evict is not None:
+                self.evict(key, value)
+
+    def Pop(self, key):
+        """Pop - Removes key from the cache if it is there."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def Clear(self):
+        """Clear - Removes every entry from the cache."""
+        self._entries.clear()
+        self.size = 0
+
+    def Stats(self):
+        """Stats - Returns the size & hit/miss counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "Entries": len(self._entries),
+            "Size": self.size,
+            "MaxSize": self.maxsize,
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Evictions": self.evictions,
+            "HitRate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """SingleFlight coalesces concurrent calls for the same key, the first
+    caller starts the work and everyone who asks for the key while it is
+    running awaits the same result (or exception) instead of repeating it.
+
+    The work runs as its own task, so a caller that gives up or is
+    cancelled does not cancel it for the others. Callers that wait longer
+    than timeout seconds get a 504.
+
+        Usage:
+            flight = SingleFlight(timeout=10)
+            page = await flight.Do(("page", url), ReadPage, url)
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        self._calls = {}  # key -> running task
+        self.started = 0  # Calls that ran the work
+        self.joined = 0  # Calls that shared a running call
+
+    async def Do(self, key, func, *args, **kwargs):
+        """Do - Returns the result of await func(*args, **kwargs), sharing
+        it with every concurrent call for key."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._Forget(key, done))
+            self.started += 1
+        else:
+            self.joined += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Timed out waiting for the database."
+            )
+
+    def _Forget(self, key, task):
+        """_Forget - Removes a finished task so the next call runs again."""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case every waiter gave up
+        if not task.cancelled():
+            task.exception()
@@ -3,14 +3,23 @@
 This file handles CRUD functionality for the Neo4j database
 """
 import uuid
-from typing import Optional
+from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
+from neo4j.exceptions import Neo4jError
 
 # Import utilities for database access, auth, & "schemas"
 from onyx import settings
-from auth.auth import GetCurrentActiveUser
-from models.base import Node, Nodes, Relationship
+from onyx.db import queries
+from onyx.db.session import UnitOfWork, GetUnitOfWork
+from onyx.db.pagination import ReadPage
+from onyx.db.stream import StreamRecords
+from auth.auth import GetCurrentActiveUser, InvalidateUser
+from onyx.blog.page import InvalidatePage
+from onyx.blog.autocomplete import RefreshAutocomplete
+from onyx.blog.routing import RefreshRouting
+from models.base import (Node, Nodes, Relationship, BatchNode,
+                         BatchRelationship, BatchResult, BatchResults)
 from models.user import User
 
 # Set API Router
@@ -22,11 +31,34 @@ ROUTE = {
     "tags": ["CRUD"]
 }
 
+# Labels of the nodes with titles in the autocomplete index
+TITLED_LABELS = {"BlogPost", "Page", "URL"}
+
+
+def _RefreshTitles(labels):
+    """_RefreshTitles - Reloads the autocomplete index after a change to
+    nodes with titles."""
+    if TITLED_LABELS.intersection(labels):
+        RefreshAutocomplete(force=True)
+
+
+def _RefreshRoutes(labels, types=()):
+    """_RefreshRoutes - Reloads the routing table after a change that
+    touched URL nodes or the LINKS between URLs & pages."""
+    if "URL" in labels or "LINKS" in types:
+        RefreshRouting(force=True)
+
+
+async def _RunQuery(tx, query: str, parameters: Optional[dict] = None):
+    """_RunQuery - Runs a single query in tx and returns its records."""
+    return await (await tx.run(query=query, parameters=parameters)).data()
+
 
 @router.post("/create/node", response_model=Node)
 async def create_node(label: str,
                       node_attributes: dict,
-                      current_user: User = Depends(GetCurrentActiveUser)):
+                      current_user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
     """create_node - Creates a node with label and attributes
         label: str
         node_attributes: dict
@@ -35,79 +67,61 @@ async def create_node(label: str,
         Usage:
             Accessed by route /create/node
     """
-    # Check that node is not a restricted Node
-    if label in settings.RESTRICTED_NODES:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Operation not permitted, cannot create {label} with this method.",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    # Check if we are restricting the types of nodes we can create
-    if settings.RESTRICT_DB:
-        if label not in settings.NODE_LABELS:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Operation not permitted, cannot create {label} with this method.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
+    # Check that node is not a restricted Node & is an allowed label
+    label = queries.ValidateLabel(label, create=True)
     # Check that attributes dictionary does not modify base fields
-    unpacked = ""
-    for key, value in node_attributes.items():
-        if key in settings.BASE_PROPERTIES:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Operation not permitted. You cannot modify those fields with this method.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
-        if len(unpacked) > 0:
-            unpacked += "\n"
-        unpacked += f"SET new_node.{key}='{value}'"
+    queries.ValidatePropertyKeys(node_attributes)
     uid = str(uuid.uuid4())
 
-    cypher = f"""
-            CREATE (new_node:{label})
-            SET new_node.created_by = $created_by
-            SET new_node.created_time = $created_time
-            SET new_node.UUID = "{uid}"
-            {unpacked}
-            RETURN new_node, LABELS(new_node) as labels, ID(new_node) as id
-            """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(
-            query=cypher,
-            parameters={
-                "created_by": current_user.Email,
-                "created_time": str(datetime.now(settings.SERVER_TIMEZONE)),
-                "attributes": node_attributes
-            },
-        )
-        node_data = result.data()[0]
+    result = await uow.Write(_RunQuery, queries.CreateNodeQuery(label), {
+        "created_by": current_user.Email,
+        "created_time": str(datetime.now(settings.SERVER_TIMEZONE)),
+        "uid": uid,
+        "attributes": node_attributes
+    })
+    node_data = result[0]
+    _RefreshTitles(node_data["labels"])
+    _RefreshRoutes(node_data["labels"])
     return Node(NODE_ID=node_data["id"],
                 UUID=uid,
                 LABELS=node_data["labels"],
-                Properties=node_data["new_node"])
+                Properties=node_data["node"])
 # List Nodes
 
 
 @router.get("/list/nodes", response_model=Nodes)
 async def list_nodes(limit: int = 25,
-                     current_user: User = Depends(GetCurrentActiveUser)):
-    """list_nodes, lists as many nodes as requested"""
-    cypher = f"""MATCH (node)
-    RETURN ID(node) as id, LABELS(node) as labels, node
-    LIMIT {limit}"""
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        data = result.data()
+                     cursor: Optional[str] = None,
+                     current_user: User = Depends(GetCurrentActiveUser),
+                     uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """list_nodes, lists a page of nodes, pass NextCursor/PrevCursor back as
+    cursor to read the next/previous page"""
+    data, next_cursor, prev_cursor = await uow.Read(
+        ReadPage, queries.LIST_NODES, {}, cursor, limit)
     node_list = []
     for node in data:
-        print(node)
-        print(node["node"])
         node = Node(NODE_ID=node["id"],
+                    UUID=node["node"].get("UUID"),
                     LABELS=node["labels"],
-                    **node["node"])
+                    Properties=node["node"])
         node_list.append(node)
-    return Nodes(Nodes=node_list)
+    return Nodes(Nodes=node_list,
+                 NextCursor=next_cursor,
+                 PrevCursor=prev_cursor)
+
+# Export Nodes
+
+
+@router.get("/export/nodes")
+async def export_nodes(current_user: User = Depends(GetCurrentActiveUser)):
+    """export_nodes - Streams every node as newline delimited JSON"""
+    def render(record):
+        return Node(NODE_ID=record["id"],
+                    UUID=record["node"].get("UUID"),
+                    LABELS=record["labels"],
+                    Properties=record["node"]).json()
+
+    return StreamRecords(queries.EXPORT_NODES, {}, render)
 
 # Search Nodes
 
@@ -115,23 +129,21 @@ async def list_nodes(limit: int = 25,
 @router.get("/search/nodes", response_model=Nodes)
 async def search_nodes(node_property: str,
                        property_value: str,
-                       current_user: User = Depends(GetCurrentActiveUser)):
+                       current_user: User = Depends(GetCurrentActiveUser),
+                       uow: UnitOfWork = Depends(GetUnitOfWork)):
     """SearchNodes
     Retrieves data about a collection of nodes in the graph based on node properties
     """
-    cypher = f"""
-        MATCH (node)
-        WHERE node.{node_property} = "{property_value}"
-        RETURN ID(node) as id, LABELS(node) as labels, node
-        """
-    print("CYPHER:", cypher)
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        data = result.data()
+    queries.ValidatePropertyKeys({node_property: None}, allow_base=True)
+    data = await uow.Read(_RunQuery, queries.SEARCH_NODES,
+                         {"property": node_property,
+                          "value": property_value})
 
     node_list = []
     for node in data:
-        node = Node(**node)
+        node = Node(NODE_ID=node["id"],
+                    LABELS=node["labels"],
+                    Properties=node["node"])
         node_list.append(node)
     return Nodes(Nodes=node_list)
 
@@ -141,16 +153,22 @@ async def search_nodes(node_property: str,
 @router.put("/update/node/{node_id}")
 async def update_node(node_id: int,
                       attributes: dict,
-                      current_user: User = Depends(GetCurrentActiveUser)):
-    cypher = """MATCH (node) WHERE ID(node) = $id
-    SET node += $attributes
-    RETURN node, ID(node) as id, LABELS(node) as labels
-    """
-
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher,
-                             parameters={"id": node_id, "attributes": attributes})
-        node_data = result.data()[0]
+                      current_user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    queries.ValidatePropertyKeys(attributes)
+    result = await uow.Write(_RunQuery, queries.UPDATE_NODE,
+                           {"id": node_id, "attributes": attributes})
+    node_data = result[0]
+    if "User" in node_data["labels"]:
+        # The email may have changed too, so drop every cached user
+        InvalidateUser()
+    if "Page" in node_data["labels"]:
+        # Likewise the page URL
+        InvalidatePage()
+    if TITLED_LABELS.intersection(node_data["labels"]):
+        RefreshAutocomplete(force=True)
+    if "URL" in node_data["labels"]:
+        RefreshRouting(force=True)
     return Node(NODE_ID=node_data["id"],
                 LABELS=node_data["labels"],
                 **node_data["node"])
@@ -160,16 +178,18 @@ async def update_node(node_id: int,
 
 @router.post("/delete/node/{node_id}")
 async def delete_node(node_id: int,
-                      current_user: User = Depends(GetCurrentActiveUser)):
-    cypher = f"""
-    MATCH (node)
-    WHERE ID(node) = "{node_id}"
-    DETACH DELETE node
-    """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        data = result.data()
-    return data or {
+                      current_user: User = Depends(GetCurrentActiveUser),
+                      uow: UnitOfWork = Depends(GetUnitOfWork)):
+    data = await uow.Write(_RunQuery, queries.DELETE_NODE, {"id": node_id})
+    if data and "User" in data[0]["labels"]:
+        InvalidateUser()
+    if data and "Page" in data[0]["labels"]:
+        InvalidatePage()
+    if data and TITLED_LABELS.intersection(data[0]["labels"]):
+        RefreshAutocomplete(force=True)
+    if data and "URL" in data[0]["labels"]:
+        RefreshRouting(force=True)
+    return {
         "response": f"Node with ID: {node_id} was successfully deleted from the graph."
     }
 
@@ -185,47 +205,29 @@ async def create_relationship(source_label: str,
                               target_value: str,
                               relationship_type: str,
                               relationship_attributes: Optional[dict] = None,
-                              current_user=Depends(GetCurrentActiveUser)):
+                              current_user=Depends(GetCurrentActiveUser),
+                              uow: UnitOfWork = Depends(GetUnitOfWork)):
     """CreateRelationship - Creates a relationship between two nodes"""
-    # Check that node is not a restricted Node
-    if settings.RESTRICT_DB:
-        if relationship_type not in settings.RELATIONSHIP_TYPES:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="Operation not permitted, relationship type not allowed.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
-    unpacked = ""
-    for key, value in relationship_attributes.items():
-        if key in settings.BASE_PROPERTIES:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=f"Operation not permitted. You cannot modify those fields with this method.",
-                headers={"WWW-Authenticate": "Bearer"}
-            )
-        if len(unpacked) > 0:
-            unpacked += "\n"
-        unpacked += f"SET relationship.{key}='{value}'"
-    cypher = f"""
-    MATCH (nodeA:{source_label}) WHERE nodeA.{source_property} = '{source_value}'
-    MATCH (nodeB:{target_label}) WHERE nodeB.{target_property} = '{target_value}'
-    CREATE (nodeA)-[relationship:{relationship_type}]->(nodeB)
-    SET relationship.created_by = '{current_user.Email}'
-    SET relationship.created_time = $created_time
-    {unpacked}
-    RETURN nodeA, nodeB, LABELS(nodeA), LABELS(nodeB), ID(nodeA),
-    ID(nodeB), ID(relationship), TYPE(relationship), PROPERTIES(relationship)
-    """
-
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher,
-                             parameters={
-                                 "created_time": str(datetime.now(settings.SERVER_TIMEZONE))
-                             }
-                             )
-        rel_data = result.data()
-        print(rel_data)
-        rel_data = rel_data[0]
+    # Check that labels, relationship type & property keys are allowed
+    cypher = queries.CreateRelationshipQuery(
+        queries.ValidateLabel(source_label),
+        queries.ValidateLabel(target_label),
+        queries.ValidateRelationshipType(relationship_type))
+    queries.ValidatePropertyKeys({source_property: None,
+                                  target_property: None}, allow_base=True)
+    queries.ValidatePropertyKeys(relationship_attributes)
+
+    result = await uow.Write(_RunQuery, cypher, {
+        "source_property": source_property,
+        "source_value": source_value,
+        "target_property": target_property,
+        "target_value": target_value,
+        "attributes": relationship_attributes or {},
+        "created_by": current_user.Email,
+        "created_time": str(datetime.now(settings.SERVER_TIMEZONE))
+    })
+    rel_data = result[0]
+    _RefreshRoutes({source_label, target_label}, {relationship_type})
     # Convert data to nodes
     source = Node(NODE_ID=rel_data["ID(nodeA)"],
                   LABELS=rel_data["LABELS(nodeA)"],
@@ -245,16 +247,11 @@ async def create_relationship(source_label: str,
 
 @router.get("/read/relationship/{relationship_id}", response_model=Relationship)
 async def read_relationship(relationship_id: int,
-                            user: User = Depends(GetCurrentActiveUser)):
-    cypher = f"""
-    MATCH (nodeA)-[relationship]->(nodeB)
-    WHERE ID(relationship) = {relationship_id}
-    RETURN nodeA, ID(nodeA), LABELS(nodeA), relationship, ID(relationship),
-    TYPE(relationship), nodeB, ID(nodeB), LABELS(nodeB), PROPERTIES(relationship)
-    """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel_data = result.data()[0]
+                            user: User = Depends(GetCurrentActiveUser),
+                            uow: UnitOfWork = Depends(GetUnitOfWork)):
+    result = await uow.Read(_RunQuery, queries.READ_RELATIONSHIP,
+                           {"rel_id": relationship_id})
+    rel_data = result[0]
     # Convert data to nodes
     source = Node(NODE_ID=rel_data["ID(nodeA)"],
                   LABELS=rel_data["LABELS(nodeA)"],
@@ -275,21 +272,14 @@ async def read_relationship(relationship_id: int,
 @router.put("/update/relationship/{relationship_id}", response_model=Relationship)
 async def update_relationship(relationship_id: int,
                               attributes: dict,
-                              user: User = Depends(GetCurrentActiveUser)):
-    cypher = """
-    MATCH (nodeA)-[relationship]->(nodeB)
-    WHERE ID(relationship) = $rel_id
-    SET relationship += $attributes
-    RETURN nodeA, ID(nodeA), LABELS(nodeA), relationship, ID(relationship),
-    TYPE(relationship), nodeB, ID(nodeB), LABELS(nodeB), PROPERTIES(relationship)
-    """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher,
-                             parameters={
-                                 "rel_id": relationship_id,
-                                 "attributes": attributes
-                             })
-        rel_data = result.data()[0]
+                              user: User = Depends(GetCurrentActiveUser),
+                              uow: UnitOfWork = Depends(GetUnitOfWork)):
+    queries.ValidatePropertyKeys(attributes)
+    result = await uow.Write(_RunQuery, queries.UPDATE_RELATIONSHIP, {
+        "rel_id": relationship_id,
+        "attributes": attributes
+    })
+    rel_data = result[0]
 
     # Convert data to nodes
     source = Node(NODE_ID=rel_data["ID(nodeA)"],
@@ -310,16 +300,164 @@ async def update_relationship(relationship_id: int,
 
 @router.post("/delete/relationship/{relationship_id}")
 async def delete_relationship(relationship_id: int,
-                              user: User = Depends(GetCurrentActiveUser)):
-    cypher = f"""
-    MATCH (nodeA)-[relationship]->(nodeB)
-    WHERE ID(relationship) = {relationship_id}
-    DELETE relationship
-    """
-    with settings.DB_DRIVER.session() as session:
-        result = session.run(query=cypher)
-        rel = result.data()
+                              user: User = Depends(GetCurrentActiveUser),
+                              uow: UnitOfWork = Depends(GetUnitOfWork)):
+    rel = await uow.Write(_RunQuery, queries.DELETE_RELATIONSHIP,
+                        {"rel_id": relationship_id})
     # rel should be empty, if not this _should_ return an error message
     return rel or {
         "response": f"Relationship with ID: {relationship_id} was successfully deleted."
     }
+
+# Batch Operations
+
+
+def _CheckBatchSize(items: list):
+    """_CheckBatchSize - Rejects batches larger than BATCH_MAX_ITEMS."""
+    if len(items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A batch can contain at most {settings.BATCH_MAX_ITEMS} items.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+async def _WriteBatch(uow: UnitOfWork, cypher: str, rows: list,
+                      parameters: dict):
+    """_WriteBatch - Writes rows with an UNWIND query, BATCH_CHUNK_SIZE rows
+    per transaction, so one bad chunk does not roll back the whole batch.
+
+    Returns ({index: record}, {index: error}) for the rows.
+    """
+    written = {}
+    failed = {}
+    size = max(settings.BATCH_CHUNK_SIZE, 1)
+    for i in range(0, len(rows), size):
+        chunk = rows[i:i + size]
+        try:
+            records = await uow.Write(_RunQuery, cypher,
+                                      {**parameters, "rows": chunk})
+        except Neo4jError as e:
+            for row in chunk:
+                failed[row["index"]] = e.message
+            continue
+        for record in records:
+            written[record["index"]] = record
+    return written, failed
+
+
+@router.post("/batch/nodes", response_model=BatchResults)
+async def create_nodes(nodes: List[BatchNode],
+                       current_user: User = Depends(GetCurrentActiveUser),
+                       uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """create_nodes - Creates many nodes in as few queries as possible
+        nodes: List[BatchNode]
+        current_user: User
+
+    Nodes are grouped by label and written with UNWIND. The result for each
+    node is returned at the same index as the request.
+
+        Usage:
+            Accessed by route /batch/nodes
+    """
+    _CheckBatchSize(nodes)
+    results = {}
+    groups = {}
+    for i, node in enumerate(nodes):
+        try:
+            label = queries.ValidateLabel(node.Label, create=True)
+            queries.ValidatePropertyKeys(node.Properties)
+        except HTTPException as e:
+            results[i] = BatchResult(Index=i, Success=False, Error=e.detail)
+            continue
+        groups.setdefault(label, []).append({
+            "index": i,
+            "uid": str(uuid.uuid4()),
+            "attributes": node.Properties or {}
+        })
+
+    parameters = {
+        "created_by": current_user.Email,
+        "created_time": str(datetime.now(settings.SERVER_TIMEZONE))
+    }
+    for label, rows in groups.items():
+        written, failed = await _WriteBatch(uow,
+                                            queries.CreateNodesQuery(label),
+                                            rows, parameters)
+        if written:
+            _RefreshTitles({label})
+            _RefreshRoutes({label})
+        for row in rows:
+            i = row["index"]
+            if i in written:
+                results[i] = BatchResult(Index=i, Success=True,
+                                         NODE_ID=written[i]["id"],
+                                         UUID=row["uid"])
+            else:
+                results[i] = BatchResult(Index=i, Success=False,
+                                         Error=failed.get(i))
+    return BatchResults(Results=[results[i] for i in range(len(nodes))])
+
+
+@router.post("/batch/relationships", response_model=BatchResults)
+async def create_relationships(relationships: List[BatchRelationship],
+                               current_user: User = Depends(GetCurrentActiveUser),
+                               uow: UnitOfWork = Depends(GetUnitOfWork)):
+    """create_relationships - Creates many relationships in as few queries
+    as possible
+        relationships: List[BatchRelationship]
+        current_user: User
+
+    Relationships are grouped by source label, target label & type and
+    written with UNWIND. The result for each relationship is returned at
+    the same index as the request.
+
+        Usage:
+            Accessed by route /batch/relationships
+    """
+    _CheckBatchSize(relationships)
+    results = {}
+    groups = {}
+    for i, rel in enumerate(relationships):
+        try:
+            key = (queries.ValidateLabel(rel.SourceLabel),
+                   queries.ValidateLabel(rel.TargetLabel),
+                   queries.ValidateRelationshipType(rel.RelationshipType))
+            queries.ValidatePropertyKeys({rel.SourceProperty: None,
+                                          rel.TargetProperty: None},
+                                         allow_base=True)
+            queries.ValidatePropertyKeys(rel.Properties)
+        except HTTPException as e:
+            results[i] = BatchResult(Index=i, Success=False, Error=e.detail)
+            continue
+        groups.setdefault(key, []).append({
+            "index": i,
+            "source_property": rel.SourceProperty,
+            "source_value": rel.SourceValue,
+            "target_property": rel.TargetProperty,
+            "target_value": rel.TargetValue,
+            "attributes": rel.Properties or {}
+        })
+
+    parameters = {
+        "created_by": current_user.Email,
+        "created_time": str(datetime.now(settings.SERVER_TIMEZONE))
+    }
+    for key, rows in groups.items():
+        written, failed = await _WriteBatch(uow,
+                                            queries.CreateRelationshipsQuery(*key),
+                                            rows, parameters)
+        if written:
+            _RefreshRoutes(key[:2], key[2:])
+        for row in rows:
+            i = row["index"]
+            if i in written:
+                results[i] = BatchResult(Index=i, Success=True,
+                                         RelationshipIDs=written[i]["ids"])
+            else:
+                # Rows without a matching source/target node return nothing
+                results[i] = BatchResult(
+                    Index=i, Success=False,
+                    Error=failed.get(i, "Source or target node not found."))
+    return BatchResults(Results=[results[i]
+                                 for i in range(len(relationships))])
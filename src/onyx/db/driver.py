@@ -0,0 +1,43 @@
+"""onyx/db/driver.py
+
+Manages the lifetime of the Neo4j database driver for the Onyx Salamander CMS.
+"""
+from neo4j import AsyncGraphDatabase
+from onyx import settings
+
+
+async def OpenDriver():
+    """OpenDriver - Creates the async Neo4j driver and stores it in
+    settings.DB_DRIVER.
+
+    Must be awaited from inside the event loop that will use the driver.
+
+        Usage:
+            await OpenDriver()
+    """
+    if settings.DB_DRIVER is None:
+        config = {
+            "max_transaction_retry_time": settings.DB_RETRY_TIME,
+            "initial_retry_delay": settings.DB_RETRY_DELAY,
+            "retry_delay_multiplier": settings.DB_RETRY_MULTIPLIER,
+            "retry_delay_jitter_factor": settings.DB_RETRY_JITTER,
+        }
+        # DB_DRIVER_CONFIG takes precedence over the DB_RETRY_* settings
+        config.update(settings.DB_DRIVER_CONFIG)
+        settings.DB_DRIVER = AsyncGraphDatabase.driver(
+            settings.DATABASE_URL,
+            auth=(settings.DATABASE_USER, settings.DATABASE_PASS),
+            **config
+        )
+    return settings.DB_DRIVER
+
+
+async def CloseDriver():
+    """CloseDriver - Closes the driver and releases its connection pool.
+
+        Usage:
+            await CloseDriver()
+    """
+    if settings.DB_DRIVER is not None:
+        await settings.DB_DRIVER.close()
+        settings.DB_DRIVER = None
@@ -0,0 +1,174 @@
+"""onyx/db/migrations.py
+
+Versioned schema migrations for the Onyx Salamander CMS database.
+
+Each migration is a version number, a description and a list of Cypher
+statements. Applied versions are recorded in (:SchemaMigration) nodes so
+only newer migrations run on the next startup. Schema statements use
+IF NOT EXISTS and data statements only write what is missing, so a
+migration that was interrupted can safely run again.
+"""
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from onyx import settings
+from onyx.db import queries
+
+log = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    (1, "Unique constraints & indexes for lookup keys", [
+        "CREATE CONSTRAINT schema_migration_version IF NOT EXISTS "
+        "FOR (m:SchemaMigration) REQUIRE m.Version IS UNIQUE",
+        "CREATE CONSTRAINT user_email IF NOT EXISTS "
+        "FOR (user:User) REQUIRE user.Email IS UNIQUE",
+        "CREATE CONSTRAINT user_uuid IF NOT EXISTS "
+        "FOR (user:User) REQUIRE user.UUID IS UNIQUE",
+        "CREATE CONSTRAINT blog_post_uuid IF NOT EXISTS "
+        "FOR (post:BlogPost) REQUIRE post.UUID IS UNIQUE",
+        "CREATE CONSTRAINT page_url IF NOT EXISTS "
+        "FOR (page:Page) REQUIRE page.URL IS UNIQUE",
+        "CREATE CONSTRAINT url_url IF NOT EXISTS "
+        "FOR (url:URL) REQUIRE url.URL IS UNIQUE",
+        "CREATE CONSTRAINT file_uuid IF NOT EXISTS "
+        "FOR (file:File) REQUIRE file.UUID IS UNIQUE",
+        "CREATE CONSTRAINT comment_uuid IF NOT EXISTS "
+        "FOR (comment:Comment) REQUIRE comment.UUID IS UNIQUE",
+        "CREATE INDEX page_title IF NOT EXISTS "
+        "FOR (page:Page) ON (page.Title)",
+        "CREATE INDEX blog_post_title IF NOT EXISTS "
+        "FOR (post:BlogPost) ON (post.Title)",
+        "CREATE INDEX file_filename IF NOT EXISTS "
+        "FOR (file:File) ON (file.Filename)",
+    ]),
+    (2, "Indexes for keyset pagination of list endpoints", [
+        "CREATE INDEX blog_post_created IF NOT EXISTS "
+        "FOR (post:BlogPost) ON (post.CreatedDate)",
+        "CREATE INDEX page_created IF NOT EXISTS "
+        "FOR (page:Page) ON (page.CreatedDate)",
+        "CREATE INDEX url_created IF NOT EXISTS "
+        "FOR (url:URL) ON (url.CreatedDate)",
+        "CREATE INDEX file_created IF NOT EXISTS "
+        "FOR (file:File) ON (file.CreatedDate)",
+        "CREATE INDEX comment_created IF NOT EXISTS "
+        "FOR (comment:Comment) ON (comment.CreatedDate)",
+    ]),
+    (3, "Unique content hash for deduplicated file blobs", [
+        "CREATE CONSTRAINT blob_hash IF NOT EXISTS "
+        "FOR (blob:Blob) REQUIRE blob.Hash IS UNIQUE",
+    ]),
+    (4, "Full-text indexes for searching blog posts & pages", [
+        "CREATE FULLTEXT INDEX blog_post_text IF NOT EXISTS "
+        "FOR (post:BlogPost) "
+        "ON EACH [post.Title, post.Content, post.Keywords, post.Tags]",
+        "CREATE FULLTEXT INDEX page_text IF NOT EXISTS "
+        "FOR (page:Page) ON EACH [page.Title, page.Headline, page.Intro, "
+        "page.Description, page.Keywords]",
+    ]),
+    (5, "Tag nodes & counters for the tags & keywords of posts & pages", [
+        "CREATE CONSTRAINT tag_name IF NOT EXISTS "
+        "FOR (tag:Tag) REQUIRE tag.Name IS UNIQUE",
+        queries.TAG_BLOG_POSTS,
+        queries.TAG_PAGES,
+    ]),
+    (6, "Indexes for the other sort keys of blog post lists", [
+        "CREATE INDEX blog_post_modified IF NOT EXISTS "
+        "FOR (post:BlogPost) ON (post.ModifiedDate)",
+        "CREATE INDEX blog_post_published IF NOT EXISTS "
+        "FOR (post:BlogPost) ON (post.PublishedDate)",
+    ]),
+    (7, "Index for the UUID of pages, which comments can be on", [
+        "CREATE INDEX page_uuid IF NOT EXISTS "
+        "FOR (page:Page) ON (page.UUID)",
+    ]),
+    (8, "Tag counter indexes, public page & per-user draft counters", [
+        *(f"CREATE INDEX tag_{counter.lower()} IF NOT EXISTS "
+          f"FOR (tag:Tag) ON (tag.{counter})"
+          for counter in queries.TAG_COUNTERS),
+        queries.COUNT_PUBLIC_PAGES,
+        queries.TAG_BLOG_POSTS,
+        queries.TAG_PAGES,
+    ]),
+]
+
+
+async def GetSchemaVersion(session):
+    """GetSchemaVersion - Returns the newest applied migration version.
+        session: AsyncSession
+
+        Usage:
+            version = await GetSchemaVersion(session)
+    """
+    result = await session.run(query=queries.GET_SCHEMA_VERSION)
+    record = await result.single()
+    return (record and record["version"]) or 0
+
+
+async def _AcquireLock(session, owner: str):
+    """_AcquireLock - Takes (or renews) the migration lock, waiting while
+    another worker holds it."""
+    lease = int(settings.MIGRATION_LOCK_LEASE * 1000)
+    waiting = False
+    while True:
+        record = await (await session.run(
+            query=queries.ACQUIRE_MIGRATION_LOCK,
+            parameters={"owner": owner, "lease": lease})).single()
+        if record:
+            return
+        if not waiting:
+            log.info("Waiting for another worker to apply schema migrations")
+            waiting = True
+        await asyncio.sleep(1)
+
+
+async def RunMigrations(dry_run: bool = False, target: int = None):
+    """RunMigrations - Applies every migration newer than the database.
+        dry_run: bool - Only report what would be applied
+        target: int - Stop at this version (default: latest)
+
+    Every worker runs this on startup, so migrations are applied under a
+    lock: the first worker applies them, the others wait and then find the
+    database up to date.
+
+        Usage:
+            applied = await RunMigrations()
+    """
+    applied = []
+    owner = uuid.uuid4().hex
+    async with settings.DB_DRIVER.session() as session:
+        if not dry_run:
+            await (await session.run(
+                query=queries.MIGRATION_LOCK_CONSTRAINT)).consume()
+            await _AcquireLock(session, owner)
+        try:
+            # Read after taking the lock, another worker may have migrated
+            current = await GetSchemaVersion(session)
+            for version, description, statements in MIGRATIONS:
+                if version <= current or (target is not None
+                                          and version > target):
+                    continue
+                applied.append((version, description, statements))
+                if dry_run:
+                    continue
+                log.info("Applying schema migration %s: %s",
+                         version, description)
+                # Schema changes cannot share a transaction with data
+                # writes, so each statement runs as its own auto-commit
+                # transaction
+                for statement in statements:
+                    await _AcquireLock(session, owner)  # Renew the lease
+                    await (await session.run(query=statement)).consume()
+                await (await session.run(
+                    query=queries.RECORD_MIGRATION,
+                    parameters={
+                        "version": version,
+                        "description": description,
+                        "date": str(datetime.now(settings.SERVER_TIMEZONE))
+                    })).consume()
+        finally:
+            if not dry_run:
+                await (await session.run(
+                    query=queries.RELEASE_MIGRATION_LOCK,
+                    parameters={"owner": owner})).consume()
+    return applied
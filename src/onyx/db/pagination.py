@@ -0,0 +1,99 @@
+"""onyx/db/pagination.py
+
+Keyset (cursor) pagination for the Onyx Salamander CMS list endpoints.
+
+Instead of SKIP/OFFSET, each page starts right after the sort key of the
+last item of the previous page, e.g. (CreatedDate, UUID). The database can
+seek straight to that key, so the cost of a page stays the same no matter
+how deep into the collection it is.
+
+Cursors are opaque to clients, they are the sort key of an item and the
+direction to read in, encoded as url-safe base64 JSON.
+"""
+import json
+import base64
+import binascii
+from typing import Optional
+from fastapi import HTTPException, status
+
+
+def EncodeCursor(key: list, forward: bool = True):
+    """EncodeCursor - Returns the opaque cursor for a sort key.
+        key: list - The sort key of the item the page starts after
+        forward: bool - Read forward (next page) or backward (previous page)
+
+        Usage:
+            cursor = EncodeCursor(record["cursor"])
+    """
+    data = json.dumps([forward, key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def DecodeCursor(cursor: Optional[str]):
+    """DecodeCursor - Returns (forward, key) for a cursor, a missing cursor
+    starts at the beginning of the collection.
+        cursor: str
+
+        Usage:
+            forward, after = DecodeCursor(cursor)
+    """
+    if not cursor:
+        return True, None
+    try:
+        forward, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(forward, bool) or not isinstance(key, list):
+            raise ValueError(cursor)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor."
+        )
+    return forward, key
+
+
+async def ReadPage(tx, query: tuple, parameters: dict,
+                   cursor: Optional[str] = None, limit: int = 25):
+    """ReadPage - Reads one page of a keyset query.
+        tx: Transaction
+        query: tuple - (first, forward, backward) statements from
+            queries.KeysetQuery, all return a `cursor` column
+        parameters: dict - Query parameters, $after & $limit are set here
+        cursor: str - Cursor returned by a previous page
+        limit: int - Page size
+
+    Returns (records, next_cursor, prev_cursor), the cursors are None when
+    there is nothing more to read in that direction.
+
+        Usage:
+            records, next_cursor, prev_cursor = await ReadPage(
+                tx, queries.LIST_PAGES, {}, cursor, limit)
+    """
+    if limit < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit must be at least 1."
+        )
+    forward, after = DecodeCursor(cursor)
+    if after is None:
+        cypher = query[0]
+    else:
+        cypher = query[1] if forward else query[2]
+    # Fetch one extra record to find out if there is another page
+    result = await tx.run(query=cypher,
+                          parameters={**parameters,
+                                      "after": after,
+                                      "limit": limit + 1})
+    records = await result.data()
+    more = len(records) > limit
+    records = records[:limit]
+    if not forward:
+        # Backward pages are read in reverse order
+        records.reverse()
+
+    next_cursor = prev_cursor = None
+    if records:
+        if more or not forward:
+            next_cursor = EncodeCursor(records[-1]["cursor"], True)
+        if (more and not forward) or (forward and after is not None):
+            prev_cursor = EncodeCursor(records[0]["cursor"], False)
+    return records, next_cursor, prev_cursor
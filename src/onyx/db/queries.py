@@ -0,0 +1,935 @@
+"""onyx/db/queries.py
+
+Named, fully parameterized Cypher statements for the Onyx Salamander CMS.
+
+Every value is passed to Neo4j as a query parameter so the query text stays
+the same between requests and the server can reuse its cached query plans.
+Labels and relationship types cannot be parameterized in Cypher, so the few
+statements that need them are built from templates once the name has been
+validated against the allow-list in onyx/settings.py.
+"""
+import re
+from functools import lru_cache
+from fastapi import HTTPException, status
+from onyx import settings
+
+# Labels, relationship types & property keys must be plain identifiers
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Validation
+
+
+def ValidateLabel(label: str, create: bool = False):
+    """ValidateLabel - Checks a node label against the allow-list.
+        label: str
+        create: bool - Whether the label is used to create nodes
+
+        Usage:
+            label = ValidateLabel(label, create=True)
+    """
+    if not IDENTIFIER_PATTERN.match(label or ""):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted, {label} is not a valid label.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    if create and label in settings.RESTRICTED_NODES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted, cannot create {label} with this method.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    if settings.RESTRICT_DB and label not in settings.NODE_LABELS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Operation not permitted, cannot create {label} with this method.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return label
+
+
+def ValidateRelationshipType(relationship_type: str):
+    """ValidateRelationshipType - Checks a relationship type against the
+    allow-list.
+        relationship_type: str
+
+        Usage:
+            rel_type = ValidateRelationshipType(rel_type)
+    """
+    if (not IDENTIFIER_PATTERN.match(relationship_type or "")
+            or (settings.RESTRICT_DB
+                and relationship_type not in settings.RELATIONSHIP_TYPES)):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Operation not permitted, relationship type not allowed.",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return relationship_type
+
+
+def ValidatePropertyKeys(attributes: dict, allow_base: bool = False):
+    """ValidatePropertyKeys - Checks that property keys are identifiers and,
+    unless allow_base is set, do not touch settings.BASE_PROPERTIES.
+        attributes: dict
+        allow_base: bool
+
+        Usage:
+            ValidatePropertyKeys(node_attributes)
+    """
+    for key in attributes or {}:
+        if not IDENTIFIER_PATTERN.match(str(key)):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Operation not permitted, {key} is not a valid property.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        if not allow_base and key in settings.BASE_PROPERTIES:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Operation not permitted. You cannot modify those fields with this method.",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+    return attributes
+
+# Keyset Pagination
+
+
+def KeysetQuery(match: str, variable: str, key: str, tiebreak: str,
+                returns: str, descending: bool = False):
+    """KeysetQuery - Builds the (first, forward, backward) statements for a
+    list query that is paged with onyx.db.pagination.ReadPage.
+        match: str - MATCH clause (and filters) that binds variable
+        variable: str - The variable being paged over
+        key: str - Sort key expression, should be indexed
+        tiebreak: str - Unique expression that orders items with equal keys
+        returns: str - RETURN clause, a `cursor` column is appended
+        descending: bool - Largest keys first, e.g. the most used tags
+
+    $after is the [key, tiebreak] of the item a page starts after. The
+    range on key comes first so the planner can seek the index to it.
+
+        Usage:
+            LIST_PAGES = KeysetQuery("MATCH (page:Page)", "page",
+                                     "page.CreatedDate", "page.Title",
+                                     "RETURN page")
+    """
+    def build(op: str, order: str, seek: bool = True):
+        where = ""
+        if seek:
+            where = f"""WITH {variable} WHERE {key} {op}= $after[0]
+    AND ({key} {op} $after[0] OR {tiebreak} {op} $after[1])
+"""
+        return f"""{match}
+{where}{returns}, [{key}, {tiebreak}] AS cursor
+ORDER BY {key} {order}, {tiebreak} {order}
+LIMIT $limit
+"""
+    if descending:
+        return (build("<", "DESC", seek=False), build("<", "DESC"),
+                build(">", "ASC"))
+    return build(">", "ASC", seek=False), build(">", "ASC"), build("<", "DESC")
+
+# Schema Migrations
+
+
+GET_SCHEMA_VERSION = "MATCH (m:SchemaMigration) RETURN max(m.Version) AS version"
+
+RECORD_MIGRATION = """MERGE (m:SchemaMigration {Version: $version})
+SET m.Description = $description
+SET m.AppliedDate = $date
+"""
+
+# One worker applies migrations at a time. The lock is a lease that expires
+# $lease milliseconds after it was last taken, so a crashed worker does not
+# hold it forever.
+MIGRATION_LOCK_CONSTRAINT = ("CREATE CONSTRAINT schema_migration_lock "
+                             "IF NOT EXISTS FOR (lock:SchemaMigrationLock) "
+                             "REQUIRE lock.Name IS UNIQUE")
+
+# Setting Checked first write locks the node, so the owner is read after
+# any concurrent acquire has committed
+ACQUIRE_MIGRATION_LOCK = """MERGE (lock:SchemaMigrationLock {Name: "schema"})
+SET lock.Checked = timestamp()
+WITH lock
+WHERE lock.Owner IS NULL OR lock.Owner = $owner OR lock.Expires < timestamp()
+SET lock.Owner = $owner
+SET lock.Expires = timestamp() + $lease
+RETURN lock.Owner AS owner
+"""
+
+RELEASE_MIGRATION_LOCK = """MATCH (lock:SchemaMigrationLock {Name: "schema"})
+WHERE lock.Owner = $owner
+SET lock.Owner = null
+"""
+
+# Users
+
+GET_USER = "MATCH (user:User {Email: $email}) RETURN user"
+
+CREATE_USER = "CREATE (user:User $params) RETURN user"
+
+# Blog Post Sorting
+
+# Keys blog post lists can be sorted by, each one is indexed (migrations)
+BLOG_POST_SORT_KEYS = ("CreatedDate", "ModifiedDate", "PublishedDate", "Title")
+
+
+def ValidateSortKey(order_by: str):
+    """ValidateSortKey - Checks a blog post sort key against
+    BLOG_POST_SORT_KEYS.
+        order_by: str
+
+        Usage:
+            order_by = ValidateSortKey(order_by or "CreatedDate")
+    """
+    if order_by not in BLOG_POST_SORT_KEYS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"order_by must be one of {', '.join(BLOG_POST_SORT_KEYS)}."
+        )
+    return order_by
+
+
+def _ListBlogPosts(match: str, key: str):
+    """_ListBlogPosts - Builds the keyset query listing the posts bound by
+    match that the user may see, sorted by key. Posts without key (e.g.
+    the PublishedDate of a draft) cannot be ordered, so they are left out.
+    """
+    return KeysetQuery(f"""{match}
+WHERE post.{key} IS NOT NULL AND ($admin
+    OR post.Published = True
+    OR post.Owner = $user
+    OR post.Creator = $user)""", "post", f"post.{key}", "post.UUID",
+                       "RETURN post")
+
+# Tags
+
+# Tags & keywords are also stored as (:Tag) nodes that posts & pages are
+# TAGGED to, with counters of how many posts (all & published) and pages
+# (all & public) use them. Users are linked to the tags of their
+# unpublished posts by a (:User)-[:DRAFTS {Count}]->(:Tag) counter. The
+# statements that write posts, pages & their URLs keep all of them in sync.
+
+# The counter properties of a tag, each has an index (migration 8)
+TAG_COUNTERS = ("PostCount", "PublishedCount", "PageCount", "PublicPageCount")
+
+
+def _CountDrafts(drafters: str, op: str):
+    """_CountDrafts - Builds the clause that adds (op "+") or takes (op
+    "-") one from the DRAFTS counters of the users in drafters to tag."""
+    if op == "+":
+        return f"""    CALL {{
+        WITH tag, {drafters}
+        UNWIND {drafters} AS drafter
+        MATCH (user:User {{UUID: drafter}})
+        MERGE (user)-[drafts:DRAFTS]->(tag)
+        ON CREATE SET drafts.Count = 0
+        SET drafts.Count = drafts.Count + 1
+    }}
+"""
+    return f"""    CALL {{
+        WITH tag, tagged
+        UNWIND coalesce({drafters}, []) AS drafter
+        MATCH (:User {{UUID: drafter}})-[drafts:DRAFTS]->(tag)
+        SET drafts.Count = drafts.Count - 1
+        WITH drafts WHERE drafts.Count = 0
+        DELETE drafts
+    }}
+"""
+
+
+def _SyncTags(node: str, fields: tuple, counter: str, shown: str,
+              public: str, drafters: str = "[]"):
+    """_SyncTags - Builds the clauses that match the TAGGED relationships
+    of node to its list properties in fields, updating the tag counters.
+        node: str - The variable of the post or page
+        fields: tuple - Its list properties, e.g. ("Tags", "Keywords")
+        counter: str - The Tag property counting nodes like it
+        shown: str - The Tag property counting the ones guests see
+        public: str - Expression, 1 if guests see node else 0
+        drafters: str - Expression, the UUIDs of the users who see node
+            while it is unpublished
+
+    Tag names are trimmed & lower case. Only the relationships that change
+    are written, so running it again is harmless. TAGGED stores what node
+    was counted as (Published & Drafters), so the counters are corrected
+    when that changes.
+    """
+    names = " + ".join(f"coalesce({node}.{field}, [])" for field in fields)
+    return f"""WITH {node}, reduce(found = [], name IN
+        [name IN {names} | toLower(trim(name))] |
+        CASE WHEN name = "" OR name IN found THEN found ELSE found + name END
+    ) AS names, {public} AS public, {drafters} AS drafters
+CALL {{
+    WITH {node}, names, public, drafters
+    MATCH ({node})-[tagged:TAGGED]->(tag:Tag)
+    WHERE NOT tag.Name IN names OR tagged.Published <> public
+        OR coalesce(tagged.Drafters, []) <> drafters
+    SET tag.{counter} = tag.{counter} - 1
+    SET tag.{shown} = tag.{shown} - tagged.Published
+{_CountDrafts("tagged.Drafters", "-")}    DELETE tagged
+}}
+CALL {{
+    WITH {node}, names, public, drafters
+    UNWIND names AS name
+    MERGE (tag:Tag {{Name: name}})
+    ON CREATE SET tag.PostCount = 0, tag.PublishedCount = 0,
+        tag.PageCount = 0, tag.PublicPageCount = 0
+    WITH {node}, tag, public, drafters
+    WHERE NOT ({node})-[:TAGGED]->(tag)
+    CREATE ({node})-[tagged:TAGGED {{Published: public,
+        Drafters: drafters}}]->(tag)
+    SET tag.{counter} = tag.{counter} + 1
+    SET tag.{shown} = tag.{shown} + public
+{_CountDrafts("drafters", "+")}}}
+"""
+
+
+def _Untag(node: str, counter: str, shown: str):
+    """_Untag - Builds the clause that takes node out of the tag counters,
+    run before node is deleted."""
+    return f"""CALL {{
+    WITH {node}
+    MATCH ({node})-[tagged:TAGGED]->(tag:Tag)
+    SET tag.{counter} = tag.{counter} - 1
+    SET tag.{shown} = tag.{shown} - tagged.Published
+{_CountDrafts("tagged.Drafters", "-")}}}
+"""
+
+
+# Guests see published posts, their owner & creator also see them
+# unpublished
+_SYNC_POST_TAGS = _SyncTags(
+    "post", ("Tags", "Keywords"), "PostCount", "PublishedCount",
+    "CASE WHEN post.Published THEN 1 ELSE 0 END",
+    """CASE WHEN post.Published THEN [] ELSE
+        reduce(found = [], uid IN [post.Owner, post.Creator] |
+            CASE WHEN uid IS NULL OR uid IN found THEN found
+            ELSE found + uid END)
+    END""")
+# Pages have no publish state, guests see the ones no private URL links to
+_SYNC_PAGE_TAGS = _SyncTags(
+    "page", ("Keywords",), "PageCount", "PublicPageCount",
+    """CASE WHEN EXISTS {
+        MATCH (link:URL)-[:LINKS]->(page) WHERE link.RequiresAuth = True
+    } THEN 0 ELSE 1 END""")
+_UNTAG_POST = _Untag("post", "PostCount", "PublishedCount")
+_UNTAG_PAGE = _Untag("page", "PageCount", "PublicPageCount")
+
+# A URL that turns private or public changes what guests see of the pages
+# it links to
+_SYNC_LINKED_PAGES = """CALL {
+    WITH url
+    MATCH (url)-[:LINKS]->(page:Page)
+""" + _SYNC_PAGE_TAGS + "}\n"
+
+
+def _ForLabel(label: str, node: str, clauses: str):
+    """_ForLabel - Wraps clauses written for node in a subquery that only
+    runs them when the generic node variable has label."""
+    return f"""CALL {{
+    WITH node
+    WITH node AS {node} WHERE {node}:{label}
+{clauses}}}
+"""
+
+
+# The same for a node of any label, used by the generic /crud statements
+_SYNC_NODE_TAGS = (_ForLabel("BlogPost", "post", _SYNC_POST_TAGS)
+                   + _ForLabel("Page", "page", _SYNC_PAGE_TAGS)
+                   + _ForLabel("URL", "url", _SYNC_LINKED_PAGES))
+_UNTAG_NODE = (_ForLabel("BlogPost", "post", _UNTAG_POST)
+               + _ForLabel("Page", "page", _UNTAG_PAGE))
+
+# Builds the tags of existing posts & pages, in batches (migrations 5 & 8)
+TAG_BLOG_POSTS = ("MATCH (post:BlogPost)\nCALL {\n    WITH post\n"
+                  + _SYNC_POST_TAGS + "} IN TRANSACTIONS OF 1000 ROWS")
+
+TAG_PAGES = ("MATCH (page:Page)\nCALL {\n    WITH page\n"
+             + _SYNC_PAGE_TAGS + "} IN TRANSACTIONS OF 1000 ROWS")
+
+# Tags created before PublicPageCount (migration 8)
+COUNT_PUBLIC_PAGES = """MATCH (tag:Tag) WHERE tag.PublicPageCount IS NULL
+SET tag.PublicPageCount = 0
+"""
+
+GET_TAG = "MATCH (tag:Tag {Name: $tag}) RETURN tag"
+
+# Also reads the DRAFTS counter of $user, the unpublished posts with the
+# tag the user sees next to the published ones
+GET_TAG_WITH_DRAFTS = """MATCH (tag:Tag {Name: $tag})
+OPTIONAL MATCH (:User {UUID: $user})-[drafts:DRAFTS]->(tag)
+RETURN tag, coalesce(drafts.Count, 0) AS drafts
+"""
+
+# Tags used by at least one item, most used first, by counter. Each seeks
+# the index of its counter.
+LIST_TAGS = {
+    counter: KeysetQuery(f"MATCH (tag:Tag) WHERE tag.{counter} > 0", "tag",
+                         f"tag.{counter}", "tag.Name",
+                         f"RETURN tag.Name AS name, tag.{counter} AS count",
+                         descending=True)
+    for counter in TAG_COUNTERS
+}
+
+LIST_TAGGED_BLOG_POSTS = {
+    key: _ListBlogPosts("MATCH (:Tag {Name: $tag})<-[:TAGGED]-(post:BlogPost)",
+                        key)
+    for key in BLOG_POST_SORT_KEYS
+}
+
+LIST_TAGGED_PAGES = KeysetQuery("""MATCH (:Tag {Name: $tag})<-[:TAGGED]-(page:Page)
+WHERE $user IS NOT NULL OR NOT EXISTS {
+    MATCH (url:URL)-[:LINKS]->(page) WHERE url.RequiresAuth = True
+}""", "page", "page.CreatedDate", "page.Title", "RETURN page")
+
+# Blog Posts
+
+# Guests see published posts, users see their own posts, admins see all
+_POST_VISIBLE = """WHERE $admin
+    OR ($user IS NULL AND post.Published = True)
+    OR post.Owner = $user
+"""
+
+GET_BLOG_POST_BY_UUID = ("MATCH (post:BlogPost {UUID: $uid})\n"
+                         + _POST_VISIBLE + "RETURN post")
+
+GET_BLOG_POST_BY_TITLE = ("MATCH (post:BlogPost {Title: $title})\n"
+                          + _POST_VISIBLE + "RETURN post")
+
+CREATE_BLOG_POST = """MATCH (user:User {UUID: $user})
+CREATE (post:BlogPost $params)
+CREATE (user)-[relationship:OWNS]->(post)
+CREATE (user)-[relationship2:AUTHOR]->(post)
+""" + _SYNC_POST_TAGS + "RETURN post"
+
+# One statement per sort key, so each can seek its own index
+LIST_BLOG_POSTS = {key: _ListBlogPosts("MATCH (post:BlogPost)", key)
+                   for key in BLOG_POST_SORT_KEYS}
+
+EXPORT_BLOG_POSTS = """MATCH (post:BlogPost)
+WHERE $admin
+    OR post.Published = True
+    OR post.Owner = $user
+    OR post.Creator = $user
+RETURN post
+"""
+
+UPDATE_BLOG_POST = """MATCH (post:BlogPost {UUID: $uid})
+SET post += $attributes
+SET post.Modifier = $user
+SET post.ModifiedDate = $date
+SET post.Published = coalesce($published, post.Published)
+SET post.PublishedDate = CASE WHEN $published THEN $date
+    ELSE post.PublishedDate END
+""" + _SYNC_POST_TAGS + "RETURN post"
+
+DELETE_BLOG_POST = ("MATCH (post:BlogPost {UUID: $uid})\n"
+                    + _UNTAG_POST + "DETACH DELETE post")
+
+# Pages
+
+GET_PAGE_BY_URL = "MATCH (page:Page {URL: $url}) RETURN page"
+
+GET_PAGE_BY_TITLE = "MATCH (page:Page {Title: $title}) RETURN page"
+
+CREATE_PAGE = """MATCH (user:User {UUID: $user})
+CREATE (page:Page $params)
+CREATE (user)-[relationship:OWNS]->(page)
+WITH page
+OPTIONAL MATCH (url:URL {URL: $url})
+FOREACH (_ IN CASE WHEN url IS NULL THEN [] ELSE [1] END |
+    CREATE (url)-[relationship2:LINKS]->(page))
+""" + _SYNC_PAGE_TAGS + "RETURN page"
+
+LIST_PAGES = KeysetQuery("MATCH (page:Page)", "page", "page.CreatedDate",
+                         "page.Title", "RETURN page")
+
+EXPORT_PAGES = "MATCH (page:Page) RETURN page"
+
+GET_PAGE_PERMISSIONS = """MATCH (user:User {UUID: $user})-[relationship]->(page:Page {URL: $url})
+RETURN TYPE(relationship) AS type
+"""
+
+UPDATE_PAGE = """MATCH (page:Page {URL: $url})
+SET page += $attributes
+SET page.Modifier = $user
+SET page.ModifiedDate = $date
+""" + _SYNC_PAGE_TAGS + "RETURN page"
+
+DELETE_PAGE = """MATCH (page:Page {URL: $url})
+""" + _UNTAG_PAGE + """OPTIONAL MATCH (url:URL {URL: $url}) WHERE $del_url
+DETACH DELETE page, url
+"""
+
+UNLINK_URL = """MATCH (url:URL {URL: $url})-[relationship:LINKS]->(page:Page)
+DELETE relationship
+""" + _SYNC_PAGE_TAGS
+
+RELINK_PAGE_URL = """MATCH (url:URL {URL: $new})
+MATCH (page:Page {URL: $original})
+SET page.URL = $new
+CREATE (url)-[relationship:LINKS]->(page)
+""" + _SYNC_PAGE_TAGS + "RETURN page"
+
+# URLs
+
+GET_URL = "MATCH (url:URL {URL: $url}) RETURN url"
+
+CREATE_URL = """MATCH (user:User {UUID: $user})
+CREATE (url:URL $params)
+CREATE (user)-[relationship1:OWNS]->(url)
+WITH url
+OPTIONAL MATCH (file:File {UUID: $file})
+FOREACH (_ IN CASE WHEN file IS NULL THEN [] ELSE [1] END |
+    CREATE (url)-[relationship2:LINKS]->(file))
+WITH url
+CALL {
+    WITH url
+    UNWIND $groups AS name
+    MATCH (group:Group {Name: name})
+    CREATE (url)-[relationship3:REQUIRES]->(group)
+}
+RETURN url
+"""
+
+LIST_URLS = KeysetQuery("""MATCH (url:URL)
+WHERE $user IS NOT NULL OR url.RequiresAuth = False""", "url",
+                        "url.CreatedDate", "url.URL", "RETURN url")
+
+EXPORT_URLS = """MATCH (url:URL)
+WHERE $user IS NOT NULL OR url.RequiresAuth = False
+RETURN url
+"""
+
+GET_URL_PERMISSIONS = """MATCH (user:User {UUID: $user})-[relationship]->(url:URL {URL: $url})
+RETURN TYPE(relationship) AS type
+"""
+
+UPDATE_URL = """MATCH (url:URL {URL: $url})
+SET url += $attributes
+SET url.Modifier = $user
+SET url.ModifiedDate = $date
+""" + _SYNC_LINKED_PAGES + "RETURN url"
+
+DELETE_URL = """MATCH (url:URL {URL: $url})
+OPTIONAL MATCH (url)-[:LINKS]->(page:Page)
+WITH url, collect(page) AS pages
+DETACH DELETE url
+WITH pages
+UNWIND pages AS page
+""" + _SYNC_PAGE_TAGS
+
+# A URL that LINKS to another URL redirects to it
+REDIRECT_URL = """MATCH (old:URL {URL: $original})
+MATCH (new:URL {URL: $new})
+CREATE (old)-[relationship:LINKS]->(new)
+"""
+
+# Takes over an old URL that redirects elsewhere, e.g. moving a page back
+REUSE_URL = """MATCH (url:URL {URL: $url})-[redirect:LINKS]->(:URL)
+DELETE redirect
+RETURN url
+"""
+
+# Routing table
+_ROUTE = """RETURN url.URL AS key, url,
+    head([(url)-[:LINKS]->(target:URL) | target.URL]) AS redirect
+"""
+
+LOAD_ROUTES = "MATCH (url:URL)\n" + _ROUTE
+
+READ_ROUTES = "MATCH (url:URL) WHERE url.URL IN $urls\n" + _ROUTE
+
+# Files
+
+GET_FILE = "MATCH (file:File {UUID: $uid}) RETURN file"
+
+GET_FILE_BY_FILENAME = "MATCH (file:File {Filename: $filename}) RETURN file"
+
+# Deduplicated files share a (:Blob) that counts the files stored in it
+_STORE_BLOB = """WITH file
+CALL {
+    WITH file
+    WITH file WHERE file.Blob IS NOT NULL
+    MERGE (blob:Blob {Hash: file.Blob})
+    ON CREATE SET blob.RefCount = 0, blob.SizeBytes = file.SizeBytes
+    SET blob.RefCount = blob.RefCount + 1
+    CREATE (file)-[storedAs:STORED_AS]->(blob)
+}
+"""
+
+CREATE_FILE = """MATCH (user:User {UUID: $user})
+CREATE (file:File $params)
+CREATE (user)-[relationship:OWNS]->(file)
+""" + _STORE_BLOB + "RETURN file"
+
+# Creates a File for every attribute map in $files
+CREATE_FILES = """MATCH (user:User {UUID: $user})
+UNWIND $files AS params
+CREATE (file:File)
+SET file = params
+CREATE (user)-[relationship:OWNS]->(file)
+""" + _STORE_BLOB + "RETURN file"
+
+LIST_FILES = KeysetQuery("MATCH (file:File)", "file", "file.CreatedDate",
+                         "file.UUID", "RETURN file")
+
+EXPORT_FILES = "MATCH (file:File) RETURN file"
+
+# Returns the storage key that is no longer used, which is null while other
+# files still share the blob. An unused blob is kept with a RefCount of 0
+# until its bytes are removed under LOCK_UNUSED_BLOB
+DELETE_FILE = """MATCH (file:File {UUID: $uid})
+OPTIONAL MATCH (file)-[storedAs:STORED_AS]->(blob:Blob)
+SET blob.RefCount = blob.RefCount - 1
+WITH file, blob, CASE
+    WHEN blob IS NULL THEN file.UUID
+    WHEN blob.RefCount <= 0 THEN blob.Hash
+END AS unused
+DETACH DELETE file
+RETURN unused
+"""
+
+# Write locks the blob of $hash (creating it if no file ever committed it)
+# and returns it only while no file uses it. An upload of the same content
+# waits on the lock, so its bytes are never removed once a file uses them
+LOCK_UNUSED_BLOB = """MERGE (blob:Blob {Hash: $hash})
+ON CREATE SET blob.RefCount = 0
+SET blob.Checked = timestamp()
+WITH blob WHERE blob.RefCount <= 0
+RETURN blob.Hash AS hash
+"""
+
+DELETE_UNUSED_BLOB = """MATCH (blob:Blob {Hash: $hash})
+WHERE blob.RefCount <= 0
+DELETE blob
+"""
+
+# Comments
+
+GET_COMMENT = "MATCH (comment:Comment {UUID: $uid}) RETURN comment"
+
+GET_COMMENT_WITH_ATTACHMENTS = """MATCH (comment:Comment {UUID: $uid})
+OPTIONAL MATCH (comment)-[r:ATTACHES]->(f:File)
+RETURN comment, collect(f) AS files
+"""
+
+# Attach every File in $files to the comment
+_ATTACH_FILES = """WITH comment
+CALL {
+    WITH comment
+    UNWIND $files AS fileUUID
+    MATCH (file:File {UUID: fileUUID})
+    CREATE (comment)-[linksToFile:ATTACHES]->(file)
+}
+"""
+
+CREATE_COMMENT = """MATCH (user:User {UUID: $user})
+MATCH (commentOn {UUID: $commentOn})
+CREATE (comment:Comment $params)
+CREATE (user)-[madeComment:OWNS]->(comment)
+CREATE (comment)-[isOn:ON]->(commentOn)
+""" + _ATTACH_FILES + "RETURN comment"
+
+LIST_COMMENTS = KeysetQuery("MATCH (comment:Comment)-[r:ON]->(n {UUID: $uid})",
+                            "comment", "comment.CreatedDate", "comment.UUID",
+                            "RETURN comment")
+
+EXPORT_COMMENTS = """MATCH (comment:Comment)-[r:ON]->(n {UUID: $uid})
+RETURN comment
+"""
+
+UPDATE_COMMENT = ("MATCH (comment:Comment {UUID: $uid})\n" + _ATTACH_FILES
+                  + """SET comment += $attributes
+RETURN comment
+""")
+
+DELETE_COMMENT = "MATCH (comment:Comment {UUID: $uid}) DETACH DELETE comment"
+
+
+# Labels of the items comments can be ON, all looked up by an indexed UUID
+COMMENT_ON_LABELS = ("BlogPost", "Page", "Comment", "File")
+
+# Binds c0 to the item $uid, one index seek per label instead of a scan
+_COMMENT_ROOT = "CALL {\n" + "    UNION\n".join(
+    f"    MATCH (c0:{label} {{UUID: $uid}}) RETURN c0\n"
+    for label in COMMENT_ON_LABELS) + "}\n"
+
+
+def _ThreadLevel(level: int, depth: int):
+    """_ThreadLevel - Builds the subquery that collects the comments ON
+    c{level - 1} into replies{level}, oldest first, with the levels below
+    it nested inside.
+
+    Each level reads one comment more than its limit so the caller can tell
+    whether there are more. That extra comment is returned without its
+    replies, the levels below only run for the shown{level} comments, so
+    the query reads at most ThreadNodes comments."""
+    node, parent = f"c{level}", f"c{level - 1}"
+    seek = ""
+    limit = "$replies"
+    shown = f"shown{level - 1}"
+    imports = f"WITH {parent}, {shown}\n    WITH {parent} WHERE {shown}"
+    if level == 1:
+        # Only the top level is paged with a cursor
+        seek = f"""    WHERE $after IS NULL OR {node}.CreatedDate > $after[0]
+        OR ({node}.CreatedDate = $after[0] AND {node}.UUID > $after[1])
+"""
+        limit = "$limit"
+        imports = f"WITH {parent}"
+    if level < depth:
+        nested = _ThreadLevel(level + 1, depth)
+        replies = f"Replies: replies{level + 1}"
+    else:
+        nested = ""
+        replies = f"HasReplies: EXISTS {{ MATCH (:Comment)-[:ON]->({node}) }}"
+    return f"""CALL {{
+    {imports}
+    MATCH ({node}:Comment)-[:ON]->({parent})
+{seek}    WITH {node} ORDER BY {node}.CreatedDate, {node}.UUID LIMIT {limit} + 1
+    WITH collect({node}) AS page{level}
+    UNWIND range(0, size(page{level}) - 1) AS i{level}
+    WITH page{level}[i{level}] AS {node}, i{level} < {limit} AS shown{level}
+{nested}    RETURN collect({node} {{.*,
+        Author: head([(author:User)-[:OWNS]->({node}) | author.ScreenName]),
+        Attachments: [({node})-[:ATTACHES]->(file:File) | file {{.*}}],
+        {replies}
+    }}) AS replies{level}
+}}
+"""
+
+
+def ThreadNodes(depth: int, limit: int, replies: int):
+    """ThreadNodes - The most comments CommentThreadQuery(depth) reads:
+    limit + 1 on the item, then replies + 1 under each shown comment."""
+    shown = limit
+    nodes = limit + 1
+    for _ in range(depth - 1):
+        nodes += shown * (replies + 1)
+        shown *= replies
+    return nodes
+
+
+@lru_cache(maxsize=None)
+def CommentThreadQuery(depth: int):
+    """CommentThreadQuery - Builds the statement that reads the comments
+    on $uid and their replies, depth levels deep, in one query.
+        depth: int - Levels of comments, 1 is only the direct comments
+
+    The top level starts after the cursor key $after & holds up to $limit
+    comments, every other level up to $replies per comment. Comments carry
+    their author's ScreenName & attachments, the deepest ones HasReplies.
+
+        Usage:
+            cypher = queries.CommentThreadQuery(3)
+    """
+    return (_COMMENT_ROOT + _ThreadLevel(1, depth)
+            + "RETURN replies1 AS comments")
+
+# Autocomplete
+
+# Titles & the visibility of what they name. owners may see the item while
+# it is unpublished, private items need a login.
+_POST_TITLE = """RETURN post.UUID AS key, post.Title AS title,
+    coalesce(post.Published, False) AS published,
+    [post.Owner, post.Creator] AS owners, False AS private
+"""
+_PAGE_TITLE = """RETURN coalesce(page.URL, page.Title) AS key, page.Title AS title,
+    True AS published, [] AS owners,
+    EXISTS {
+        MATCH (url:URL)-[:LINKS]->(page) WHERE url.RequiresAuth = True
+    } AS private
+"""
+_URL_TITLE = """RETURN url.URL AS key, url.URL AS title,
+    True AS published, [] AS owners,
+    coalesce(url.RequiresAuth, False) AS private
+"""
+
+# Every title, by type
+TITLES = {
+    "post": "MATCH (post:BlogPost)\n" + _POST_TITLE,
+    "page": "MATCH (page:Page)\n" + _PAGE_TITLE,
+    "url": "MATCH (url:URL)\n" + _URL_TITLE,
+}
+
+# The titles of the items in $keys, by type
+TITLES_BY_KEY = {
+    "post": "MATCH (post:BlogPost) WHERE post.UUID IN $keys\n" + _POST_TITLE,
+    "page": ("MATCH (page:Page)\n"
+             "WHERE page.URL IN $keys OR page.Title IN $keys\n"
+             + _PAGE_TITLE),
+    "url": "MATCH (url:URL) WHERE url.URL IN $keys\n" + _URL_TITLE,
+}
+
+# Search
+
+# Full-text search branches, by result type. Each yields (node, score, type)
+# for the matches the user may see. Pages have no publish state, they are
+# treated as published.
+_SEARCH = {
+    "post": """CALL db.index.fulltext.queryNodes("blog_post_text", $query)
+    YIELD node, score
+    WHERE ($admin
+        OR node.Published = True
+        OR node.Owner = $user
+        OR node.Creator = $user)
+        AND ($published IS NULL
+            OR coalesce(node.Published, False) = $published)
+    RETURN node, score, "post" AS type
+""",
+    "page": """CALL db.index.fulltext.queryNodes("page_text", $query)
+    YIELD node, score
+    WHERE ($user IS NOT NULL OR NOT EXISTS {
+            MATCH (url:URL)-[:LINKS]->(node) WHERE url.RequiresAuth = True
+        })
+        AND coalesce($published, True)
+    RETURN node, score, "page" AS type
+""",
+}
+
+
+@lru_cache(maxsize=None)
+def SearchQuery(types: tuple):
+    """SearchQuery - Builds the keyset query that searches the full-text
+    indexes of the given result types, best matches first.
+        types: tuple - Keys of _SEARCH, e.g. ("post", "page")
+
+        Usage:
+            query = SearchQuery(("post",))
+    """
+    branches = "    UNION ALL\n".join("    " + _SEARCH[t] for t in types)
+    return KeysetQuery(f"""CALL {{
+{branches}}}
+WITH {{node: node, score: score, type: type}} AS hit""", "hit",
+                       "-hit.score", "ID(hit.node)",
+                       "RETURN hit.node AS node, hit.score AS score, "
+                       "hit.type AS type")
+
+# Generic CRUD
+
+_NODE_RETURN = "RETURN node, ID(node) AS id, LABELS(node) AS labels"
+
+_RELATIONSHIP_RETURN = """RETURN nodeA, ID(nodeA), LABELS(nodeA), relationship, ID(relationship),
+TYPE(relationship), nodeB, ID(nodeB), LABELS(nodeB), PROPERTIES(relationship)
+"""
+
+# Internal IDs are unique & ordered, so they are the key and the tiebreak
+LIST_NODES = KeysetQuery("MATCH (node)", "node", "ID(node)", "ID(node)",
+                         _NODE_RETURN)
+
+EXPORT_NODES = "MATCH (node)\n" + _NODE_RETURN
+
+SEARCH_NODES = ("MATCH (node)\nWHERE node[$property] = $value\n"
+                + _NODE_RETURN)
+
+UPDATE_NODE = """MATCH (node) WHERE ID(node) = $id
+SET node += $attributes
+WITH node
+""" + _SYNC_NODE_TAGS + _NODE_RETURN
+
+DELETE_NODE = """MATCH (node) WHERE ID(node) = $id
+""" + _UNTAG_NODE + """WITH node, LABELS(node) AS labels
+DETACH DELETE node
+RETURN labels
+"""
+
+READ_RELATIONSHIP = """MATCH (nodeA)-[relationship]->(nodeB)
+WHERE ID(relationship) = $rel_id
+""" + _RELATIONSHIP_RETURN
+
+UPDATE_RELATIONSHIP = """MATCH (nodeA)-[relationship]->(nodeB)
+WHERE ID(relationship) = $rel_id
+SET relationship += $attributes
+""" + _RELATIONSHIP_RETURN
+
+DELETE_RELATIONSHIP = """MATCH (nodeA)-[relationship]->(nodeB)
+WHERE ID(relationship) = $rel_id
+DELETE relationship
+"""
+
+
+@lru_cache(maxsize=256)
+def CreateNodeQuery(label: str):
+    """CreateNodeQuery - Returns the CREATE statement for a label.
+        label: str - Must already be validated with ValidateLabel
+
+        Usage:
+            cypher = CreateNodeQuery(ValidateLabel(label, create=True))
+    """
+    return f"""CREATE (node:`{label}`)
+SET node += $attributes
+SET node.created_by = $created_by
+SET node.created_time = $created_time
+SET node.UUID = $uid
+WITH node
+""" + _SYNC_NODE_TAGS + _NODE_RETURN
+
+
+@lru_cache(maxsize=256)
+def CreateRelationshipQuery(source_label: str,
+                            target_label: str,
+                            relationship_type: str):
+    """CreateRelationshipQuery - Returns the statement that links two nodes.
+        source_label: str - Validated with ValidateLabel
+        target_label: str - Validated with ValidateLabel
+        relationship_type: str - Validated with ValidateRelationshipType
+
+        Usage:
+            cypher = CreateRelationshipQuery("Page", "File", "LINKS")
+    """
+    return f"""MATCH (nodeA:`{source_label}`) WHERE nodeA[$source_property] = $source_value
+MATCH (nodeB:`{target_label}`) WHERE nodeB[$target_property] = $target_value
+CREATE (nodeA)-[relationship:`{relationship_type}`]->(nodeB)
+SET relationship += $attributes
+SET relationship.created_by = $created_by
+SET relationship.created_time = $created_time
+""" + _RELATIONSHIP_RETURN
+
+
+@lru_cache(maxsize=256)
+def CreateNodesQuery(label: str):
+    """CreateNodesQuery - Returns the UNWIND statement that creates a batch
+    of nodes with the same label.
+        label: str - Must already be validated with ValidateLabel
+
+    Each row of $rows is {index, uid, attributes}.
+
+        Usage:
+            cypher = CreateNodesQuery(ValidateLabel(label, create=True))
+    """
+    return f"""UNWIND $rows AS row
+CREATE (node:`{label}`)
+SET node += row.attributes
+SET node.created_by = $created_by
+SET node.created_time = $created_time
+SET node.UUID = row.uid
+WITH row, node
+""" + _SYNC_NODE_TAGS + "RETURN row.index AS index, ID(node) AS id\n"
+
+
+@lru_cache(maxsize=256)
+def CreateRelationshipsQuery(source_label: str,
+                             target_label: str,
+                             relationship_type: str):
+    """CreateRelationshipsQuery - Returns the UNWIND statement that links a
+    batch of node pairs with the same labels & relationship type.
+        source_label: str - Validated with ValidateLabel
+        target_label: str - Validated with ValidateLabel
+        relationship_type: str - Validated with ValidateRelationshipType
+
+    Each row of $rows is {index, source_property, source_value,
+    target_property, target_value, attributes}.
+
+        Usage:
+            cypher = CreateRelationshipsQuery("Page", "File", "LINKS")
+    """
+    return f"""UNWIND $rows AS row
+MATCH (nodeA:`{source_label}`) WHERE nodeA[row.source_property] = row.source_value
+MATCH (nodeB:`{target_label}`) WHERE nodeB[row.target_property] = row.target_value
+CREATE (nodeA)-[relationship:`{relationship_type}`]->(nodeB)
+SET relationship += row.attributes
+SET relationship.created_by = $created_by
+SET relationship.created_time = $created_time
+RETURN row.index AS index, collect(ID(relationship)) AS ids
+"""
@@ -0,0 +1,89 @@
+"""onyx/db/session.py
+
+Request scoped database access for the Onyx Salamander CMS.
+
+GetUnitOfWork is a FastAPI dependency that opens one session per request.
+Handlers put all of their database work in a single transaction function
+and hand it to UnitOfWork.Read or UnitOfWork.Write. Each runs it as one
+managed transaction that commits once, so a request never leaves partial
+writes behind.
+
+Reads and writes are routed separately so a Neo4j cluster can serve reads
+from followers & read replicas, and the driver retries either kind on
+transient errors (leader changes, deadlocks, lost connections) using the
+DB_RETRY_* settings.
+
+Hot lookups (a post, a page, a user, a file) can go through
+UnitOfWork.ReadShared, which runs one query for all concurrent requests
+asking for the same key instead of one each.
+"""
+from onyx import settings
+from onyx.cache import SingleFlight
+
+# Coalesces concurrent ReadShared calls with the same key
+READ_FLIGHT = SingleFlight(timeout=settings.SINGLE_FLIGHT_TIMEOUT)
+
+
+class UnitOfWork:
+    """UnitOfWork wraps the session that is shared by every dependency and
+    handler of a single request.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    async def Read(self, work, *args, **kwargs):
+        """Read - Runs work(tx, *args, **kwargs) in a read transaction.
+
+        Read transactions may be routed to any cluster member that can
+        serve reads. work must not write to the database.
+
+            Usage:
+                page = await uow.Read(GetPage, url=url)
+        """
+        return await self.session.execute_read(work, *args, **kwargs)
+
+    async def ReadShared(self, key, work, *args, **kwargs):
+        """ReadShared - Like Read, but concurrent calls with the same key
+        share a single query and its result or error.
+
+        key must identify everything the result depends on (including the
+        user, if visibility depends on it), and the result must not be
+        modified by callers. The shared query runs in its own session so it
+        does not depend on the request that started it.
+
+            Usage:
+                page = await uow.ReadShared(("page", url), GetPage, url=url)
+        """
+        async def read():
+            async with settings.DB_DRIVER.session() as session:
+                return await session.execute_read(work, *args, **kwargs)
+
+        return await READ_FLIGHT.Do(key, read)
+
+    async def Write(self, work, *args, **kwargs):
+        """Write - Runs work(tx, *args, **kwargs) in a write transaction.
+
+        The transaction is committed when work returns and rolled back if it
+        raises, so either all of its writes land or none do.
+
+        NOTE: work is run again if the transaction fails with a transient
+        error, so it must not change any state outside of the database.
+
+            Usage:
+                page = await uow.Write(UpdatePageURL, url, new_url, user)
+        """
+        return await self.session.execute_write(work, *args, **kwargs)
+
+
+async def GetUnitOfWork():
+    """GetUnitOfWork - FastAPI dependency that yields the request's
+    UnitOfWork. FastAPI caches dependencies per request, so the auth
+    dependencies and the handler share the same session.
+
+        Usage:
+            async def handler(uow: UnitOfWork = Depends(GetUnitOfWork)):
+                ...
+    """
+    async with settings.DB_DRIVER.session() as session:
+        yield UnitOfWork(session)
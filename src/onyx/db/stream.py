@@ -0,0 +1,54 @@
+"""onyx/db/stream.py
+
+Streaming exports for the Onyx Salamander CMS.
+
+StreamRecords turns a query into an application/x-ndjson response, one JSON
+object per line. Records are pulled from the Neo4j result cursor
+EXPORT_FETCH_SIZE at a time and written out as they arrive, so an export
+never holds more than a batch of records in memory however large the
+collection is. The next batch is only read once the client has taken the
+previous one, so a slow client slows the export down instead of making it
+buffer.
+"""
+from typing import Callable
+from fastapi.responses import StreamingResponse
+from neo4j import READ_ACCESS
+from onyx import settings
+
+NDJSON = "application/x-ndjson"
+
+
+async def _Lines(query: str, parameters: dict, render: Callable):
+    """_Lines - Yields the rendered records of query, EXPORT_CHUNK_SIZE
+    lines at a time.
+
+    The export opens its own session, the request's UnitOfWork is not
+    meant to outlive the handler.
+    """
+    async with settings.DB_DRIVER.session(
+            default_access_mode=READ_ACCESS,
+            fetch_size=settings.EXPORT_FETCH_SIZE) as session:
+        result = await session.run(query=query, parameters=parameters)
+        lines = []
+        async for record in result:
+            lines.append(render(record) + "\n")
+            if len(lines) >= settings.EXPORT_CHUNK_SIZE:
+                yield "".join(lines)
+                lines = []
+        if lines:
+            yield "".join(lines)
+
+
+def StreamRecords(query: str, parameters: dict, render: Callable):
+    """StreamRecords - Returns a StreamingResponse that writes every record
+    of query as one line of JSON.
+        query: str
+        parameters: dict
+        render: Callable - Turns a record into a JSON string
+
+        Usage:
+            return StreamRecords(queries.EXPORT_PAGES, {},
+                                 lambda r: Page(**r["page"]).json())
+    """
+    return StreamingResponse(_Lines(query, parameters, render),
+                             media_type=NDJSON)
@@ -2,7 +2,8 @@ from collections.abc import Iterable
 from fastapi import FastAPI
 from onyx import settings
 from onyx.crud import core
-from onyx.blog import post, page, url, file, comment
+from onyx.blog import post, page, url, file, image, comment, search
+from onyx.blog import autocomplete, tag
 from auth import auth
 
 # Authentication Routes
@@ -12,8 +13,12 @@ ROUTES = [
     comment.ROUTE,
     core.ROUTE,
     file.ROUTE,
+    image.ROUTE,
     page.ROUTE,
     url.ROUTE,
+    search.ROUTE,
+    autocomplete.ROUTE,
+    tag.ROUTE,
     page.page_router,
 ]
 
@@ -7,7 +7,6 @@ This file holds global settings for the Onyx Salamander CMS Project.
 import os
 import hashlib
 from datetime import timezone
-from neo4j import GraphDatabase
 from onyx.storage.base import StorageDriver
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
@@ -37,6 +36,16 @@ USE_STATIC = True
 STATIC_ROUTE = "/static"  # The url for accessing static files
 STATIC_DIR = "static"  # The local directory for static files
 
+# Public page cache, serialized GET /{url} responses kept in memory
+PAGE_CACHE_BYTES = 32 * 1024 * 1024  # Max bytes cached per worker, 0 = off
+PAGE_CACHE_TTL = 60  # Seconds a cached page is served without the database
+PAGE_CACHE_CONTROL = "public, max-age=60"  # Cache-Control for pages
+SEARCH_SNIPPET_LENGTH = 160  # Characters of each highlighted search match
+AUTOCOMPLETE_REFRESH = 300  # Seconds between reloads of the title index
+AUTOCOMPLETE_MAX_RESULTS = 50  # Largest limit of /autocomplete
+ROUTING_REFRESH = 300  # Seconds between reloads of the URL routing table
+COMMENT_THREAD_MAX_NODES = 500  # Most comments /comment/thread reads at once
+
 # Templating
 USE_TEMPLATES = False  # True
 TEMPLATE_DIR = "templates"
@@ -55,7 +64,37 @@ TEMP_DIR = "/tmp/onyx"
 HASH_FILES = False  # True # Whether to hash files for security purposes
 HASH_FUNC = hashlib.sha256  # The hash function to use
 UPLOAD_DIR = "./uploads"  # The upload directory
-STORAGE_DRIVER = StorageDriver(UPLOAD_DIR)
+UPLOAD_CHUNK_SIZE = 2**20  # Bytes read from an upload at a time (1 MiB)
+UPLOAD_CONCURRENCY = 4  # Attachments of a request stored at the same time
+# Store identical uploads once, under their HASH_FUNC digest
+DEDUPLICATE_FILES = False
+# Levels of hex prefix sub directories files are spread over (0 = flat)
+UPLOAD_FANOUT = 2
+# Let the reverse proxy send downloads: None, "x-accel-redirect" (nginx)
+# or "x-sendfile" (Apache/lighttpd)
+SENDFILE_MODE = None
+# Internal proxy location that serves UPLOAD_DIR (x-accel-redirect only)
+SENDFILE_PREFIX = "/protected-uploads/"
+# Let the ASGI server send downloads with sendfile() (zero-copy send
+# extension). Uvicorn & Hypercorn do not support it, use SENDFILE_MODE for
+# zero-copy downloads behind a proxy instead. Also needs GZipMiddleware
+# removed from MIDDLEWARE since it only passes on regular body messages.
+ZERO_COPY_SEND = False
+STORAGE_DRIVER = StorageDriver(UPLOAD_DIR, fanout=UPLOAD_FANOUT,
+                               sendfile=SENDFILE_MODE,
+                               sendfile_prefix=SENDFILE_PREFIX,
+                               zero_copy=ZERO_COPY_SEND)
+# Shared storage for multi node deployments (needs boto3)
+# from onyx.storage.backends.s3boto3 import S3StorageDriver
+# STORAGE_DRIVER = S3StorageDriver("onyx-uploads",
+#                                  endpoint_url="http://localhost:9000")
+# Image derivatives (/file/image/, needs Pillow)
+IMAGE_WORKERS = 2  # Processes rendering derivatives
+IMAGE_CACHE_DIR = "./image_cache"  # Where rendered derivatives are kept
+IMAGE_CACHE_BYTES = 512 * 2**20  # Disk budget of the derivative cache
+IMAGE_MAX_SIZE = 4096  # Largest width/height that can be requested
+IMAGE_QUALITY = 80  # Default encoder quality
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
 
 # Security Settings
 # Secret Key
@@ -77,20 +116,38 @@ PASSWORD_SCHEMES_DEPRECATED = "auto"
 SALT_SIZE = 32
 PWD_CONTEXT = CryptContext(schemes=PASSWORD_SCHEMES,
                            deprecated=PASSWORD_SCHEMES_DEPRECATED)
+# Hashing runs in its own thread pool so it never blocks the event loop
+PASSWORD_WORKERS = 4  # Threads hashing & verifying passwords
+PASSWORD_QUEUE_LIMIT = 64  # Waiting hash jobs before answering 503
 
 # Authentication Settings
 AUTH_ENDPOINT = "/auth"
 OAUTH2_SCHEME = OAuth2PasswordBearer(tokenUrl="auth/token", auto_error=False)
 JWT_ALGORITHM = "HS256"
 TOKEN_LIFETIME_MINUTES = 15  # How many minutes an access token is valid
+# Cache of authenticated users, saves a database lookup per request
+USER_CACHE_SIZE = 1024  # Max users cached per worker, 0 disables the cache
+USER_CACHE_TTL = 30  # Seconds a cached user is trusted
+USER_CACHE_NEGATIVE_TTL = 0  # Seconds an unknown email is cached, 0 = off
 
 # Database Settings
 DATABASE_URL = os.environ.get("DATABASE_URL", "neo4j://localhost:7687")
 DATABASE_USER = os.environ.get("DATABASE_USER", "neo4j")
 DATABASE_PASS = os.environ.get("DATABASE_PASS", "password")
 # Neo4j Database Driver for convenience
-DB_DRIVER = GraphDatabase.driver(DATABASE_URL,
-                                 auth=(DATABASE_USER, DATABASE_PASS))
+# The async driver binds itself to the running event loop, so it is opened
+# by onyx.db.driver.OpenDriver() on app startup instead of at import time.
+DB_DRIVER = None
+DB_DRIVER_CONFIG = {}  # Extra keyword arguments for the driver
+# Transaction retries on transient errors, see onyx/db/session.py
+DB_RETRY_TIME = 15.0  # Seconds to keep retrying a failed transaction
+DB_RETRY_DELAY = 1.0  # Seconds to wait before the first retry
+DB_RETRY_MULTIPLIER = 2.0  # Backoff multiplier applied after each retry
+DB_RETRY_JITTER = 0.2  # Random +/- fraction added to each delay
+# Seconds a request waits on a read shared with concurrent requests
+SINGLE_FLIGHT_TIMEOUT = 10.0
+RUN_MIGRATIONS = True  # Apply schema migrations (onyx/db/migrations.py) on startup
+MIGRATION_LOCK_LEASE = 600  # Seconds a worker may hold the migration lock
 RESTRICT_DB = False  # Whether to restrict database operations
 # Nodes that cannot be made through CRUD operations
 RESTRICTED_NODES = ["User"]
@@ -98,6 +155,10 @@ NODE_LABELS = []  # List of allowed node labels
 RELATIONSHIP_TYPES = []  # List of relationship types
 BASE_PROPERTIES = ["created_by", "created_time",
                    "CreatedDate", "ModifiedDate", "Creator", "Modifier"]
+BATCH_MAX_ITEMS = 10000  # Max items per /crud/batch request
+BATCH_CHUNK_SIZE = 1000  # Items written per batch transaction
+EXPORT_FETCH_SIZE = 1000  # Records fetched per round trip by /export routes
+EXPORT_CHUNK_SIZE = 100  # NDJSON lines written per response chunk
 
 # CORS Settings
 ALLOWED_ORIGINS = [
@@ -1 +1,226 @@
-# Todo
\ No newline at end of file
+"""storage/backends/s3boto3.py
+
+Amazon S3 (and S3 compatible, e.g. MinIO) storage for the Onyx CMS System.
+
+boto3 is an optional dependency, install it to use this driver:
+
+    pip install boto3
+"""
+import asyncio
+import anyio
+from fastapi.responses import RedirectResponse
+from onyx.storage.base import StorageDriver
+from onyx.storage.utils import secure_filename
+from onyx.storage.errors import FileExists
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+MIN_PART_SIZE = 5 * 2**20  # S3 rejects smaller parts, except for the last
+
+
+class S3StorageDriver(StorageDriver):
+    """S3StorageDriver stores files as objects in an S3 bucket, so every
+    node of a deployment shares the same storage.
+
+    One boto3 client is created per driver and shared by every request,
+    its connection pool holds max_pool_connections connections. Uploads
+    larger than part_size are streamed as a multipart upload with up to
+    concurrency parts in flight at once. Downloads are redirects to a
+    presigned URL, so the bytes go straight from S3 to the client (S3
+    handles Range requests itself).
+
+        Usage:
+            STORAGE_DRIVER = S3StorageDriver(
+                "onyx-uploads", endpoint_url="http://localhost:9000")
+    """
+
+    def __init__(self, bucket, prefix="", part_size=8 * 2**20,
+                 concurrency=4, url_expires=3600, max_pool_connections=10,
+                 client=None, **client_kwargs):
+        if boto3 is None:
+            raise ImportError("S3StorageDriver needs boto3: pip install boto3")
+        super().__init__(UPLOAD_DIR=None)
+        self.name = "S3_DRIVER"
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = concurrency
+        self.url_expires = url_expires
+        # boto3 clients are thread safe, the worker threads share this one
+        self.client = client or boto3.client(
+            "s3", config=Config(max_pool_connections=max_pool_connections),
+            **client_kwargs)
+
+    def _Key(self, filename):
+        """_Key - Returns the object key of a file."""
+        return self.prefix + secure_filename(filename)
+
+    def Exists(self, filename):
+        """Checks if a file exists."""
+        try:
+            self.client.head_object(Bucket=self.bucket,
+                                    Key=self._Key(filename))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    async def WriteFile(self, filename, file, overwrite=False, digest=None,
+                        chunk_size=None):
+        """Write content to a file.
+
+        Uploads smaller than part_size are sent with one PUT. Larger ones
+        are sent as a multipart upload: parts are read one after another,
+        added to digest and uploaded by worker threads, at most concurrency
+        at a time. The object only appears once every part is uploaded, and
+        a failed upload is aborted.
+
+        :param str filename: The storage root-relative filename
+        :param file: The UploadFile to write in the file
+        :param bool overwrite: Whether to allow overwrite or not
+        :param digest: Optional hashlib object updated with the content
+        :param int chunk_size: Unused, parts are part_size bytes
+        :raises FileExists: If the file exists and `overwrite` is `False`
+        :returns: The number of bytes written
+        """
+        if not overwrite and await anyio.to_thread.run_sync(self.Exists,
+                                                            filename):
+            raise FileExists()
+        key = self._Key(filename)
+        extra = {}
+        if getattr(file, "content_type", None):
+            extra["ContentType"] = file.content_type
+
+        body = await self._ReadPart(file, digest)
+        if len(body) < self.part_size:
+            await anyio.to_thread.run_sync(lambda: self.client.put_object(
+                Bucket=self.bucket, Key=key, Body=body, **extra))
+            return len(body)
+
+        upload = await anyio.to_thread.run_sync(
+            lambda: self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=key, **extra))
+        upload_id = upload["UploadId"]
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        size = 0
+        try:
+            number = 1
+            while body:
+                size += len(body)
+                # Wait for a free slot, so no more than concurrency parts
+                # are held in memory
+                await slots.acquire()
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+                tasks.append(asyncio.ensure_future(
+                    self._UploadPart(slots, key, upload_id, number, body)))
+                body = await self._ReadPart(file, digest)
+                number += 1
+            parts = await asyncio.gather(*tasks)
+            await anyio.to_thread.run_sync(
+                lambda: self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    MultipartUpload={"Parts": parts}))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await anyio.to_thread.run_sync(
+                lambda: self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id))
+            raise
+        return size
+
+    async def _ReadPart(self, file, digest):
+        """_ReadPart - Reads up to part_size bytes of an upload."""
+        chunks = []
+        size = 0
+        while size < self.part_size:
+            chunk = await file.read(self.part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        body = b"".join(chunks)
+        if digest is not None and body:
+            await anyio.to_thread.run_sync(digest.update, body)
+        return body
+
+    async def _UploadPart(self, slots, key, upload_id, number, body):
+        """_UploadPart - Uploads one part of a multipart upload and frees
+        its slot."""
+        try:
+            res = await anyio.to_thread.run_sync(
+                lambda: self.client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=body))
+        finally:
+            slots.release()
+        return {"ETag": res["ETag"], "PartNumber": number}
+
+    def ReadFile(self, filename, db_name=None, headers=None, etag=None):
+        """Redirects the client to a presigned URL of the file.
+
+        Signing happens locally, so no request is made to S3. A missing
+        file is reported by S3 when the client follows the redirect.
+
+        :param str filename: The storage root-relative filename
+        :param str db_name: The filename sent to the client
+        :param headers: Unused, S3 handles Range & If-Range itself
+        :param str etag: Unused, S3 sends the object's ETag
+        """
+        params = {"Bucket": self.bucket, "Key": self._Key(filename)}
+        if db_name:
+            params["ResponseContentDisposition"] = \
+                f'attachment; filename="{secure_filename(db_name)}"'
+        url = self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=self.url_expires)
+        return RedirectResponse(url)
+
+    async def ReadBytes(self, filename):
+        """Reads the whole content of a file off the event loop."""
+        def read():
+            try:
+                res = self.client.get_object(Bucket=self.bucket,
+                                             Key=self._Key(filename))
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                    raise FileNotFoundError(filename)
+                raise
+            return res["Body"].read()
+        return await anyio.to_thread.run_sync(read)
+
+    def DeleteFile(self, filename):
+        """Deletes a given file in the bucket."""
+        if not self.Exists(filename):
+            raise FileNotFoundError(filename)
+        self.client.delete_object(Bucket=self.bucket, Key=self._Key(filename))
+
+    def ListFiles(self, after=None):
+        """Lists the files in the bucket, for maintenance scripts (it is
+        not exposed over HTTP).
+
+        Returns an iterator that fetches one page of keys at a time. Keys
+        come out in order, so a listing can be resumed by passing the last
+        name it returned as after.
+
+        :param str after: Only list files that come after this one
+        """
+        pages = self.client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self.prefix,
+            StartAfter=self._Key(after) if after else "")
+        for page in pages:
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):]
+
+    def Reshard(self, dry_run=False):
+        """Object keys have no directories, so there is nothing to move."""
+        return 0
@@ -4,71 +4,288 @@ Holds the base file StorageDrive class for the Onyx CMS System
 """
 import os
 import os.path
-import shutil
-from fastapi.responses import FileResponse
+import heapq
+import secrets
+import mimetypes
+from urllib.parse import quote
+import anyio
+from fastapi import Response
+from onyx.storage.response import RangeFileResponse
 from onyx.storage.utils import secure_filename
 from onyx.storage.errors import FileExists
 
+PARTIAL_SUFFIX = ".part"  # Suffix of uploads that are still being written
+SENDFILE_MODES = (None, "x-accel-redirect", "x-sendfile")
+
 
 class StorageDriver:
     """This class contains functionality for managing storage.
+
+    Files are spread over fanout levels of sub directories named after the
+    first hex digits of their name, e.g. with fanout=2 the file
+    3f2a9c1e-... is stored as 3f/2a/3f2a9c1e-.... This keeps every
+    directory small however many files are stored. Files left at the top
+    of a flat directory are still found, Reshard moves them into place.
+
+    With sendfile set to "x-accel-redirect" (nginx) or "x-sendfile"
+    (Apache, lighttpd) downloads are handed to the reverse proxy, which
+    sends the bytes itself instead of a worker. zero_copy lets the ASGI
+    server send them with sendfile() instead (see RangeFileResponse).
     """
 
-    def __init__(self, UPLOAD_DIR):
+    def __init__(self, UPLOAD_DIR, fanout=0, sendfile=None,
+                 sendfile_prefix="/protected-uploads/", zero_copy=False):
+        if sendfile not in SENDFILE_MODES:
+            raise ValueError(f"Unknown sendfile mode: {sendfile}")
         self.name = "LOCAL_DRIVER"
         self.upload_dir = UPLOAD_DIR
+        self.fanout = fanout
+        self.sendfile = sendfile
+        self.sendfile_prefix = sendfile_prefix
+        self.zero_copy = zero_copy
+
+    def _Parts(self, filename):
+        """_Parts - Returns the path components of a file, relative to the
+        upload directory."""
+        name = secure_filename(filename)
+        prefix = name.ljust(2 * self.fanout, "_")
+        return tuple(prefix[2 * i:2 * i + 2]
+                     for i in range(self.fanout)) + (name,)
+
+    def _Path(self, filename):
+        """_Path - Returns the path a file is stored at, falling back to
+        the flat layout for files that were not resharded yet."""
+        path = os.path.join(self.upload_dir, *self._Parts(filename))
+        if self.fanout and not os.path.exists(path):
+            flat = os.path.join(self.upload_dir, secure_filename(filename))
+            if os.path.exists(flat):
+                return flat
+        return path
 
     def Exists(self, filename):
         """Checks if a file exists.
 
         Overridden by backends.
         """
-        filename = secure_filename(filename)
-        return os.path.exists(os.path.join(self.upload_dir, filename))
+        return os.path.exists(self._Path(filename))
 
-    async def WriteFile(self, filename, file, overwrite=False):
+    async def WriteFile(self, filename, file, overwrite=False, digest=None,
+                        chunk_size=2**20):
         """Write content to a file.
 
+        The upload is read once, chunk by chunk. Each chunk is added to
+        digest & written to disk in a worker thread, so hashing and writing
+        a large upload never blocks the event loop. The content goes to a
+        temporary file that is renamed into place once complete, so readers
+        never see a partly written file.
+
         :param str filename: The storage root-relative filename
-        :param file: The file-like object to write in the file
+        :param file: The UploadFile to write in the file
         :param bool overwrite: Whether to allow overwrite or not
+        :param digest: Optional hashlib object updated with the content
+        :param int chunk_size: How many bytes to read at a time
         :raises FileExists: If the file exists and `overwrite` is `False`
+        :returns: The number of bytes written
 
         Overridden by backends.
         """
         if not overwrite and self.Exists(filename):
             raise FileExists()
-        filename = secure_filename(filename)
-        fpath = os.path.join(self.upload_dir, filename)
-        with open(fpath, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+        fpath = os.path.join(self.upload_dir, *self._Parts(filename))
+        partial = f"{fpath}.{secrets.token_hex(8)}{PARTIAL_SUFFIX}"
+
+        def write(f, chunk):
+            if digest is not None:
+                digest.update(chunk)
+            f.write(chunk)
+
+        size = 0
+        await anyio.to_thread.run_sync(os.makedirs, os.path.dirname(fpath),
+                                       0o777, True)
+        f = await anyio.to_thread.run_sync(open, partial, "wb")
+        try:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                await anyio.to_thread.run_sync(write, f, chunk)
+                size += len(chunk)
+            await anyio.to_thread.run_sync(f.close)
+            os.replace(partial, fpath)
+        except BaseException:
+            f.close()
+            os.remove(partial)
+            raise
+        return size
 
-    def ReadFile(self, filename, db_name=None):
+    def ReadFile(self, filename, db_name=None, headers=None, etag=None):
         """Reads a file from the local storage.
 
+        :param str filename: The storage root-relative filename
+        :param str db_name: The filename sent to the client
+        :param headers: The request headers, used for Range & If-Range
+        :param str etag: ETag of the file, e.g. its stored hash
+
         Overridden by backends
         """
-        filename = secure_filename(filename)
-        fpath = os.path.join(self.upload_dir, filename)
-        if not self.Exists(filename):
+        fpath = self._Path(filename)
+        if not os.path.exists(fpath):
             raise FileNotFoundError(filename)
-        res = FileResponse(fpath, filename=db_name)
+        if self.sendfile:
+            return self._SendfileResponse(fpath, db_name, etag)
+        headers = headers or {}
+        res = RangeFileResponse(fpath, filename=db_name,
+                                range_header=headers.get("range"),
+                                if_range=headers.get("if-range"),
+                                etag=etag, zero_copy=self.zero_copy)
         return res
 
+    def _SendfileResponse(self, fpath, db_name=None, etag=None):
+        """_SendfileResponse - Returns an empty response that tells the
+        reverse proxy which file to send. The proxy handles Range requests
+        & conditional headers itself."""
+        if self.sendfile == "x-accel-redirect":
+            # An internal location of the proxy that maps to upload_dir
+            relative = os.path.relpath(fpath, self.upload_dir)
+            header = ("X-Accel-Redirect",
+                      self.sendfile_prefix.rstrip("/") + "/"
+                      + quote(relative.replace(os.sep, "/")))
+        else:
+            header = ("X-Sendfile", os.path.abspath(fpath))
+        res_headers = dict([header])
+        if db_name:
+            quoted = quote(db_name)
+            if quoted != db_name:
+                res_headers["Content-Disposition"] = \
+                    f"attachment; filename*=utf-8''{quoted}"
+            else:
+                res_headers["Content-Disposition"] = \
+                    f'attachment; filename="{db_name}"'
+        if etag:
+            res_headers["ETag"] = f'"{etag}"'
+        media_type = mimetypes.guess_type(db_name or fpath)[0]
+        return Response(headers=res_headers,
+                        media_type=media_type or "application/octet-stream")
+
+    async def ReadBytes(self, filename):
+        """Reads the whole content of a file off the event loop.
+
+        Overridden by backends.
+        """
+        fpath = self._Path(filename)
+
+        def read():
+            with open(fpath, "rb") as f:
+                return f.read()
+        return await anyio.to_thread.run_sync(read)
+
     def DeleteFile(self, filename):
         """Deletes a given file in the local storage.
 
         Overridden by backends.
         """
-        filename = secure_filename(filename)
-        path = os.path.join(self.upload_dir, filename)
-        if not self.Exists(filename):
+        path = self._Path(filename)
+        if not os.path.exists(path):
             raise FileNotFoundError(path)
         os.remove(path)
 
-    def ListFiles(self):
-        """Lists all the files in the local storage.
+    def ListFiles(self, after=None):
+        """Lists the files in the local storage.
+
+        Not exposed over HTTP, it is for maintenance scripts (e.g. finding
+        files no File node points at) that need every stored file.
+
+        Returns an iterator that walks the storage one directory at a time
+        instead of building a list of every file: each directory is read
+        when the walk reaches it, and only shard directories (a few hundred
+        entries) are sorted. Files come out in the order of their sharded
+        paths, so a listing can be resumed by passing the last name it
+        returned as after. Files of the flat layout that were not resharded
+        yet are listed where Reshard will put them, uploads that are still
+        being written are left out.
+
+        With fanout=0 every listing reads the whole upload directory, but
+        files are still handed out one at a time from a heap rather than
+        sorted up front.
+
+        :param str after: Only list files that come after this one
+
+        Overridden by backends.
+
+            Usage:
+                for filename in driver.ListFiles(after=cursor):
+                    ...
+        """
+        start = self._Parts(after) if after else None
+        yield from self._List(self.upload_dir, (), start)
+
+    def _List(self, path, parts, start):
+        """_List - Returns an iterator over the files below path in order,
+        skipping those up to start (the path components of the cursor)."""
+        depth = len(parts)
+        shards, files = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if depth < self.fanout and entry.is_dir():
+                    shards.append(entry)
+                elif (entry.is_file() and (depth == 0 or depth == self.fanout)
+                      and not entry.name.endswith(PARTIAL_SUFFIX)):
+                    files.append(entry.name)
+        if depth == self.fanout:
+            return self._Sorted(files, start)
+        shards.sort(key=lambda entry: entry.name)
+        walk = self._Shards(shards, parts, start)
+        if not files:
+            return walk
+        # Flat files left at the top, merged in where they will be sharded
+        return heapq.merge(walk, self._Sorted(files, start), key=self._Parts)
+
+    def _Shards(self, shards, parts, start):
+        """_Shards - Yields the files of the shard directories, in order,
+        reading each only when the walk gets to it."""
+        for entry in shards:
+            key = parts + (entry.name,)
+            if start and key < start[:len(key)]:
+                continue
+            # Only the directories on the cursor's path are partial
+            on_path = start and key == start[:len(key)]
+            yield from self._List(entry.path, key, start if on_path else None)
+
+    def _Sorted(self, names, start):
+        """_Sorted - Yields the names after start in the order of their
+        sharded paths, popping them off a heap one at a time."""
+        heap = [(key, name) for key, name in
+                ((self._Parts(name), name) for name in names)
+                if not start or key > start]
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)[1]
+
+    def Reshard(self, dry_run=False):
+        """Moves every stored file to where the current fanout puts it,
+        e.g. from a flat upload directory into the sharded layout or from
+        one fanout to another. Directories left empty are removed.
+
+        :param bool dry_run: Only count the files that would move
+        :returns: The number of files moved
 
         Overridden by backends.
         """
-        return os.listdir(self.upload_dir)
+        moved = 0
+        for dirpath, dirnames, filenames in os.walk(self.upload_dir,
+                                                    topdown=False):
+            for name in filenames:
+                if name.endswith(PARTIAL_SUFFIX):
+                    continue
+                source = os.path.join(dirpath, name)
+                target = os.path.join(self.upload_dir, *self._Parts(name))
+                if source == target:
+                    continue
+                moved += 1
+                if not dry_run:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(source, target)
+            if not dry_run and dirpath != self.upload_dir \
+                    and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return moved
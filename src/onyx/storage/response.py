@@ -0,0 +1,196 @@
+"""storage/response.py
+
+File responses with HTTP Range support for the Onyx CMS System
+"""
+import os
+import stat
+import secrets
+import hashlib
+from typing import Optional
+import anyio
+from fastapi.responses import FileResponse
+
+MAX_RANGES = 16  # More ranges than this are ignored and the file is sent whole
+
+
+def ETagMatches(etag: str, if_none_match: Optional[str]):
+    """ETagMatches - Whether an If-None-Match header matches etag, using
+    the weak comparison RFC 9110 requires for If-None-Match."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.replace("W/", "", 1) == etag:
+            return True
+    return False
+
+
+class RangeFileResponse(FileResponse):
+    """RangeFileResponse is a FileResponse that answers Range requests.
+
+    A single range is sent as 206 Partial Content with a Content-Range
+    header, several ranges as a multipart/byteranges body and ranges past
+    the end of the file as 416. If-Range is honoured against the ETag
+    and Last-Modified of the file.
+
+    With zero_copy (the ZERO_COPY_SEND setting) and a server that supports
+    the ASGI zero-copy send extension, the file is handed to the server to
+    send with sendfile(). Uvicorn & Hypercorn do not implement it, so
+    there the file is read in chunks off the event loop, as without it.
+
+        Usage:
+            return RangeFileResponse(path, filename="a.pdf",
+                                     range_header=request.headers.get("range"),
+                                     if_range=request.headers.get("if-range"),
+                                     etag=dbFile.Hash)
+    """
+
+    def __init__(self, path, range_header: str = None, if_range: str = None,
+                 etag: str = None, zero_copy: bool = False, **kwargs):
+        self.range_header = range_header
+        self.zero_copy = zero_copy
+        self.if_range = if_range
+        self.etag = f'"{etag}"' if etag else None
+        super().__init__(path, **kwargs)
+        self.headers["accept-ranges"] = "bytes"
+
+    def set_stat_headers(self, stat_result: os.stat_result):
+        if self.etag is None:
+            base = f"{stat_result.st_mtime}-{stat_result.st_size}"
+            self.etag = f'"{hashlib.md5(base.encode()).hexdigest()}"'
+        self.headers.setdefault("etag", self.etag)
+        super().set_stat_headers(stat_result)
+
+    def _Ranges(self, size: int):
+        """_Ranges - Parses the Range header into [(start, end), ...] with
+        inclusive ends. Returns None to send the whole file & [] when no
+        range can be satisfied.
+        """
+        if not self.range_header:
+            return None
+        if self.if_range and self.if_range not in (
+                self.etag, self.headers.get("last-modified")):
+            # The file changed since the client cached the first part
+            return None
+        unit, _, specs = self.range_header.partition("=")
+        if unit.strip().lower() != "bytes":
+            return None
+        ranges = []
+        for spec in specs.split(","):
+            first, dash, last = spec.strip().partition("-")
+            if not dash or not (first or last):
+                return None
+            if not (first or "0").isdigit() or not (last or "0").isdigit():
+                return None
+            if not first:
+                # Suffix range, the last N bytes
+                if int(last) == 0:
+                    continue
+                start, end = max(size - int(last), 0), size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+                if end < start:
+                    if last:
+                        # first-last with last < first is invalid
+                        return None
+                    continue
+            if start < size:
+                ranges.append((start, end))
+        if len(ranges) > MAX_RANGES:
+            return None
+        return ranges
+
+    async def __call__(self, scope, receive, send):
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(
+                    os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(self.stat_result)
+        size = self.stat_result.st_size
+        ranges = self._Ranges(size)
+
+        parts = []  # (header bytes, start, length)
+        if ranges is None:
+            self.status_code = 200
+            parts.append((b"", 0, size))
+        elif not ranges:
+            self.status_code = 416
+            self.headers["content-range"] = f"bytes */{size}"
+            self.headers["content-length"] = "0"
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            parts.append((b"", start, end - start + 1))
+        else:
+            self.status_code = 206
+            boundary = secrets.token_hex(16)
+            for start, end in ranges:
+                header = (f"--{boundary}\r\n"
+                          f"Content-Type: {self.media_type}\r\n"
+                          f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n")
+                # Each part's data ends with a CRLF before the next boundary
+                parts.append((header.encode(), start, end - start + 1))
+            self.headers["content-type"] = \
+                f"multipart/byteranges; boundary={boundary}"
+        multipart = len(parts) > 1
+        trailer = f"--{boundary}--\r\n".encode() if multipart else b""
+        if parts:
+            self.headers["content-length"] = str(
+                sum(len(h) + n + (2 if multipart else 0) for h, _, n in parts)
+                + len(trailer))
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only or not parts:
+            await send({"type": "http.response.body", "body": b"",
+                        "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, "rb") as file:
+                for i, (header, start, length) in enumerate(parts):
+                    last = i == len(parts) - 1 and not multipart
+                    if header:
+                        await send({"type": "http.response.body",
+                                    "body": header, "more_body": True})
+                    await self._SendRange(scope, send, file.wrapped, start,
+                                          length, more_body=not last)
+                    if multipart:
+                        await send({"type": "http.response.body",
+                                    "body": b"\r\n", "more_body": True})
+                if multipart:
+                    await send({"type": "http.response.body",
+                                "body": trailer, "more_body": False})
+        if self.background is not None:
+            await self.background()
+
+    async def _SendRange(self, scope, send, file, start: int, length: int,
+                         more_body: bool):
+        """_SendRange - Sends length bytes of file from start."""
+        if (self.zero_copy
+                and "http.response.zerocopysend" in scope.get("extensions", {})):
+            # The server copies the bytes from the file descriptor itself
+            await send({"type": "http.response.zerocopysend", "file": file,
+                        "offset": start, "count": length,
+                        "more_body": more_body})
+            return
+        fd = file.fileno()
+        offset, end = start, start + length
+        while True:
+            chunk = b""
+            if offset < end:
+                chunk = await anyio.to_thread.run_sync(
+                    os.pread, fd, min(self.chunk_size, end - offset), offset)
+            offset += len(chunk)
+            done = not chunk or offset >= end
+            await send({"type": "http.response.body", "body": chunk,
+                        "more_body": more_body or not done})
+            if done:
+                return
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+"""reshard.py
+
+A handy script for moving stored files into the directory layout set by
+UPLOAD_FANOUT, e.g. after upgrading from a flat upload directory.
+
+usage:
+    ./reshard.py
+    python3 reshard.py --dry-run
+
+"""
+import argparse
+import onyx.settings as settings
+
+
+# This section only runs if reshard.py is called directly
+if __name__ in '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move stored files into the UPLOAD_FANOUT layout.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Count the files that would move")
+    args = parser.parse_args()
+    moved = settings.STORAGE_DRIVER.Reshard(dry_run=args.dry_run)
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} file(s).")
@@ -0,0 +1,111 @@
+"""tests/conftest.py
+
+Shared fixtures for the Onyx Salamander CMS tests. Run them from src/:
+
+    python -m pytest tests
+"""
+import os
+import asyncio
+import sys
+
+import pytest
+
+# The application imports its packages relative to src/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onyx import settings  # noqa: E402  (loads settings before the rest)
+
+
+class RecordedResult:
+    """RecordedResult is the empty result of a statement run by
+    RecordingTx."""
+
+    async def data(self):
+        return []
+
+    async def single(self):
+        return None
+
+
+class RecordingTx:
+    """RecordingTx stands in for a Neo4j transaction and records every
+    statement & its parameters instead of running them.
+
+        Usage:
+            tx = RecordingTx()
+            await GetBlogPost(tx, UUID=uid)
+            assert tx.queries[0] == queries.GET_BLOG_POST_BY_UUID
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.parameters = []
+
+    async def run(self, query, parameters=None, **kwargs):
+        self.queries.append(query)
+        self.parameters.append(parameters or {})
+        return RecordedResult()
+
+
+@pytest.fixture
+def tx():
+    return RecordingTx()
+
+
+class SnapshotDatabase:
+    """SnapshotDatabase stands in for the driver of the background
+    reloads. Every statement returns records, once release() is called,
+    so a test can change things while a reload is reading.
+
+        Usage:
+            db = SnapshotDatabase([{"url": {...}, "redirect": None}])
+            monkeypatch.setattr(settings, "DB_DRIVER", db)
+            db.release()
+    """
+
+    def __init__(self, records, released=False):
+        self.records = records
+        self.released = released
+        self.reads = 0
+        self.gate = None
+
+    def release(self):
+        self.gate.set()
+
+    def session(self, **kwargs):
+        return _SnapshotSession(self)
+
+
+class _SnapshotSession:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def run(self, query, parameters=None, **kwargs):
+        db = self.db
+        if db.gate is None:
+            # Made on first use, inside the test's event loop
+            db.gate = asyncio.Event()
+            if db.released:
+                db.gate.set()
+        db.reads += 1
+        await db.gate.wait()
+        return _Records(db.records)
+
+
+class _Records:
+    def __init__(self, records):
+        self.records = list(records)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.records:
+            raise StopAsyncIteration
+        return self.records.pop(0)
@@ -0,0 +1,67 @@
+"""tests/test_autocomplete.py
+
+Background reloads of the autocomplete index must not replace titles the
+worker reindexed while they were reading, and a forced reload asked for
+during one must still run.
+"""
+import asyncio
+
+import pytest
+
+from onyx import settings
+from onyx.blog import autocomplete
+from onyx.blog.autocomplete import (PrefixIndex, RefreshAutocomplete,
+                                    LoadAutocomplete)
+from tests.conftest import SnapshotDatabase
+
+OLD = {"key": "post-1", "title": "Old title", "published": True,
+       "owners": [], "private": False}
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = PrefixIndex()
+    monkeypatch.setattr(autocomplete, "AUTOCOMPLETE", index)
+    monkeypatch.setattr(autocomplete, "_reload", None)
+    monkeypatch.setattr(autocomplete, "_again", False)
+    return index
+
+
+def _Titles(index, prefix):
+    return [title for _, _, title, _ in index.Search(prefix, 10)]
+
+
+def test_stale_reload_is_dropped(monkeypatch, index):
+    db = SnapshotDatabase([OLD])
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+
+    async def run():
+        load = asyncio.ensure_future(LoadAutocomplete())
+        await asyncio.sleep(0)
+        # A post is renamed while the reload is reading
+        index.Add("post", "post-1", "New title", published=True,
+                  owners=[], private=False)
+        db.release()
+        return await load
+
+    assert asyncio.run(run()) is False
+    assert _Titles(index, "title") == ["New title"]
+
+
+def test_forced_refresh_during_a_reload_runs_again(monkeypatch, index):
+    db = SnapshotDatabase([OLD])
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+
+    async def run():
+        RefreshAutocomplete(force=True)
+        await asyncio.sleep(0)
+        RefreshAutocomplete(force=True)  # e.g. a post created via /crud
+        db.release()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await autocomplete._reload
+
+    asyncio.run(run())
+    # One query per title type, for each of the two reloads
+    assert db.reads == 2 * len(autocomplete.TITLE_TYPES)
+    assert set(_Titles(index, "old")) == {"Old title"}
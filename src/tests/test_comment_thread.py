@@ -0,0 +1,61 @@
+"""tests/test_comment_thread.py
+
+/comment/thread shrinks requests until CommentThreadQuery reads at most
+COMMENT_THREAD_MAX_NODES comments. The budget is checked against the shape
+of the generated statement, so it cannot drift from what the query reads.
+"""
+import re
+import itertools
+
+import pytest
+
+from onyx.db import queries
+from onyx.blog.comment import _FitThread, MAX_THREAD_DEPTH
+
+
+def _QueryReads(depth: int, limit: int, replies: int):
+    """_QueryReads - Counts the comments CommentThreadQuery(depth) reads
+    when every comment has more replies than requested, following the
+    LIMITs and the shown guards of the statement itself."""
+    cypher = queries.CommentThreadQuery(depth)
+    limits = re.findall(r"LIMIT \$(\w+) \+ (\d+)", cypher)
+    assert len(limits) == depth
+    values = {"limit": limit, "replies": replies}
+    reads, parents = 0, 1
+    for level, (name, extra) in enumerate(limits, start=1):
+        reads += parents * (values[name] + int(extra))
+        if level < depth:
+            # Only the shown comments of a level have their replies read
+            guard = f"WITH c{level} WHERE shown{level}"
+            assert guard in cypher
+            parents *= values[name]
+    return reads
+
+
+@pytest.mark.parametrize("depth,limit,replies", [
+    (1, 20, 5), (2, 20, 5), (3, 25, 10), (5, 100, 1), (8, 20, 1)])
+def test_thread_nodes_match_the_query(depth, limit, replies):
+    assert (queries.ThreadNodes(depth, limit, replies)
+            == _QueryReads(depth, limit, replies))
+
+
+def test_fitted_threads_stay_in_budget():
+    budget = 500
+    sizes = (1, 2, 5, 20, 100, 1000)
+    for depth, limit, replies in itertools.product(
+            range(1, MAX_THREAD_DEPTH + 1), sizes, sizes):
+        fitted = _FitThread(depth, limit, replies, budget)
+        assert _QueryReads(*fitted) <= budget
+        assert all(0 < new <= old for new, old
+                   in zip(fitted, (depth, limit, replies)))
+
+
+def test_requests_in_budget_are_unchanged():
+    assert _FitThread(2, 20, 5, 500) == (2, 20, 5)
+
+
+def test_root_is_looked_up_by_label():
+    cypher = queries.CommentThreadQuery(2)
+    assert "(c0 {" not in cypher
+    for label in queries.COMMENT_ON_LABELS:
+        assert f"MATCH (c0:{label} {{UUID: $uid}})" in cypher
@@ -0,0 +1,90 @@
+"""tests/test_dedup_storage.py
+
+With DEDUPLICATE_FILES on, identical uploads are stored once under their
+digest and the repeats skip the write. A lightweight stand-in for the
+requested benchmark: a workload where most uploads repeat a few popular
+files (logos, PDFs) reports the disk & write savings against storing every
+upload.
+"""
+import os
+import time
+import random
+import asyncio
+
+from onyx import settings
+from onyx.storage.base import StorageDriver
+from onyx.blog.file import StoreUpload
+from models.user import User
+from tests.test_upload_pipeline import CountingUpload
+
+KIB = 2**10
+UPLOADS = 400
+DUPLICATE_RATIO = 0.6  # Share of uploads that repeat an earlier file
+
+
+def _Workload(seed=5):
+    """_Workload - Returns the upload contents, about DUPLICATE_RATIO of
+    them repeating one of a few popular files."""
+    rng = random.Random(seed)
+    popular = [rng.randbytes(rng.randint(4, 256) * KIB) for _ in range(20)]
+    uploads = []
+    for i in range(UPLOADS):
+        if rng.random() < DUPLICATE_RATIO:
+            uploads.append(rng.choice(popular))
+        else:
+            uploads.append(rng.randbytes(rng.randint(4, 256) * KIB))
+    return uploads
+
+
+def _DiskBytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names)
+
+
+def _Run(monkeypatch, tmp_path, deduplicate):
+    """_Run - Stores the workload, returns (disk bytes, bytes written,
+    writes, seconds, attributes)."""
+    driver = StorageDriver(str(tmp_path / str(deduplicate)))
+    monkeypatch.setattr(settings, "STORAGE_DRIVER", driver)
+    monkeypatch.setattr(settings, "DEDUPLICATE_FILES", deduplicate)
+    written = []
+    write_file = driver.WriteFile
+
+    async def counting(filename, file, **kwargs):
+        size = await write_file(filename, file, **kwargs)
+        written.append(size)
+        return size
+
+    monkeypatch.setattr(driver, "WriteFile", counting)
+
+    async def run():
+        user = User.construct(UUID="user")
+        return [await StoreUpload(CountingUpload(data), user)
+                for data in _Workload()]
+
+    start = time.perf_counter()
+    attributes = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    return (_DiskBytes(driver.upload_dir), sum(written), len(written),
+            elapsed, attributes)
+
+
+def test_duplicate_uploads_are_stored_once(monkeypatch, tmp_path):
+    uploads = _Workload()
+    unique = {data: len(data) for data in uploads}
+    plain_disk, plain_written, plain_writes, plain_time, _ = _Run(
+        monkeypatch, tmp_path, False)
+    disk, written, writes, elapsed, attributes = _Run(
+        monkeypatch, tmp_path, True)
+    print(f"dedup: {UPLOADS} uploads, {len(unique)} unique, disk "
+          f"{plain_disk // KIB} -> {disk // KIB} KiB "
+          f"({1 - disk / plain_disk:.0%} saved), writes {plain_writes} -> "
+          f"{writes}, {plain_time:.2f}s -> {elapsed:.2f}s")
+    assert plain_disk == plain_written == sum(map(len, uploads))
+    # Each distinct content is written & kept once
+    assert writes == len(unique)
+    assert disk == written == sum(unique.values())
+    # Every File points at the blob of its content
+    assert all(a["Blob"] == a["Hash"] for a in attributes)
+    assert len({a["Blob"] for a in attributes}) == len(unique)
+    assert disk < plain_disk * (1 - DUPLICATE_RATIO / 2)
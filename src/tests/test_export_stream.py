@@ -0,0 +1,104 @@
+"""tests/test_export_stream.py
+
+NDJSON exports must keep memory flat however many records they write, and
+only read ahead of the client by a chunk. A lightweight stand-in for the
+requested peak RSS benchmark: tracemalloc measures the peak Python memory
+of an export at growing sizes.
+"""
+import json
+import asyncio
+import tracemalloc
+
+import pytest
+
+from onyx import settings
+from onyx.crud.core import export_nodes
+
+
+class LazyDatabase:
+    """LazyDatabase stands in for the driver of an export, its result makes
+    each node record when the export asks for it."""
+
+    def __init__(self, count):
+        self.count = count
+        self.pulled = 0
+
+    def session(self, **kwargs):
+        return _LazySession(self)
+
+
+class _LazySession:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def run(self, query, parameters=None):
+        return self._Records()
+
+    async def _Records(self):
+        for i in range(self.db.count):
+            self.db.pulled += 1
+            yield {"id": i, "labels": ["Page"],
+                   "node": {"UUID": f"uuid-{i}", "Title": "x" * 200}}
+
+
+def _Export(monkeypatch, count):
+    """_Export - Streams count nodes, returns (lines, peak bytes)."""
+    monkeypatch.setattr(settings, "DB_DRIVER", LazyDatabase(count))
+
+    async def run():
+        lines = 0
+        response = await export_nodes(current_user=None)
+        async for chunk in response.body_iterator:
+            lines += chunk.count("\n")
+        return lines
+
+    tracemalloc.start()
+    try:
+        lines = asyncio.run(run())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return lines, peak
+
+
+def test_peak_memory_stays_flat_as_exports_grow(monkeypatch):
+    peaks = {}
+    for count in (1000, 5000, 20000):
+        lines, peak = _Export(monkeypatch, count)
+        assert lines == count
+        peaks[count] = peak
+    print("export peak bytes by records:", peaks)
+    # 20 times the records, the peak stays within the noise of one chunk
+    assert peaks[20000] < peaks[1000] * 1.5
+
+
+def test_export_reads_one_chunk_ahead_of_the_client(monkeypatch):
+    db = LazyDatabase(10 * settings.EXPORT_CHUNK_SIZE)
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+
+    async def run():
+        response = await export_nodes(current_user=None)
+        body = response.body_iterator
+        first = await body.__anext__()
+        pulled = db.pulled
+        await body.aclose()
+        return first, pulled
+
+    first, pulled = asyncio.run(run())
+    lines = first.splitlines()
+    assert len(lines) == settings.EXPORT_CHUNK_SIZE
+    assert json.loads(lines[0])["UUID"] == "uuid-0"
+    # Nothing past the first chunk is read until the client takes it
+    assert pulled == settings.EXPORT_CHUNK_SIZE
+
+
+@pytest.mark.parametrize("count", [0, 1, settings.EXPORT_CHUNK_SIZE + 1])
+def test_every_record_is_one_line(monkeypatch, count):
+    lines, _ = _Export(monkeypatch, count)
+    assert lines == count
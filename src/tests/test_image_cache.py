@@ -0,0 +1,89 @@
+"""tests/test_image_cache.py
+
+The image derivative cache is indexed from disk in a worker thread but only
+changed on the event loop, and evicted derivatives are deleted off it.
+"""
+import os
+import asyncio
+import threading
+
+import pytest
+
+from onyx import settings
+from onyx.blog import image
+from onyx.cache import TTLCache
+from onyx.storage.base import PARTIAL_SUFFIX
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "IMAGE_CACHE_DIR", str(tmp_path))
+    cache = TTLCache(maxsize=10, ttl=float("inf"), weigh=lambda size: size,
+                     evict=image._Evict)
+    monkeypatch.setattr(image, "IMAGE_CACHE", cache)
+    monkeypatch.setattr(image, "_cache_loaded", False)
+    return cache
+
+
+def _Write(directory, name, size, mtime):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as out:
+        out.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _Drain():
+    # Wait for the queued deletions
+    image.EVICT_POOL.submit(lambda: None).result()
+
+
+def test_load_indexes_on_the_loop_and_cleans_up(monkeypatch, cache):
+    directory = settings.IMAGE_CACHE_DIR
+    _Write(directory, "old.webp", 4, 1)
+    _Write(directory, "new.webp", 4, 2)
+    big = _Write(directory, "big.webp", 11, 3)
+    partial = _Write(directory, "a.webp" + PARTIAL_SUFFIX, 1, 4)
+    loop_threads = set()
+    set_entry = cache.Set
+
+    def record(*args, **kwargs):
+        loop_threads.add(threading.get_ident())
+        return set_entry(*args, **kwargs)
+
+    monkeypatch.setattr(cache, "Set", record)
+
+    async def run():
+        main = threading.get_ident()
+        # Concurrent first requests share one scan
+        await asyncio.gather(*(image.IMAGE_FLIGHT.Do(
+            ("load",), image._LoadImageCache) for _ in range(3)))
+        return main
+
+    main = asyncio.run(run())
+    _Drain()
+    assert loop_threads == {main}
+    assert image._cache_loaded
+    assert cache.size == 8
+    assert cache.Get("old.webp")[0] and cache.Get("new.webp")[0]
+    assert not os.path.exists(big) and not os.path.exists(partial)
+
+
+def test_evictions_are_deleted_off_the_loop(monkeypatch, cache):
+    directory = settings.IMAGE_CACHE_DIR
+    first = _Write(directory, "first.webp", 6, 1)
+    _Write(directory, "second.webp", 6, 2)
+    removed_in = []
+    remove = os.remove
+
+    def record(path):
+        removed_in.append(threading.current_thread().name)
+        remove(path)
+
+    monkeypatch.setattr(image.os, "remove", record)
+    cache.Set("first.webp", 6)
+    cache.Set("second.webp", 6)  # Pushes out first.webp
+    _Drain()
+    assert not os.path.exists(first)
+    assert len(removed_in) == 1
+    assert removed_in[0].startswith("image-evict")
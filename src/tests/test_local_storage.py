@@ -0,0 +1,87 @@
+"""tests/test_local_storage.py
+
+StorageDriver.ListFiles walks the upload directory lazily and in a stable
+order, resumes after any name, and lists files of the flat layout that
+were not resharded yet in the place Reshard will move them to.
+"""
+import os
+import uuid
+import random
+from itertools import islice
+
+import pytest
+
+from onyx.storage.base import StorageDriver, PARTIAL_SUFFIX
+
+_rng = random.Random(7)
+NAMES = sorted(str(uuid.UUID(int=_rng.getrandbits(128))) for _ in range(300))
+
+
+def _Store(driver, names):
+    for name in names:
+        path = os.path.join(driver.upload_dir, *driver._Parts(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            out.write(b"x")
+
+
+def _Order(driver, names):
+    return sorted(names, key=driver._Parts)
+
+
+def _Pages(driver, size):
+    """_Pages - Lists every file size at a time, resuming after the last
+    name of each page."""
+    listed, after = [], None
+    while True:
+        page = list(islice(driver.ListFiles(after=after), size))
+        if not page:
+            return listed
+        listed.extend(page)
+        after = page[-1]
+
+
+@pytest.mark.parametrize("fanout", [0, 1, 2])
+def test_listing_is_ordered_and_resumable(tmp_path, fanout):
+    driver = StorageDriver(str(tmp_path), fanout=fanout)
+    _Store(driver, NAMES)
+    with open(os.path.join(str(tmp_path), "upload" + PARTIAL_SUFFIX),
+              "wb") as out:
+        out.write(b"x")
+    expected = _Order(driver, NAMES)
+    assert list(driver.ListFiles()) == expected
+    assert _Pages(driver, 7) == expected
+    assert list(driver.ListFiles(after=expected[100])) == expected[101:]
+
+
+def test_listing_reads_shards_only_when_it_gets_to_them(tmp_path,
+                                                        monkeypatch):
+    driver = StorageDriver(str(tmp_path), fanout=2)
+    _Store(driver, NAMES)
+    scanned = []
+    scandir = os.scandir
+
+    def recording(path):
+        scanned.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", recording)
+    files = driver.ListFiles()
+    assert scanned == []
+    first = next(files)
+    # The top, one shard of each level, nothing else
+    assert len(scanned) == 3
+    assert first == _Order(driver, NAMES)[0]
+
+
+def test_flat_files_are_listed_where_they_will_be_sharded(tmp_path):
+    flat = StorageDriver(str(tmp_path), fanout=0)
+    _Store(flat, NAMES[::2])
+    sharded = StorageDriver(str(tmp_path), fanout=2)
+    _Store(sharded, NAMES[1::2])
+    expected = _Order(sharded, NAMES)
+    assert list(sharded.ListFiles()) == expected
+    assert _Pages(sharded, 11) == expected
+    # Resharding changes where the files are, not the listing
+    assert sharded.Reshard() == len(NAMES[::2])
+    assert list(sharded.ListFiles()) == expected
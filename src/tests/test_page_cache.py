@@ -0,0 +1,150 @@
+"""tests/test_page_cache.py
+
+The public page route answers repeat visits from PAGE_CACHE and matching
+If-None-Match headers with 304, without touching the database, and an
+invalidation only drops the page it names. A lightweight stand-in for the
+requested benchmark: a skewed workload reports the hit rate & latency of
+hits and misses against a database that takes a few milliseconds a read.
+"""
+import time
+import random
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+from onyx import settings
+from onyx.blog import page
+from onyx.cache import TTLCache
+from onyx.db.session import UnitOfWork
+
+URLS = [f"page-{i}" for i in range(50)]
+
+
+class PageDatabase:
+    """PageDatabase stands in for the driver, each read of a page takes
+    delay seconds and is counted by URL."""
+
+    def __init__(self, delay=0.002):
+        self.delay = delay
+        self.reads = {}
+
+    def session(self, **kwargs):
+        return _PageSession(self)
+
+
+class _PageSession:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute_read(self, work, *args, **kwargs):
+        return await work(self, *args, **kwargs)
+
+    async def run(self, query, parameters=None, **kwargs):
+        url = parameters["url"]
+        self.db.reads[url] = self.db.reads.get(url, 0) + 1
+        await asyncio.sleep(self.db.delay)
+        return _PageResult(url)
+
+
+class _PageResult:
+    def __init__(self, url):
+        self.url = url
+
+    async def data(self):
+        return [{"page": {"Title": self.url, "Headline": "Hello",
+                          "Language": "en", "PageType": "page",
+                          "URL": self.url, "Intro": "x" * 500}}]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = PageDatabase()
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    monkeypatch.setattr(page, "PAGE_CACHE", TTLCache(
+        maxsize=2**20, ttl=60, weigh=lambda entry: len(entry[1])))
+    monkeypatch.setattr(page, "_generations", {})
+    monkeypatch.setattr(page, "RefreshRouting", lambda: None)
+    return db
+
+
+def _Request(url, etag=None):
+    headers = [(b"if-none-match", etag.encode())] if etag else []
+    return Request({"type": "http", "method": "GET", "path": "/" + url,
+                    "query_string": b"", "headers": headers})
+
+
+async def _Serve(url, etag=None):
+    return await page.serve_page(url, _Request(url, etag),
+                                 uow=UnitOfWork(None))
+
+
+def test_hit_rate_and_latency_under_a_skewed_workload(db):
+    rng = random.Random(11)
+    # Zipf-like popularity, a few pages get most of the visits
+    weights = [1 / (rank + 1) for rank in range(len(URLS))]
+    etags = {}
+    timings = {"hit": [], "miss": [], "304": []}
+
+    async def run(requests):
+        for _ in range(requests):
+            url = rng.choices(URLS, weights)[0]
+            # Returning visitors send the ETag they were given
+            etag = etags.get(url) if rng.random() < 0.3 else None
+            reads = db.reads.get(url, 0)
+            start = time.perf_counter()
+            response = await _Serve(url, etag)
+            elapsed = time.perf_counter() - start
+            if response.status_code == 304:
+                timings["304"].append(elapsed)
+            elif db.reads.get(url, 0) > reads:
+                timings["miss"].append(elapsed)
+            else:
+                timings["hit"].append(elapsed)
+            etags[url] = response.headers["etag"]
+
+    requests = 3000
+    asyncio.run(run(requests))
+    reads = sum(db.reads.values())
+    hit_rate = 1 - reads / requests
+
+    def mean(values):
+        return sum(values) / len(values) * 1000
+
+    print(f"page cache: {requests} requests, {reads} reads, hit rate "
+          f"{hit_rate:.3f}, mean ms: miss {mean(timings['miss']):.3f} "
+          f"hit {mean(timings['hit']):.3f} 304 {mean(timings['304']):.3f}")
+    # Every page is read once, after that it is served from the cache
+    assert max(db.reads.values()) == 1
+    assert hit_rate > 0.95
+    assert timings["304"]
+    assert mean(timings["hit"]) * 5 < mean(timings["miss"])
+    assert mean(timings["304"]) * 5 < mean(timings["miss"])
+
+
+def test_not_modified_does_not_touch_the_database(db):
+    async def run():
+        etag = (await _Serve("page-1")).headers["etag"]
+        return await _Serve("page-1", etag)
+
+    response = asyncio.run(run())
+    assert response.status_code == 304
+    assert db.reads == {"page-1": 1}
+
+
+def test_invalidation_only_drops_the_page_it_names(db):
+    async def run():
+        for url in URLS[:3]:
+            await _Serve(url)
+        page.InvalidatePage("page-1")
+        for url in URLS[:3]:
+            await _Serve(url)
+
+    asyncio.run(run())
+    assert db.reads == {"page-0": 1, "page-1": 2, "page-2": 1}
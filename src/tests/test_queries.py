@@ -0,0 +1,119 @@
+"""tests/test_queries.py
+
+The query layer must keep the text of every statement independent of the
+values in it, so Neo4j compiles a bounded set of plans and user input can
+never change a query.
+"""
+import uuid
+import random
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from onyx.db import queries
+from onyx.db.pagination import ReadPage, EncodeCursor
+from onyx.blog.post import GetBlogPost
+from onyx.blog.page import GetPage
+from onyx.blog.url import GetURL
+from onyx.blog.file import GetFileFromDB
+from models.user import User
+
+# Values that would change the query text if they were spliced into it
+HOSTILE = ["' OR 1=1 //", '"}) DETACH DELETE n //', "`x`", "$uid", "{}"]
+LABELS = ["BlogPost", "Page", "Widget"]
+LIST_QUERIES = ([queries.LIST_PAGES, queries.LIST_FILES, queries.LIST_URLS,
+                 queries.LIST_NODES, queries.LIST_COMMENTS]
+                + list(queries.LIST_BLOG_POSTS.values())
+                + list(queries.LIST_TAGS.values()))
+
+
+def _Value(rng):
+    if rng.random() < 0.2:
+        return rng.choice(HOSTILE)
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+async def _Request(tx, rng):
+    """_Request - Runs the queries of one random request in tx, returns
+    the values it passed."""
+    value = _Value(rng)
+    user = User.construct(UUID=_Value(rng), Admin=rng.random() < 0.5)
+    kind = rng.randrange(7)
+    if kind == 0:
+        await GetBlogPost(tx, **{rng.choice(["UUID", "title"]): value},
+                          user=user)
+    elif kind == 1:
+        await GetPage(tx, **{rng.choice(["url", "title"]): value})
+    elif kind == 2:
+        await GetURL(tx, value)
+    elif kind == 3:
+        with pytest.raises(HTTPException):
+            await GetFileFromDB(tx, UUID=value)
+    elif kind == 4:
+        cursor = None
+        if rng.random() < 0.5:
+            cursor = EncodeCursor([value, _Value(rng)], rng.random() < 0.5)
+        await ReadPage(tx, rng.choice(LIST_QUERIES), {"uid": value},
+                       cursor, rng.randint(1, 100))
+    elif kind == 5:
+        label = queries.ValidateLabel(rng.choice(LABELS), create=True)
+        attributes = {"Title": value}
+        queries.ValidatePropertyKeys(attributes)
+        await tx.run(query=queries.CreateNodeQuery(label),
+                     parameters={"attributes": attributes, "uid": value})
+    else:
+        await tx.run(query=queries.CommentThreadQuery(rng.randint(1, 8)),
+                     parameters={"uid": value})
+    return value, user.UUID
+
+
+def test_distinct_queries_stay_bounded(tx):
+    rng = random.Random(2)
+    values = []
+
+    async def workload(requests):
+        for _ in range(requests):
+            values.extend(await _Request(tx, rng))
+
+    asyncio.run(workload(2000))
+    seen = set(tx.queries)
+    asyncio.run(workload(8000))
+    # Five times more requests with new values add no new statements
+    assert set(tx.queries) == seen
+    # One statement per lookup, per keyset direction, per label & depth
+    assert len(seen) <= (2 + 2 + 1 + 1 + 3 * len(LIST_QUERIES)
+                         + len(LABELS) + 8)
+    for value in set(values) - set(HOSTILE):
+        assert not any(value in query for query in seen)
+
+
+def test_hostile_values_never_reach_the_query_text(tx):
+    async def workload():
+        for value in HOSTILE:
+            await GetBlogPost(tx, title=value)
+            await GetPage(tx, url=value)
+            await GetURL(tx, value)
+
+    asyncio.run(workload())
+    # "$uid" & "{}" are valid Cypher on their own, only the rest must not
+    # show up
+    for query in tx.queries:
+        assert not any(value in query for value in HOSTILE[:3])
+    assert [p.get("title") or p.get("url") for p in tx.parameters] \
+        == [value for value in HOSTILE for _ in range(3)]
+
+
+@pytest.mark.parametrize("label", ["Page) DETACH DELETE (n", "Page`", "",
+                                   "User"])
+def test_labels_are_validated(label):
+    with pytest.raises(HTTPException) as error:
+        queries.ValidateLabel(label, create=True)
+    assert error.value.status_code == 422
+
+
+def test_base_properties_are_rejected():
+    with pytest.raises(HTTPException):
+        queries.ValidatePropertyKeys({"created_by": "someone"})
+    with pytest.raises(HTTPException):
+        queries.ValidatePropertyKeys({"Title}) DELETE (n": "x"})
@@ -0,0 +1,69 @@
+"""tests/test_routing.py
+
+Background reloads of the routing table must not replace changes the
+worker made while they were reading, and a forced reload asked for during
+one must still run.
+"""
+import asyncio
+
+import pytest
+
+from onyx import settings
+from onyx.blog import routing
+from onyx.blog.routing import RoutingTable, RefreshRouting, LoadRouting
+from models.page import URI
+from tests.conftest import SnapshotDatabase
+
+OLD = {"url": {"URL": "old"}, "redirect": None}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = RoutingTable()
+    monkeypatch.setattr(routing, "ROUTING", table)
+    monkeypatch.setattr(routing, "_reload", None)
+    monkeypatch.setattr(routing, "_again", False)
+    return table
+
+
+def test_stale_reload_is_dropped(monkeypatch, table):
+    db = SnapshotDatabase([OLD])
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+
+    async def run():
+        load = asyncio.ensure_future(LoadRouting())
+        await asyncio.sleep(0)
+        # A page moves while the reload is reading
+        table.Set(URI(URL="new"))
+        db.release()
+        return await load
+
+    assert asyncio.run(run()) is False
+    assert table.Get("new") is not None
+    assert table.Get("old") is None
+
+
+def test_reload_without_changes_replaces_the_table(monkeypatch, table):
+    db = SnapshotDatabase([OLD], released=True)
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    assert asyncio.run(LoadRouting()) is True
+    assert table.Get("old") is not None and table.loaded
+
+
+def test_forced_refresh_during_a_reload_runs_again(monkeypatch, table):
+    db = SnapshotDatabase([OLD])
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+
+    async def run():
+        RefreshRouting(force=True)
+        await asyncio.sleep(0)
+        RefreshRouting(force=True)  # e.g. a URL created through /crud
+        assert db.reads == 1
+        db.release()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await routing._reload
+
+    asyncio.run(run())
+    assert db.reads == 2
+    assert table.Get("old") is not None
@@ -0,0 +1,121 @@
+"""tests/test_s3_storage.py
+
+S3StorageDriver against moto's in-memory S3. Skipped unless boto3 & moto
+are installed (pip install -r requirements-dev.txt).
+"""
+import asyncio
+import hashlib
+from urllib.parse import unquote
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from onyx.storage.errors import FileExists  # noqa: E402
+from onyx.storage.backends.s3boto3 import (S3StorageDriver,  # noqa: E402
+                                           MIN_PART_SIZE)
+
+# moto 5 mocks every service with mock_aws, older versions one at a time
+mock_aws = getattr(moto, "mock_aws", None) or moto.mock_s3
+BUCKET = "onyx-test"
+
+
+class Upload:
+    """Upload stands in for an UploadFile, optionally failing once fail_at
+    bytes have been read."""
+
+    def __init__(self, data: bytes, fail_at=None):
+        self.data = data
+        self.offset = 0
+        self.fail_at = fail_at
+        self.content_type = "application/octet-stream"
+
+    async def read(self, size=-1):
+        if self.fail_at is not None and self.offset >= self.fail_at:
+            raise ConnectionResetError("Client went away")
+        end = len(self.data) if size < 0 else self.offset + size
+        chunk = self.data[self.offset:end]
+        self.offset += len(chunk)
+        return chunk
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1",
+                              aws_access_key_id="test",
+                              aws_secret_access_key="test")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def driver(s3):
+    return S3StorageDriver(BUCKET, prefix="uploads/", client=s3,
+                           part_size=MIN_PART_SIZE, concurrency=2)
+
+
+def _Content(s3, key):
+    return s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_small_uploads_are_put_whole(s3, driver):
+    digest = hashlib.sha256()
+    size = asyncio.run(driver.WriteFile("small", Upload(b"hello"),
+                                        digest=digest))
+    assert size == 5
+    assert _Content(s3, "uploads/small") == b"hello"
+    assert digest.hexdigest() == hashlib.sha256(b"hello").hexdigest()
+    assert driver.Exists("small")
+    with pytest.raises(FileExists):
+        asyncio.run(driver.WriteFile("small", Upload(b"again")))
+
+
+def test_large_uploads_are_sent_in_parts(s3, driver):
+    data = bytes(range(256)) * (MIN_PART_SIZE * 2 // 256) + b"tail"
+    digest = hashlib.sha256()
+    size = asyncio.run(driver.WriteFile("large", Upload(data),
+                                        digest=digest))
+    assert size == len(data)
+    assert _Content(s3, "uploads/large") == data
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+    # Three parts: two full ones and the tail
+    head = s3.head_object(Bucket=BUCKET, Key="uploads/large")
+    assert head["ETag"].strip('"').endswith("-3")
+
+
+def test_failed_multipart_uploads_are_aborted(s3, driver):
+    upload = Upload(b"x" * (MIN_PART_SIZE * 3), fail_at=MIN_PART_SIZE * 2)
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(driver.WriteFile("broken", upload))
+    assert not driver.Exists("broken")
+    pending = s3.list_multipart_uploads(Bucket=BUCKET)
+    assert not pending.get("Uploads")
+
+
+def test_delete(s3, driver):
+    s3.put_object(Bucket=BUCKET, Key="uploads/gone", Body=b"x")
+    driver.DeleteFile("gone")
+    assert not driver.Exists("gone")
+    with pytest.raises(FileNotFoundError):
+        driver.DeleteFile("gone")
+
+
+def test_listing_pages_through_the_bucket(s3, driver):
+    names = [f"file-{i:04d}" for i in range(1005)]  # More than one page
+    for name in names:
+        s3.put_object(Bucket=BUCKET, Key="uploads/" + name, Body=b"")
+    s3.put_object(Bucket=BUCKET, Key="elsewhere/file", Body=b"")
+    assert list(driver.ListFiles()) == names
+    assert list(driver.ListFiles(after="file-0999")) == names[1000:]
+
+
+def test_downloads_redirect_to_a_presigned_url(s3, driver):
+    s3.put_object(Bucket=BUCKET, Key="uploads/doc", Body=b"x")
+    response = driver.ReadFile("doc", db_name="report.pdf")
+    assert response.status_code == 307
+    url = unquote(response.headers["location"])
+    assert f"{BUCKET}" in url and "uploads/doc" in url
+    assert "Signature" in url
+    assert 'filename="report.pdf"' in url
@@ -0,0 +1,101 @@
+"""tests/test_search.py
+
+/search must answer from the full-text indexes a page at a time, so its
+cost does not grow with the corpus. A lightweight stand-in for the
+requested 1M post benchmark, which needs a Neo4j server: the statements
+are checked to seek the indexes and page with LIMIT, and the latency the
+app adds per page (paging, models & highlighting) is measured over a
+synthetic corpus of long posts.
+"""
+import time
+import random
+import asyncio
+
+import pytest
+
+from onyx.db import queries
+from onyx.db.session import UnitOfWork
+from onyx.blog.search import search, SEARCH_TYPES
+from models.user import User
+
+WORDS = ["graph", "database", "neo4j", "cypher", "index", "query", "node",
+         "relationship", "latency", "cache", "page", "blog", "search"]
+
+
+def _Corpus(size, rng):
+    """_Corpus - Returns size synthetic posts of about 3000 words."""
+    return [{"UUID": f"post-{i}", "Title": " ".join(rng.choices(WORDS, k=6)),
+             "Content": " ".join(rng.choices(WORDS, k=3000)),
+             "Published": True, "Owner": "user-1", "Creator": "user-1"}
+            for i in range(size)]
+
+
+class IndexSession:
+    """IndexSession stands in for the database, it answers a search with
+    the number of hits the statement asks for, like a top-k index read."""
+
+    def __init__(self, corpus, rng):
+        self.corpus = corpus
+        self.rng = rng
+        self.limits = []
+
+    async def execute_read(self, work, *args, **kwargs):
+        return await work(self, *args, **kwargs)
+
+    async def run(self, query, parameters=None, **kwargs):
+        limit = parameters["limit"]
+        self.limits.append(limit)
+        records = []
+        for rank, node in enumerate(self.rng.sample(self.corpus, limit)):
+            score = 10.0 - rank / limit
+            records.append({"node": node, "score": score, "type": "post",
+                            "cursor": [-score, rank]})
+        return _IndexResult(records)
+
+
+class _IndexResult:
+    def __init__(self, records):
+        self.records = records
+
+    async def data(self):
+        return self.records
+
+
+@pytest.mark.parametrize("types", [("post",), ("page",), SEARCH_TYPES])
+def test_statements_seek_the_fulltext_indexes(types):
+    for statement in queries.SearchQuery(types):
+        assert statement.count("db.index.fulltext.queryNodes") == len(types)
+        # No label scan of posts or pages next to the index reads
+        assert "MATCH (post" not in statement
+        assert "MATCH (page" not in statement
+        assert statement.rstrip().endswith("LIMIT $limit")
+
+
+def test_app_latency_per_page_of_hits():
+    rng = random.Random(3)
+    corpus = _Corpus(2000, rng)
+    session = IndexSession(corpus, rng)
+    user = User.construct(UUID="user-1", Admin=False)
+    timings = []
+
+    async def run(requests):
+        for _ in range(requests):
+            q = " ".join(rng.sample(WORDS, 2)) + "*"
+            start = time.perf_counter()
+            results = await search(q, types=None, published=None, limit=25,
+                                   cursor=None, user=user,
+                                   uow=UnitOfWork(session))
+            timings.append(time.perf_counter() - start)
+            assert len(results.Hits) == 25
+            assert "<mark>" in results.Hits[0].Highlights["Content"]
+
+    asyncio.run(run(200))
+    timings.sort()
+    p50 = timings[len(timings) // 2] * 1000
+    p95 = timings[int(len(timings) * 0.95)] * 1000
+    print(f"search: 200 pages of 25 over {len(corpus)} posts of 3000 "
+          f"words, app p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+    # Only the page (and the one record that tells if there is another) is
+    # ever read, however many posts match
+    assert set(session.limits) == {26}
+    assert p95 < 100
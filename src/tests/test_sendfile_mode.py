@@ -0,0 +1,70 @@
+"""tests/test_sendfile_mode.py
+
+With SENDFILE_MODE the app answers a download with a header naming the
+file and the reverse proxy sends the bytes. A lightweight stand-in for the
+requested benchmark: it compares the worker CPU time per download of an
+8 MiB file streamed by the app against handing it to the proxy.
+"""
+import os
+import time
+import asyncio
+
+import pytest
+
+from onyx.storage.base import StorageDriver
+
+MIB = 2**20
+DOWNLOADS = 20
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    with open(tmp_path / "file-1", "wb") as out:
+        out.write(os.urandom(8 * MIB))
+    return str(tmp_path)
+
+
+def _Download(driver, count=DOWNLOADS):
+    """_Download - Sends the file count times to a client that takes every
+    chunk at once, returns (CPU seconds per download, body bytes, headers).
+    """
+    sent = {"body": 0, "headers": {}}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            sent["headers"] = {k.decode(): v.decode()
+                               for k, v in message["headers"]}
+        else:
+            sent["body"] += len(message.get("body", b""))
+
+    async def run():
+        scope = {"type": "http", "method": "GET", "headers": []}
+        for _ in range(count):
+            response = driver.ReadFile("file-1", db_name="report.pdf",
+                                       etag="abc")
+            await response(scope, None, send)
+
+    start = time.process_time()
+    asyncio.run(run())
+    cpu = (time.process_time() - start) / count
+    return cpu, sent["body"] // count, sent["headers"]
+
+
+def test_proxy_modes_use_less_worker_cpu_per_download(upload_dir):
+    app_cpu, app_body, _ = _Download(StorageDriver(upload_dir))
+    accel_cpu, accel_body, accel = _Download(StorageDriver(
+        upload_dir, sendfile="x-accel-redirect",
+        sendfile_prefix="/protected-uploads/"))
+    sendfile_cpu, sendfile_body, sendfile = _Download(StorageDriver(
+        upload_dir, sendfile="x-sendfile"))
+    print(f"CPU ms per 8 MiB download: app {app_cpu * 1000:.2f}, "
+          f"x-accel-redirect {accel_cpu * 1000:.3f}, "
+          f"x-sendfile {sendfile_cpu * 1000:.3f}")
+    assert app_body == 8 * MIB
+    # The proxy sends the bytes, the worker only answers with headers
+    assert accel_body == sendfile_body == 0
+    assert accel["x-accel-redirect"] == "/protected-uploads/file-1"
+    assert sendfile["x-sendfile"] == os.path.join(upload_dir, "file-1")
+    assert accel["etag"] == '"abc"'
+    assert 'filename="report.pdf"' in accel["content-disposition"]
+    assert accel_cpu * 5 < app_cpu and sendfile_cpu * 5 < app_cpu
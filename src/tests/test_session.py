@@ -0,0 +1,164 @@
+"""tests/test_session.py
+
+UnitOfWork runs its work in managed transactions, which the driver retries
+on transient errors using the DB_RETRY_* settings. A stand-in database that
+fails on purpose replaces the connection, the driver's own retry loop runs
+unchanged.
+"""
+import asyncio
+
+import pytest
+from neo4j import READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import TransientError, ServiceUnavailable, ClientError
+
+from onyx import settings
+from onyx.db.driver import OpenDriver, CloseDriver
+from onyx.db.session import UnitOfWork
+from tests.conftest import RecordedResult
+
+
+class FlakyDatabase:
+    """FlakyDatabase fails the first failures transactions with error,
+    when they run a statement or when they commit, and records every
+    transaction it begins.
+
+        Usage:
+            db = FlakyDatabase(failures=2)
+            db.Attach(session)
+    """
+
+    def __init__(self, failures=0, error=None, on="commit"):
+        self.failures = failures
+        self.error = error or TransientError.hydrate(
+            code="Neo.TransientError.Transaction.DeadlockDetected",
+            message="Deadlock detected")
+        self.on = on
+        self.modes = []  # Access mode of every transaction begun
+        self.commits = 0
+
+    def Attach(self, session):
+        """Attach - Makes session open its transactions here instead of on
+        a connection."""
+        async def open_transaction(*, tx_cls, access_mode, **kwargs):
+            self.modes.append(access_mode)
+            session._transaction = FlakyTransaction(self)
+        session._open_transaction = open_transaction
+
+    def Fail(self, on):
+        if on == self.on and self.failures:
+            self.failures -= 1
+            raise self.error
+
+
+class FlakyTransaction:
+    def __init__(self, db):
+        self.db = db
+
+    async def run(self, query, parameters=None, **kwargs):
+        self.db.Fail("run")
+        return RecordedResult()
+
+    async def _commit(self):
+        self.db.Fail("commit")
+        self.db.commits += 1
+
+    async def _close(self):
+        pass
+
+    def _closed(self):
+        return True
+
+
+@pytest.fixture
+def retries(monkeypatch):
+    """Short retry delays, so the tests do not wait on backoff."""
+    monkeypatch.setattr(settings, "DB_DRIVER", None)
+    monkeypatch.setattr(settings, "DB_DRIVER_CONFIG", {})
+    monkeypatch.setattr(settings, "DB_RETRY_TIME", 0.5)
+    monkeypatch.setattr(settings, "DB_RETRY_DELAY", 0.001)
+    monkeypatch.setattr(settings, "DB_RETRY_MULTIPLIER", 1.0)
+    monkeypatch.setattr(settings, "DB_RETRY_JITTER", 0.0)
+
+
+def _Run(db, method, work):
+    """_Run - Runs work through UnitOfWork.method against db, returns its
+    result or error."""
+    async def run():
+        driver = await OpenDriver()
+        try:
+            async with driver.session() as session:
+                db.Attach(session)
+                return await getattr(UnitOfWork(session), method)(work)
+        finally:
+            await CloseDriver()
+    return asyncio.run(run())
+
+
+def _Work():
+    """_Work - A transaction function that counts its attempts."""
+    async def work(tx):
+        work.attempts += 1
+        await tx.run("RETURN 1")
+        return "done"
+    work.attempts = 0
+    return work
+
+
+@pytest.mark.parametrize("method,mode", [("Read", READ_ACCESS),
+                                         ("Write", WRITE_ACCESS)])
+def test_transient_errors_are_retried(retries, method, mode):
+    db = FlakyDatabase(failures=3)
+    work = _Work()
+    assert _Run(db, method, work) == "done"
+    assert work.attempts == 4
+    assert db.commits == 1
+    assert db.modes == [mode] * 4
+
+
+def test_lost_connections_are_retried(retries):
+    db = FlakyDatabase(failures=2, on="run",
+                       error=ServiceUnavailable("Connection lost"))
+    work = _Work()
+    assert _Run(db, "Write", work) == "done"
+    assert work.attempts == 3
+    assert db.commits == 1
+
+
+def test_client_errors_are_not_retried(retries):
+    db = FlakyDatabase(failures=1, on="run", error=ClientError.hydrate(
+        code="Neo.ClientError.Statement.SyntaxError", message="Bad query"))
+    work = _Work()
+    with pytest.raises(ClientError):
+        _Run(db, "Write", work)
+    assert work.attempts == 1
+    assert db.commits == 0
+
+
+def test_retries_stop_after_retry_time(retries, monkeypatch):
+    monkeypatch.setattr(settings, "DB_RETRY_TIME", 0.05)
+    monkeypatch.setattr(settings, "DB_RETRY_DELAY", 0.01)
+    db = FlakyDatabase(failures=10**6)
+    work = _Work()
+    with pytest.raises(TransientError):
+        _Run(db, "Write", work)
+    assert 1 < work.attempts < 100
+    assert db.commits == 0
+
+
+def test_retry_settings_reach_the_driver(retries, monkeypatch):
+    monkeypatch.setattr(settings, "DB_DRIVER_CONFIG",
+                        {"initial_retry_delay": 0.25})
+
+    async def config():
+        driver = await OpenDriver()
+        try:
+            async with driver.session() as session:
+                return session._config
+        finally:
+            await CloseDriver()
+
+    config = asyncio.run(config())
+    assert config.max_transaction_retry_time == settings.DB_RETRY_TIME
+    assert config.retry_delay_multiplier == settings.DB_RETRY_MULTIPLIER
+    # DB_DRIVER_CONFIG overrides the DB_RETRY_* settings
+    assert config.initial_retry_delay == 0.25
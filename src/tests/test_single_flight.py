@@ -0,0 +1,123 @@
+"""tests/test_single_flight.py
+
+Concurrent UnitOfWork.ReadShared calls for the same key share one query,
+its result and its error.
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from onyx import settings
+from onyx.cache import SingleFlight
+from onyx.db.session import UnitOfWork
+from onyx.blog.post import GetBlogPost
+
+POST = {"UUID": "post-1", "Title": "Hello", "Content": "World",
+        "Published": True, "Owner": "user-1", "Creator": "user-1",
+        "CreatedDate": "2023-06-01T12:00:00+00:00",
+        "ModifiedDate": "2023-06-01T12:00:00+00:00"}
+
+
+class SlowResult:
+    def __init__(self, records):
+        self.records = records
+
+    async def data(self):
+        return self.records
+
+
+class SlowDatabase:
+    """SlowDatabase stands in for the driver. Each query takes delay
+    seconds, so concurrent callers overlap, and is counted.
+
+        Usage:
+            db = SlowDatabase()
+            monkeypatch.setattr(settings, "DB_DRIVER", db)
+    """
+
+    def __init__(self, delay=0.05, error=None):
+        self.delay = delay
+        self.error = error
+        self.queries = 0
+
+    def session(self, **kwargs):
+        return SlowSession(self)
+
+
+class SlowSession:
+    def __init__(self, db):
+        self.db = db
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute_read(self, work, *args, **kwargs):
+        return await work(self, *args, **kwargs)
+
+    async def run(self, query, parameters=None, **kwargs):
+        self.db.queries += 1
+        await asyncio.sleep(self.db.delay)
+        if self.db.error:
+            raise self.db.error
+        return SlowResult([{"post": POST}])
+
+
+@pytest.fixture
+def flight(monkeypatch):
+    flight = SingleFlight(timeout=settings.SINGLE_FLIGHT_TIMEOUT)
+    monkeypatch.setattr("onyx.db.session.READ_FLIGHT", flight)
+    return flight
+
+
+def _ReadConcurrently(db, count, key=("post", "post-1")):
+    """_ReadConcurrently - Reads the post count times at once, returns the
+    results & errors."""
+    async def read():
+        uow = UnitOfWork(db.session())
+        return await uow.ReadShared(key, GetBlogPost, UUID="post-1")
+
+    async def run():
+        return await asyncio.gather(*(read() for _ in range(count)),
+                                    return_exceptions=True)
+    return asyncio.run(run())
+
+
+def test_concurrent_reads_share_one_query(monkeypatch, flight):
+    db = SlowDatabase()
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    results = _ReadConcurrently(db, 1000)
+    assert db.queries == 1
+    assert flight.started == 1 and flight.joined == 999
+    assert all(post is results[0] for post in results)
+    assert results[0].Title == "Hello"
+
+
+def test_errors_reach_every_waiter(monkeypatch, flight):
+    db = SlowDatabase(error=RuntimeError("Database unavailable"))
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    results = _ReadConcurrently(db, 100)
+    assert db.queries == 1
+    assert all(isinstance(error, RuntimeError) for error in results)
+
+
+def test_finished_reads_run_again(monkeypatch, flight):
+    db = SlowDatabase(delay=0)
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    _ReadConcurrently(db, 10)
+    _ReadConcurrently(db, 10)
+    assert db.queries == 2
+
+
+def test_slow_reads_time_out(monkeypatch):
+    monkeypatch.setattr("onyx.db.session.READ_FLIGHT",
+                        SingleFlight(timeout=0.01))
+    db = SlowDatabase(delay=0.5)
+    monkeypatch.setattr(settings, "DB_DRIVER", db)
+    results = _ReadConcurrently(db, 10)
+    assert db.queries == 1
+    assert all(isinstance(error, HTTPException)
+               and error.status_code == 504 for error in results)
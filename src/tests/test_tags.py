@@ -0,0 +1,99 @@
+"""tests/test_tags.py
+
+Tag counts are read from maintained counters, never aggregated per request,
+guests only count what they may list, and the tag cloud is ordered by a
+counter property that an index can serve.
+"""
+import re
+import asyncio
+
+import pytest
+
+from onyx.db import queries
+from onyx.db.migrations import MIGRATIONS
+from onyx.blog import tag
+from models.user import User
+from tests.conftest import RecordingTx
+
+GUEST = None
+MEMBER = User.construct(UUID="member", Admin=False)
+ADMIN = User.construct(UUID="admin", Admin=True)
+
+
+class _TagResult:
+    def __init__(self, record):
+        self.record = record
+
+    async def single(self):
+        return self.record
+
+
+class TagTx(RecordingTx):
+    """TagTx returns the same tag node for every statement."""
+
+    def __init__(self, node, drafts=0):
+        super().__init__()
+        self.record = {"tag": node, "drafts": drafts}
+
+    async def run(self, query, parameters=None, **kwargs):
+        await super().run(query, parameters)
+        return _TagResult(self.record)
+
+
+NODE = {"Name": "news", "PostCount": 9, "PublishedCount": 5,
+        "PageCount": 4, "PublicPageCount": 3}
+
+
+@pytest.mark.parametrize("kind, user, counter", [
+    ("post", GUEST, "PublishedCount"),
+    ("post", MEMBER, "PublishedCount"),
+    ("post", ADMIN, "PostCount"),
+    ("page", GUEST, "PublicPageCount"),
+    ("page", MEMBER, "PageCount"),
+])
+def test_counters_match_what_the_user_may_list(kind, user, counter):
+    assert tag._Counter(kind, user) == counter
+
+
+def test_drafts_are_read_from_the_users_counter():
+    tx = TagTx(NODE, drafts=2)
+    result = asyncio.run(tag._ReadTag(tx, "news", "PublishedCount", "member"))
+    assert result.Count == 5 + 2
+    assert tx.queries == [queries.GET_TAG_WITH_DRAFTS]
+    # One counter relationship, no aggregation over the tagged posts
+    assert "count(" not in tx.queries[0]
+    assert "DRAFTS" in tx.queries[0]
+
+
+def test_guest_page_count_excludes_private_pages():
+    tx = TagTx(NODE)
+    result = asyncio.run(tag._ReadTag(tx, "news", tag._Counter("page", None)))
+    assert result.Count == 3
+
+
+@pytest.mark.parametrize("counter", queries.TAG_COUNTERS)
+def test_tag_cloud_orders_by_the_indexed_counter(counter):
+    first, forward, backward = queries.LIST_TAGS[counter]
+    assert f"ORDER BY tag.{counter} DESC, tag.Name DESC" in first
+    assert f"ORDER BY tag.{counter} DESC" in forward
+    assert f"WHERE tag.{counter} <= $after[0]" in forward
+    assert f"ORDER BY tag.{counter} ASC" in backward
+    for statement in (first, forward, backward):
+        assert "[$counter]" not in statement
+    indexes = " ".join(statement for _, _, statements in MIGRATIONS
+                       for statement in statements)
+    assert f"FOR (tag:Tag) ON (tag.{counter})" in indexes
+
+
+def test_writes_keep_the_draft_and_public_counters():
+    # Every statement that changes what a post or page counts as updates
+    # the counters in the same transaction
+    for statement in (queries.CREATE_BLOG_POST, queries.UPDATE_BLOG_POST,
+                      queries.DELETE_BLOG_POST, queries.UPDATE_NODE,
+                      queries.DELETE_NODE):
+        assert re.search(r"drafts\.Count = drafts\.Count [+-] 1", statement)
+    for statement in (queries.CREATE_PAGE, queries.UPDATE_PAGE,
+                      queries.DELETE_PAGE, queries.UPDATE_URL,
+                      queries.DELETE_URL, queries.UNLINK_URL,
+                      queries.RELINK_PAGE_URL):
+        assert "tag.PublicPageCount" in statement